@@ -0,0 +1,82 @@
+"""Broadcast throughput against Telegram stand-in.
+
+Redis stand-in, or SQLite file given with `--sqlite-states`, is filled
+with `--chats` user states, Redis also with some other keys. Broadcast is
+run once at `--rate` and then resumed to check nothing is sent twice.
+
+Run from project root:
+    python -m benchmarks.broadcast --chats 10000 --rate 1000
+"""
+
+import time
+from argparse import ArgumentParser
+
+from telegram import Bot
+from telegram.utils.request import Request
+
+from benchmarks.fake_telegram import TOKEN, FakeTelegramServer
+from benchmarks.load import InMemoryRedis
+from broadcast import Broadcast
+from state_storage import RedisStateStorage, SqliteStateStorage
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--chats", type=int, default=10000)
+    parser.add_argument("--rate", type=float, default=1000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--telegram-latency", type=float, default=0.0)
+    parser.add_argument(
+        "--sqlite-states", type=str, help="Keep user states in this SQLite file"
+    )
+    args = parser.parse_args()
+
+    redis_connection = InMemoryRedis()
+    state_storage = (
+        SqliteStateStorage(args.sqlite_states)
+        if args.sqlite_states
+        else RedisStateStorage(redis_connection)
+    )
+    state_storage.save_many(
+        {chat_id: b"state" for chat_id in range(10000, 10000 + args.chats)}
+    )
+    for chat_id in range(10000, 10000 + args.chats, 10):
+        redis_connection.set(f"invoice:{chat_id}", b"{}")
+
+    telegram_server = FakeTelegramServer(latency=args.telegram_latency).start()
+    try:
+        bot = Bot(
+            TOKEN,
+            base_url=telegram_server.base_url,
+            request=Request(con_pool_size=args.concurrency + 1),
+        )
+        broadcast = Broadcast(
+            bot,
+            redis_connection,
+            state_storage,
+            "benchmark",
+            "<b>Скидка 20% на все пиццы!</b>",
+            rate=args.rate,
+            concurrency=args.concurrency,
+            batch_size=args.batch_size,
+        )
+        started_at = time.perf_counter()
+        checkpoint = broadcast.run(report_interval=1)
+        elapsed = time.perf_counter() - started_at
+        print(
+            f"{checkpoint['sent']} messages in {elapsed:.2f} s, "
+            f"{checkpoint['sent'] / elapsed:.1f} msg/s at {args.rate:g} msg/s limit"
+        )
+        broadcast.run()
+        print(
+            "Messages sent by resumed broadcast: "
+            f"{telegram_server.call_counts['POST sendMessage'] - checkpoint['sent']}"
+        )
+    finally:
+        telegram_server.stop()
+        state_storage.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""Inline search index build, update and query time on a large menu.
+
+Run from project root:
+    python -m benchmarks.catalog_search [--products 1000]
+"""
+
+import itertools
+import random
+import time
+from argparse import ArgumentParser
+
+from catalog_search import CatalogIndex
+from models import Product
+
+
+STYLES = ["Римская", "Неаполитанская", "Острая", "Сырная", "Белая", "Детская"]
+TOPPINGS = [
+    "пепперони",
+    "ветчина",
+    "грибы",
+    "ананасы",
+    "моцарелла",
+    "халапеньо",
+    "курица",
+    "бекон",
+    "томаты",
+    "маслины",
+    "лосось",
+    "креветки",
+    "песто",
+    "горгонзола",
+]
+QUERIES = ["п", "пе", "пеп", "пепперони", "сыр", "острая курица", "ролл", "оцар", "гриб"]
+MENU_PAGE_SIZE = 8
+
+
+def make_product_cards(count, seed=0):
+    random.seed(seed)
+    product_cards = {}
+    for i in range(count):
+        toppings = random.sample(TOPPINGS, 3)
+        product = Product(
+            id=f"product-{i}",
+            name=f"{random.choice(STYLES)} {toppings[0]} {i}",
+            description=f"Пицца с начинкой: {', '.join(toppings)}. Тесто на закваске.",
+            price=400 + i % 50 * 10,
+            currency="RUB",
+            main_image_id=f"file-{i}",
+        )
+        product_cards[product.id] = (product, f"https://files.example.com/{i}.png")
+    return product_cards
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--products", type=int, default=1000)
+    parser.add_argument("-n", "--number", type=int, default=2000)
+    args = parser.parse_args()
+
+    product_cards = make_product_cards(args.products)
+    index = CatalogIndex()
+    started_at = time.perf_counter()
+    index.update(product_cards)
+    print(
+        f"Index of {args.products} products built in "
+        f"{(time.perf_counter() - started_at) * 1000:.1f} ms"
+    )
+
+    changed_cards = dict(product_cards)
+    for id in random.sample(list(changed_cards), max(1, args.products // 100)):
+        product, image_url = changed_cards[id]
+        changed_cards[id] = (product.replace(name=f"Новинка {product.name}"), image_url)
+    started_at = time.perf_counter()
+    index.update(changed_cards)
+    print(
+        f"Incremental update of {args.products // 100} changed products in "
+        f"{(time.perf_counter() - started_at) * 1000:.2f} ms"
+    )
+
+    latencies = []
+    for query in itertools.islice(itertools.cycle(QUERIES), args.number):
+        started_at = time.perf_counter()
+        index.search(query)
+        latencies.append(time.perf_counter() - started_at)
+    latencies.sort()
+    print(
+        f"Query p50 {percentile(latencies, 0.5) * 1e6:.1f} us, "
+        f"p99 {percentile(latencies, 0.99) * 1e6:.1f} us, "
+        f"max {latencies[-1] * 1e6:.1f} us"
+    )
+    print()
+    print(f"{'query':<16}{'matches':>8}{'us':>10}")
+    for query in QUERIES:
+        started_at = time.perf_counter()
+        results = index.search(query, limit=args.products)
+        elapsed = time.perf_counter() - started_at
+        print(f"{query:<16}{len(results):>8}{elapsed * 1e6:>10.1f}")
+
+    pages = -(-args.products // MENU_PAGE_SIZE)
+    print()
+    print(
+        f"Menu has {pages} pages, finding a pizza takes {pages / 2:.0f} page "
+        "flips on average vs one inline query"
+    )
+
+
+if __name__ == "__main__":
+    main()
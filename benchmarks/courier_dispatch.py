@@ -0,0 +1,169 @@
+"""Courier messages and route length with dispatch batching at peak.
+
+Simulates a peak hour of delivery orders spread over a few restaurants
+with customers within `--radius` km around them, in simulated time. For
+every dispatch window reports courier messages, stops per route, how long
+stops waited for dispatch and kilometres driven per order, compared with a
+separate round trip per order.
+
+Run from project root:
+    python -m benchmarks.courier_dispatch [--orders 600]
+"""
+
+import json
+import math
+import random
+import time
+from argparse import ArgumentParser
+
+from benchmarks.load import InMemoryRedis
+from courier_dispatch import CourierDispatcher, get_distance, plan_route
+from template_loader import create_jinja_env
+
+
+class RecordingBot:
+    def __init__(self):
+        self.messages = []
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.messages.append((chat_id, text))
+
+
+def make_orders(count, restaurants, radius, duration, seed=0):
+    random.seed(seed)
+    orders = []
+    for i in range(count):
+        restaurant = i % restaurants
+        restaurant_coords = {"lon": 37.6 + restaurant * 0.05, "lat": 55.75}
+        angle = random.uniform(0, 2 * math.pi)
+        # Degrees of latitude are ~111 km, longitude ~63 km at Moscow
+        offset = radius * math.sqrt(random.random())
+        orders.append(
+            (
+                random.uniform(0, duration),
+                {
+                    "order_id": f"order-{i}",
+                    "chat_id": 10000 + i,
+                    "restaurant_id": f"restaurant-{restaurant}",
+                    "restaurant_address": f"ул. Тестовая, {restaurant + 1}",
+                    "restaurant_coords": restaurant_coords,
+                    "restaurant_courier": 1000 + restaurant,
+                    "customer_coords": {
+                        "lon": restaurant_coords["lon"] + offset * math.cos(angle) / 63,
+                        "lat": restaurant_coords["lat"]
+                        + offset * math.sin(angle) / 111,
+                    },
+                    "cart_items": [{"name": "Пепперони", "quantity": 1}],
+                },
+            )
+        )
+    return sorted(orders, key=lambda timed_order: timed_order[0])
+
+
+def simulate(orders, window, max_stops, poll_interval):
+    """Feed orders to dispatcher polled every `poll_interval` seconds.
+
+    Returns:
+        tuple: number of courier messages, routes as lists of stops and
+            seconds every stop waited for dispatch
+    """
+    redis_connection = InMemoryRedis()
+    bot = RecordingBot()
+    dispatcher = CourierDispatcher(
+        redis_connection,
+        bot,
+        create_jinja_env(production=True),
+        window=window,
+        max_stops=max_stops,
+    )
+    stops_keys = {
+        dispatcher.STOPS_KEY.format(order["restaurant_id"]) for _, order in orders
+    }
+    routes = []
+    waits = []
+    order_index = 0
+    now = 0.0
+    while order_index < len(orders) or any(
+        redis_connection.lrange(key, 0, -1) for key in stops_keys
+    ):
+        while order_index < len(orders) and orders[order_index][0] <= now:
+            ordered_at, order = orders[order_index]
+            dispatcher.add(order, now=ordered_at)
+            order_index += 1
+        pending = {key: redis_connection.lrange(key, 0, -1) for key in stops_keys}
+        dispatcher.dispatch(now=now)
+        for key, stops in pending.items():
+            sent = len(stops) - len(redis_connection.lrange(key, 0, -1))
+            stops = [json.loads(stop) for stop in stops[:sent]]
+            routes.extend(
+                stops[start : start + max_stops] for start in range(0, sent, max_stops)
+            )
+            waits.extend(now - stop["added_at"] for stop in stops)
+        now += poll_interval
+    return len(bot.messages), routes, waits
+
+
+def get_route_km(stops):
+    start = stops[0]["restaurant_coords"]
+    route = plan_route(start, stops)
+    return sum(leg for _, leg in route) + get_distance(route[-1][0], start)
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--orders", type=int, default=600)
+    parser.add_argument("--restaurants", type=int, default=5)
+    parser.add_argument("--radius", type=float, default=5.0, help="Delivery km")
+    parser.add_argument("--duration", type=float, default=3600, help="Peak seconds")
+    parser.add_argument("--max-stops", type=int, default=5)
+    parser.add_argument("--poll-interval", type=float, default=1.0)
+    parser.add_argument("--windows", type=float, nargs="+", default=[30, 60, 120, 300])
+    args = parser.parse_args()
+
+    orders = make_orders(args.orders, args.restaurants, args.radius, args.duration)
+    round_trips_km = sum(
+        2 * get_distance(order["restaurant_coords"], order["customer_coords"])
+        for _, order in orders
+    )
+    print(
+        f"{args.orders} orders in {args.duration:.0f} s over {args.restaurants} "
+        f"restaurants, at most {args.max_stops} stops per route"
+    )
+    print(
+        f"{'window s':<10}{'messages':>10}{'stops/route':>13}"
+        f"{'p50 wait s':>12}{'max wait s':>12}{'km/order':>10}"
+    )
+    print(
+        f"{'none':<10}{args.orders:>10}{1:>13.2f}{0:>12.1f}{0:>12.1f}"
+        f"{round_trips_km / args.orders:>10.2f}"
+    )
+    for window in args.windows:
+        messages, routes, waits = simulate(
+            orders, window, args.max_stops, args.poll_interval
+        )
+        waits.sort()
+        km = sum(get_route_km(route) for route in routes)
+        print(
+            f"{window:<10.0f}{messages:>10}{args.orders / len(routes):>13.2f}"
+            f"{percentile(waits, 0.5):>12.1f}{waits[-1]:>12.1f}"
+            f"{km / args.orders:>10.2f}"
+        )
+
+    stops = [order["customer_coords"] for _, order in orders[: args.max_stops]]
+    number = 200
+    started_at = time.perf_counter()
+    for _ in range(number):
+        plan_route(orders[0][1]["restaurant_coords"], stops)
+    print(
+        f"Planning a route of {args.max_stops} stops takes "
+        f"{(time.perf_counter() - started_at) / number * 1e6:.0f} us"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class FakeHttpServer:
+    """In-process HTTP server standing in for a remote API.
+
+    Routes are registered as (method, path regex) pairs. Every request is
+    delayed by `latency` seconds and fails with 503 with `error_rate`
+    probability. Served calls are counted per route. GET responses carry
+    ETag and are answered with 304 if it matches `If-None-Match`.
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.call_counts = Counter()
+        self.__routes = []
+        self.__lock = threading.Lock()
+        self.__server = None
+
+    @property
+    def url(self):
+        host, port = self.__server.server_address
+        return f"http://{host}:{port}"
+
+    def route(self, method, pattern, handler, name=None):
+        name = name if name else pattern.replace("([^/]+)", "{id}")
+        self.__routes.append((method, re.compile(f"^{pattern}$"), name, handler))
+
+    def start(self):
+        self.__server = ThreadingHTTPServer(("127.0.0.1", 0), self.__make_handler())
+        self.__server.daemon_threads = True
+        threading.Thread(target=self.__server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    def reset_counts(self):
+        with self.__lock:
+            self.call_counts.clear()
+
+    def _dispatch(self, method, path, query, body):
+        for route_method, regex, name, handler in self.__routes:
+            if route_method != method or not (match := regex.match(path)):
+                continue
+            with self.__lock:
+                self.call_counts[f"{method} {name}"] += 1
+            if self.latency:
+                time.sleep(self.latency)
+            if self.error_rate and random.random() < self.error_rate:
+                return 503, {"errors": [{"title": "Injected failure"}]}
+            return handler(*match.groups(), query=query, body=body)
+        return 404, {"errors": [{"title": f"No route for {method} {path}"}]}
+
+    def __make_handler(self):
+        fake_server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def __handle(self):
+                parsed_url = urlparse(self.path)
+                length = int(self.headers.get("Content-Length") or 0)
+                raw_body = self.rfile.read(length) if length else b""
+                content_type = self.headers.get("Content-Type", "")
+                if "json" in content_type and raw_body:
+                    body = json.loads(raw_body)
+                elif "form-urlencoded" in content_type:
+                    body = {
+                        key: values[0]
+                        for key, values in parse_qs(raw_body.decode()).items()
+                    }
+                else:
+                    body = {}
+                status, payload = fake_server._dispatch(
+                    self.command, parsed_url.path, parse_qs(parsed_url.query), body
+                )
+                encoded = json.dumps(payload).encode()
+                etag = None
+                if self.command == "GET" and status == 200:
+                    etag = f'"{hashlib.sha1(encoded).hexdigest()}"'
+                    if self.headers.get("If-None-Match") == etag:
+                        status, encoded = 304, b""
+                self.send_response(status)
+                if etag:
+                    self.send_header("ETag", etag)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(encoded)))
+                self.end_headers()
+                self.wfile.write(encoded)
+
+            do_GET = do_POST = do_PUT = do_DELETE = __handle
+
+        return Handler
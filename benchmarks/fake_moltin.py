@@ -0,0 +1,238 @@
+import threading
+import uuid
+
+from benchmarks.fake_http import FakeHttpServer
+
+
+def make_products(count):
+    return [
+        {
+            "type": "product",
+            "id": f"product-{i}",
+            "name": f"Пицца {i}",
+            "slug": f"pizza-{i}",
+            "description": f"Описание пиццы {i}",
+            "price": [
+                {"amount": 400 + i * 10, "currency": "RUB", "includes_tax": True},
+                # Some products have prices set in dollars, the rest are
+                # converted by exchange rate
+                *(
+                    [{"amount": 499 + i * 10, "currency": "USD", "includes_tax": True}]
+                    if i % 2
+                    else []
+                ),
+            ],
+            "relationships": {
+                "main_image": {"data": {"type": "main_image", "id": f"file-{i}"}}
+            },
+        }
+        for i in range(count)
+    ]
+
+
+def make_restaurants(count):
+    return [
+        {
+            "type": "entry",
+            "id": f"restaurant-{i}",
+            "restaurant-alias": f"Пиццерия {i}",
+            "restaurant-address": f"ул. Тестовая, {i + 1}",
+            "restaurant-lon": 37.6 + i * 0.01,
+            "restaurant-lat": 55.7 + i * 0.01,
+            "restaurant-courier": 1000 + i,
+        }
+        for i in range(count)
+    ]
+
+
+def make_currencies():
+    return [
+        {
+            "type": "currency",
+            "id": f"currency-{code.lower()}",
+            "code": code,
+            "exchange_rate": exchange_rate,
+            "format": price_format,
+            "decimal_point": ".",
+            "thousand_separator": thousand_separator,
+            "decimal_places": decimal_places,
+            "default": code == "RUB",
+            "enabled": True,
+        }
+        for code, exchange_rate, price_format, thousand_separator, decimal_places in [
+            ("RUB", 1, "{price} Р", "", 0),
+            ("USD", 0.011, "${price}", ",", 2),
+            ("EUR", 0.01, "€{price}", ",", 2),
+        ]
+    ]
+
+
+class FakeMoltinServer(FakeHttpServer):
+    """Stand-in for endpoints used by `SimpleMoltinApiClient`."""
+
+    def __init__(self, products=20, restaurants=5, latency=0.0, error_rate=0.0):
+        super().__init__(latency=latency, error_rate=error_rate)
+        self.products = {product["id"]: product for product in make_products(products)}
+        self.flows = {
+            "restaurant": make_restaurants(restaurants),
+            "customer-address": [],
+        }
+        self.currencies = make_currencies()
+        self.carts = {}
+        self.customers = []
+        self.__lock = threading.Lock()
+
+        self.route("POST", "/oauth/access_token", self.access_token)
+        self.route("GET", "/v2/products", self.get_products)
+        self.route("GET", "/v2/products/([^/]+)", self.get_product)
+        self.route("GET", "/v2/files/([^/]+)", self.get_file)
+        self.route("GET", "/v2/currencies", self.get_currencies)
+        self.route("GET", "/v2/carts/([^/]+)/items", self.get_cart_items)
+        self.route("POST", "/v2/carts/([^/]+)/items", self.add_cart_item)
+        self.route("DELETE", "/v2/carts/([^/]+)/items/([^/]+)", self.remove_cart_item)
+        self.route("DELETE", "/v2/carts/([^/]+)", self.flush_cart)
+        self.route("POST", "/v2/carts/([^/]+)/checkout", self.checkout)
+        self.route("GET", "/v2/flows/([^/]+)/entries", self.get_flow_entries)
+        self.route("POST", "/v2/flows/([^/]+)/entries", self.create_flow_entry)
+        self.route("GET", "/v2/customers", self.get_customers)
+        self.route("POST", "/v2/customers", self.create_customer)
+
+    def access_token(self, query, body):
+        return 200, {"access_token": uuid.uuid4().hex, "expires_in": 3600}
+
+    def get_products(self, query, body):
+        products = list(self.products.values())
+        if filters := query.get("filter"):
+            # Only in(id,...) filter is supported
+            ids = filters[0].removeprefix("in(id,").removesuffix(")").split(",")
+            products = [product for product in products if product["id"] in ids]
+        return 200, self.__with_included_images(self.__paginate(products, query), query)
+
+    def get_product(self, product_id, query, body):
+        if product_id not in self.products:
+            return 404, {"errors": [{"title": "Product not found"}]}
+        return 200, self.__with_included_images(
+            {"data": self.products[product_id]}, query
+        )
+
+    def get_currencies(self, query, body):
+        return 200, self.__paginate(self.currencies, query)
+
+    def get_file(self, file_id, query, body):
+        return 200, {"data": self.__make_file(file_id)}
+
+    @staticmethod
+    def __make_file(file_id):
+        return {
+            "type": "file",
+            "id": file_id,
+            "link": {"href": f"https://files.example.com/{file_id}.jpg"},
+        }
+
+    @staticmethod
+    def __paginate(items, query, default_limit=25):
+        limit = int(query.get("page[limit]", [default_limit])[0])
+        offset = int(query.get("page[offset]", [0])[0])
+        has_next = offset + limit < len(items)
+        return {
+            "data": items[offset : offset + limit],
+            "links": {"next": f"?page[offset]={offset + limit}" if has_next else None},
+            "meta": {
+                "page": {"limit": limit, "offset": offset},
+                "results": {"total": len(items)},
+            },
+        }
+
+    def __with_included_images(self, response, query):
+        if "main_image" not in query.get("include", []):
+            return response
+        products = response["data"]
+        products = products if isinstance(products, list) else [products]
+        response["included"] = {
+            "main_images": [
+                self.__make_file(product["relationships"]["main_image"]["data"]["id"])
+                for product in products
+            ]
+        }
+        return response
+
+    def get_cart_items(self, cart_id, query, body):
+        with self.__lock:
+            items = [dict(item) for item in self.carts.get(cart_id, {}).values()]
+        total = sum(
+            item["meta"]["display_price"]["with_tax"]["value"]["amount"]
+            for item in items
+        )
+        return 200, {
+            "data": items,
+            "meta": {"display_price": {"with_tax": {"amount": total}}},
+        }
+
+    def add_cart_item(self, cart_id, query, body):
+        additions = body["data"] if isinstance(body["data"], list) else [body["data"]]
+        with self.__lock:
+            cart = self.carts.setdefault(cart_id, {})
+            for addition in additions:
+                self.__add_to_cart(cart, addition)
+        return 201, {"data": list(cart.values())}
+
+    def __add_to_cart(self, cart, addition):
+        product = self.products[addition["id"]]
+        item = cart.setdefault(
+            product["id"],
+            {
+                "type": "cart_item",
+                "id": f"item-{product['id']}",
+                "product_id": product["id"],
+                "name": product["name"],
+                "quantity": 0,
+            },
+        )
+        item["quantity"] += addition["quantity"]
+        amount = product["price"][0]["amount"] * item["quantity"]
+        item["meta"] = {
+            "display_price": {
+                "with_tax": {"value": {"amount": amount, "formatted": f"{amount} Р"}}
+            }
+        }
+
+    def remove_cart_item(self, cart_id, item_id, query, body):
+        with self.__lock:
+            cart = self.carts.get(cart_id, {})
+            for product_id, item in list(cart.items()):
+                if item["id"] == item_id:
+                    del cart[product_id]
+        return 200, {"data": []}
+
+    def flush_cart(self, cart_id, query, body):
+        with self.__lock:
+            self.carts.pop(cart_id, None)
+        return 200, {}
+
+    def checkout(self, cart_id, query, body):
+        return 201, {"data": {"type": "order", "id": uuid.uuid4().hex}}
+
+    def get_flow_entries(self, flow_slug, query, body):
+        return 200, self.__paginate(self.flows.get(flow_slug, []), query)
+
+    def create_flow_entry(self, flow_slug, query, body):
+        entry = {**body["data"], "id": uuid.uuid4().hex}
+        with self.__lock:
+            self.flows.setdefault(flow_slug, []).append(entry)
+        return 201, {"data": entry}
+
+    def get_customers(self, query, body):
+        customers = self.customers
+        if filters := query.get("filter"):
+            # Only eq(email,...) filter is supported
+            email = filters[0].removeprefix("eq(email,").removesuffix(")")
+            customers = [
+                customer for customer in customers if customer["email"] == email
+            ]
+        return 200, {"data": customers}
+
+    def create_customer(self, query, body):
+        customer = {**body["data"], "id": uuid.uuid4().hex}
+        with self.__lock:
+            self.customers.append(customer)
+        return 201, {"data": customer}
@@ -0,0 +1,67 @@
+import itertools
+import threading
+import time
+
+from benchmarks.fake_http import FakeHttpServer
+
+
+TOKEN = "123456:FAKE"
+
+MESSAGE_METHODS = [
+    "sendMessage",
+    "sendPhoto",
+    "sendLocation",
+    "sendInvoice",
+    "editMessageReplyMarkup",
+]
+BOOLEAN_METHODS = [
+    "deleteMessage",
+    "answerCallbackQuery",
+    "answerPreCheckoutQuery",
+    "answerInlineQuery",
+]
+
+
+class FakeTelegramServer(FakeHttpServer):
+    """Stand-in for Telegram Bot API methods called by the bot."""
+
+    def __init__(self, latency=0.0, error_rate=0.0):
+        super().__init__(latency=latency, error_rate=error_rate)
+        self.__message_ids = itertools.count(1)
+        self.__lock = threading.Lock()
+
+        self.route("POST", f"/bot{TOKEN}/getMe", self.get_me, name="getMe")
+        for method in MESSAGE_METHODS:
+            self.route("POST", f"/bot{TOKEN}/{method}", self.send_message, name=method)
+        for method in BOOLEAN_METHODS:
+            self.route("POST", f"/bot{TOKEN}/{method}", self.confirm, name=method)
+
+    @property
+    def base_url(self):
+        return f"{self.url}/bot"
+
+    def get_me(self, query, body):
+        return 200, {
+            "ok": True,
+            "result": {
+                "id": int(TOKEN.split(":")[0]),
+                "is_bot": True,
+                "first_name": "Fake Bot",
+                "username": "fake_bot",
+            },
+        }
+
+    def send_message(self, query, body):
+        with self.__lock:
+            message_id = next(self.__message_ids)
+        return 200, {
+            "ok": True,
+            "result": {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": int(body.get("chat_id", 0)), "type": "private"},
+            },
+        }
+
+    def confirm(self, query, body):
+        return 200, {"ok": True, "result": True}
@@ -0,0 +1,779 @@
+"""End-to-end load test of the state machine against local API stand-ins.
+
+Synthetic users go through menu -> product -> cart -> delivery -> payment,
+every update is passed to `StateMachine.handle_message`. Moltin and Telegram
+are replaced with in-process fake servers, Redis with an in-memory dict
+unless `--redis-url` is given.
+
+Run from project root:
+    python -m benchmarks.load --journeys 200 --concurrency 16
+"""
+
+import fnmatch
+import itertools
+import os
+import random
+import threading
+import time
+from argparse import ArgumentParser
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import redis
+from telegram import Bot, Update
+from telegram.ext import DispatcherHandlerStop
+
+from benchmarks.fake_moltin import FakeMoltinServer
+from benchmarks.fake_telegram import TOKEN, FakeTelegramServer
+import metrics
+import tracing
+from cart_coalescer import CoalescingCartClient
+from catalog import CatalogRefresher
+from catalog_cache import CachingMoltinClient
+from catalog_search import CatalogSearch
+from courier_dispatch import CourierDispatcher
+from fulfillment import FulfillmentPipeline
+from invoices import InvoiceRegistry
+from moltin_api import SimpleMoltinApiClient
+from order_events import STREAM_KEY, EventLog
+from prefetcher import Prefetcher
+from state_machine import StateMachine
+from state_storage import RedisStateStorage, SqliteStateStorage
+from states import MenuState, registry
+from template_loader import create_jinja_env
+
+
+class InMemoryRedis:
+    def __init__(self):
+        self.__data = {}
+        self.__lists = defaultdict(list)
+        self.__hashes = defaultdict(dict)
+        self.__streams = defaultdict(list)
+        self.__groups = {}
+        self.__stream_ids = itertools.count(1)
+        self.__locks = {}
+        self.__lock = threading.Lock()
+        self.__pushed = threading.Condition(self.__lock)
+
+    def exists(self, key):
+        with self.__lock:
+            return int(str(key) in self.__data)
+
+    def get(self, key):
+        with self.__lock:
+            return self.__data.get(str(key))
+
+    def mget(self, keys):
+        with self.__lock:
+            return [self.__data.get(str(key)) for key in keys]
+
+    def mset(self, mapping):
+        with self.__lock:
+            self.__data.update((str(key), value) for key, value in mapping.items())
+        return True
+
+    def set(self, key, value, nx=False, ex=None):
+        with self.__lock:
+            if nx and str(key) in self.__data:
+                return None
+            self.__data[str(key)] = value
+        return True
+
+    def scan(self, cursor=0, match=None, count=10):
+        with self.__lock:
+            keys = sorted(self.__data)
+        next_cursor = cursor + count if cursor + count < len(keys) else 0
+        return next_cursor, [
+            key.encode()
+            for key in keys[cursor : cursor + count]
+            if match is None or fnmatch.fnmatchcase(key, match)
+        ]
+
+    def delete(self, key):
+        with self.__lock:
+            return int(self.__data.pop(str(key), None) is not None)
+
+    def rpush(self, key, value):
+        with self.__lock:
+            self.__lists[key].append(str(value).encode())
+            return len(self.__lists[key])
+
+    def lrange(self, key, start, end):
+        with self.__lock:
+            return self.__lists[key][start : None if end == -1 else end + 1]
+
+    def ltrim(self, key, start, end):
+        with self.__lock:
+            self.__lists[key] = self.__lists[key][
+                start : None if end == -1 else end + 1
+            ]
+        return True
+
+    def sadd(self, key, value):
+        with self.__lock:
+            members = self.__data.setdefault(key, set())
+            is_new = str(value).encode() not in members
+            members.add(str(value).encode())
+            return int(is_new)
+
+    def smembers(self, key):
+        with self.__lock:
+            return set(self.__data.get(key, set()))
+
+    def lpush(self, key, value):
+        with self.__lock:
+            self.__lists[key].insert(0, str(value).encode())
+            self.__pushed.notify()
+            return len(self.__lists[key])
+
+    def llen(self, key):
+        with self.__lock:
+            return len(self.__lists[key])
+
+    def lrem(self, key, count, value):
+        with self.__lock:
+            try:
+                self.__lists[key].remove(str(value).encode())
+            except ValueError:
+                return 0
+            return 1
+
+    def rpoplpush(self, source, destination):
+        with self.__lock:
+            if not self.__lists[source]:
+                return None
+            value = self.__lists[source].pop()
+            self.__lists[destination].insert(0, value)
+            return value
+
+    def brpoplpush(self, source, destination, timeout=0):
+        with self.__pushed:
+            self.__pushed.wait_for(lambda: self.__lists[source], timeout or None)
+        return self.rpoplpush(source, destination)
+
+    def hincrby(self, key, field, amount=1):
+        with self.__lock:
+            value = self.__hashes[key].get(field, 0) + amount
+            self.__hashes[key][field] = value
+            return value
+
+    hincrbyfloat = hincrby
+
+    def hset(self, key, field, value):
+        with self.__lock:
+            is_new = field not in self.__hashes[key]
+            self.__hashes[key][field] = value
+            return int(is_new)
+
+    def hdel(self, key, field):
+        with self.__lock:
+            return int(self.__hashes[key].pop(field, None) is not None)
+
+    def hgetall(self, key):
+        with self.__lock:
+            return {
+                field.encode(): str(value).encode()
+                for field, value in self.__hashes[key].items()
+            }
+
+    def expire(self, key, seconds):
+        return True
+
+    def xadd(self, key, fields, maxlen=None, approximate=True):
+        id = f"{next(self.__stream_ids)}-0".encode()
+        with self.__lock:
+            self.__streams[key].append(
+                (id, {str(k).encode(): str(v).encode() for k, v in fields.items()})
+            )
+            if maxlen is not None:
+                del self.__streams[key][:-maxlen]
+        return id
+
+    def xlen(self, key):
+        with self.__lock:
+            return len(self.__streams[key])
+
+    def xgroup_create(self, key, group, id="$", mkstream=False):
+        with self.__lock:
+            if (key, group) in self.__groups:
+                raise redis.ResponseError(
+                    "BUSYGROUP Consumer Group name already exists"
+                )
+            self.__groups[key, group] = {"delivered": 0, "pending": {}}
+
+    def xreadgroup(self, group, consumer, streams, count=None, block=None):
+        ((key, id),) = streams.items()
+        with self.__lock:
+            state = self.__groups[key, group]
+            if id == ">":
+                entries = self.__streams[key][state["delivered"] :][:count]
+                state["delivered"] += len(entries)
+                state["pending"].update(entries)
+            else:
+                entries = list(state["pending"].items())[:count]
+        return [[key.encode(), entries]] if entries else []
+
+    def xack(self, key, group, *ids):
+        with self.__lock:
+            pending = self.__groups[key, group]["pending"]
+            return sum(pending.pop(id, None) is not None for id in ids)
+
+    def pipeline(self, transaction=True):
+        return InMemoryPipeline(self)
+
+    def lock(self, name, timeout=None, blocking_timeout=None):
+        with self.__lock:
+            lock = self.__locks.setdefault(name, InMemoryLock(blocking_timeout))
+        return lock
+
+
+class InMemoryLock:
+    """Lock of `InMemoryRedis`, which never expires"""
+
+    def __init__(self, blocking_timeout=None):
+        self.__lock = threading.Lock()
+        self.__blocking_timeout = blocking_timeout
+
+    def acquire(self, blocking=True):
+        timeout = self.__blocking_timeout if self.__blocking_timeout else -1
+        return self.__lock.acquire(blocking, timeout if blocking else -1)
+
+    def release(self):
+        self.__lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class InMemoryPipeline:
+    """Buffers calls and runs them on `execute`, not atomically.
+
+    Calls between `watch` and `multi` run right away, like in redis-py,
+    but watched keys are not checked for changes.
+    """
+
+    def __init__(self, redis_connection):
+        self.__redis = redis_connection
+        self.__calls = []
+        self.__immediate = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.__calls = []
+
+    def watch(self, *keys):
+        self.__immediate = True
+
+    def multi(self):
+        self.__immediate = False
+
+    def __getattr__(self, name):
+        method = getattr(self.__redis, name)
+        if self.__immediate:
+            return method
+
+        def buffer(*args, **kwargs):
+            self.__calls.append((method, args, kwargs))
+            return self
+
+        return buffer
+
+    def execute(self):
+        calls, self.__calls = self.__calls, []
+        return [method(*args, **kwargs) for method, args, kwargs in calls]
+
+
+class SlowRedis:
+    """In-memory Redis with latency added to every round trip"""
+
+    def __init__(self, latency):
+        self.__redis = InMemoryRedis()
+        self.__latency = latency
+
+    def __getattr__(self, name):
+        method = getattr(self.__redis, name)
+
+        def call(*args, **kwargs):
+            time.sleep(self.__latency)
+            return method(*args, **kwargs)
+
+        return call
+
+    def pipeline(self, transaction=True):
+        return SlowPipeline(self.__redis, self.__latency)
+
+
+class SlowPipeline(InMemoryPipeline):
+    def __init__(self, redis_connection, latency):
+        super().__init__(redis_connection)
+        self.__latency = latency
+
+    def execute(self):
+        time.sleep(self.__latency)
+        return super().execute()
+
+
+class FakeJobQueue:
+    def __init__(self):
+        self.jobs = []
+
+    def run_once(self, callback, when, context=None, name=None, **kwargs):
+        self.jobs.append((callback, when, context))
+
+
+class UpdateFactory:
+    def __init__(self, bot, invoices):
+        self.__bot = bot
+        self.__invoices = invoices
+        self.__update_ids = itertools.count(1)
+
+    def __build(self, payload):
+        return Update.de_json(
+            {"update_id": next(self.__update_ids), **payload}, self.__bot
+        )
+
+    @staticmethod
+    def __user(chat_id):
+        return {
+            "id": chat_id,
+            "is_bot": False,
+            "first_name": f"User {chat_id}",
+            # Half of users get prices in another currency
+            "language_code": "en" if chat_id % 2 else "ru",
+        }
+
+    def message(self, chat_id, **content):
+        return self.__build(
+            {
+                "message": {
+                    "message_id": 1,
+                    "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private"},
+                    "from": self.__user(chat_id),
+                    **content,
+                }
+            }
+        )
+
+    def callback(self, chat_id, data):
+        return self.__build(
+            {
+                "callback_query": {
+                    "id": f"{chat_id}-{data}",
+                    "from": self.__user(chat_id),
+                    "chat_instance": str(chat_id),
+                    "data": data,
+                    "message": {
+                        "message_id": 1,
+                        "date": int(time.time()),
+                        "chat": {"id": chat_id, "type": "private"},
+                    },
+                }
+            }
+        )
+
+    def pre_checkout(self, chat_id):
+        invoice = self.__invoices.get(chat_id)
+        return self.__build(
+            {
+                "pre_checkout_query": {
+                    "id": f"{chat_id}-checkout",
+                    "from": self.__user(chat_id),
+                    "currency": invoice["currency"],
+                    "total_amount": invoice["total_amount"],
+                    "invoice_payload": invoice["payload"],
+                }
+            }
+        )
+
+    def successful_payment(self, chat_id):
+        return self.message(
+            chat_id,
+            successful_payment={
+                "currency": "RUB",
+                "total_amount": 100,
+                "invoice_payload": "Custom-Payload",
+                "telegram_payment_charge_id": f"tg-{chat_id}",
+                "provider_payment_charge_id": f"provider-{chat_id}",
+            },
+        )
+
+
+def build_journey(updates: UpdateFactory, chat_id, product_ids, adds=1):
+    journey = [lambda: updates.message(chat_id, text="/start")]
+    for _ in range(adds):
+        product_id = random.choice(product_ids)
+        journey += [
+            lambda product_id=product_id: updates.callback(chat_id, product_id),
+            lambda: updates.callback(chat_id, "add_to_cart"),
+        ]
+    return journey + [
+        lambda: updates.callback(chat_id, "cart"),
+        lambda: updates.callback(chat_id, "order"),
+        lambda: updates.message(
+            chat_id, location={"longitude": 37.61, "latitude": 55.71}
+        ),
+        lambda: updates.callback(chat_id, "request_delivery"),
+        lambda: updates.pre_checkout(chat_id),
+        lambda: updates.successful_payment(chat_id),
+    ]
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class LoadTest:
+    def __init__(
+        self,
+        state_machine,
+        invoices,
+        context,
+        updates,
+        product_ids,
+        adds=1,
+        think_time=0.0,
+    ):
+        self.__state_machine = state_machine
+        self.__invoices = invoices
+        self.__adds = adds
+        self.__think_time = think_time
+        self.__context = context
+        self.__updates = updates
+        self.__product_ids = product_ids
+        self.__lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.failed_journeys = 0
+
+    def run_journey(self, chat_id):
+        journey = build_journey(
+            self.__updates, chat_id, self.__product_ids, adds=self.__adds
+        )
+        for make_update in journey:
+            if self.__think_time:
+                time.sleep(random.uniform(0.5, 1.5) * self.__think_time)
+            update = make_update()
+            current_state = self.__state_machine.users_state.get(chat_id)
+            if update.message and update.message.text == "/start":
+                label = "/start"
+            elif update.pre_checkout_query:
+                label = "pre_checkout"
+            else:
+                label = type(current_state).__name__
+            started_at = time.perf_counter()
+            try:
+                self.__dispatch(update)
+            except Exception:
+                with self.__lock:
+                    self.failed_journeys += 1
+                return
+            finally:
+                elapsed = time.perf_counter() - started_at
+                with self.__lock:
+                    self.latencies[label].append(elapsed)
+
+    def __dispatch(self, update):
+        if update.pre_checkout_query:
+            try:
+                self.__invoices.answer_pre_checkout(update, self.__context)
+            except DispatcherHandlerStop:
+                return
+        self.__state_machine.handle_message(update, self.__context)
+
+    def run(self, journeys, concurrency, first_chat_id=10000):
+        started_at = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(
+                executor.map(
+                    self.run_journey, range(first_chat_id, first_chat_id + journeys)
+                )
+            )
+        return time.perf_counter() - started_at
+
+
+def print_report(load_test: LoadTest, elapsed, journeys, upstreams):
+    total_updates = sum(len(values) for values in load_test.latencies.values())
+    print(f"Journeys: {journeys} ({load_test.failed_journeys} failed)")
+    print(f"Updates: {total_updates} in {elapsed:.2f} s")
+    print(
+        f"Throughput: {total_updates / elapsed:.1f} updates/s, "
+        f"{journeys / elapsed:.1f} journeys/s"
+    )
+    print()
+    print(
+        f"{'state':<24}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}"
+        f"{'p99 ms':>10}{'max ms':>10}"
+    )
+    for label, values in load_test.latencies.items():
+        values = sorted(values)
+        print(
+            f"{label:<24}{len(values):>8}"
+            + "".join(
+                f"{percentile(values, fraction) * 1000:>10.2f}"
+                for fraction in (0.5, 0.95, 0.99, 1)
+            )
+        )
+    for name, server in upstreams.items():
+        print()
+        print(f"{name} calls:")
+        for endpoint, count in sorted(server.call_counts.items()):
+            print(f"  {endpoint:<48}{count:>8}")
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("-j", "--journeys", type=int, default=100)
+    parser.add_argument("-c", "--concurrency", type=int, default=8)
+    parser.add_argument("--products", type=int, default=20)
+    parser.add_argument("--restaurants", type=int, default=5)
+    parser.add_argument(
+        "--adds", type=int, default=1, help="Products added to cart per journey"
+    )
+    parser.add_argument(
+        "--cart-coalesce-window",
+        type=float,
+        default=1.0,
+        help="Seconds to merge cart mutations within, 0 to disable",
+    )
+    parser.add_argument(
+        "--think-time",
+        type=float,
+        default=0.0,
+        help="Average seconds a user waits before the next update",
+    )
+    parser.add_argument(
+        "--prefetch-workers", type=int, default=4, help="0 disables prefetching"
+    )
+    parser.add_argument("--fulfillment-workers", type=int, default=2)
+    parser.add_argument(
+        "--courier-dispatch-window",
+        type=float,
+        default=120,
+        help="Seconds to collect courier stops within, 0 to send each at once",
+    )
+    parser.add_argument(
+        "--event-log-interval",
+        type=float,
+        default=1.0,
+        help="Seconds between order event flushes, 0 disables event log",
+    )
+    parser.add_argument(
+        "--catalog-refresh-interval",
+        type=float,
+        default=60,
+        help="Seconds between catalog revalidations, 0 disables catalog snapshot",
+    )
+    parser.add_argument(
+        "--catalog-snapshot", type=str, help="Path of catalog snapshot file"
+    )
+    parser.add_argument(
+        "--currencies",
+        type=str,
+        nargs="+",
+        default=["RUB", "USD"],
+        help="Currencies to price products in, the first is the default",
+    )
+    parser.add_argument(
+        "--currency-by-language",
+        type=str,
+        default="en=USD",
+        help="Currencies by user language, e.g. en=USD,de=EUR",
+    )
+    parser.add_argument(
+        "--moltin-latency", type=float, default=0.0, help="Seconds per Moltin call"
+    )
+    parser.add_argument(
+        "--telegram-latency", type=float, default=0.0, help="Seconds per Telegram call"
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0.0,
+        help="Probability of Moltin call to fail with 503",
+    )
+    parser.add_argument(
+        "--redis-url", type=str, help="Use real Redis instead of in-memory stand-in"
+    )
+    parser.add_argument(
+        "--redis-latency",
+        type=float,
+        default=0.0,
+        help="Seconds per round trip to in-memory Redis stand-in",
+    )
+    parser.add_argument(
+        "--sqlite-states", type=str, help="Keep user states in this SQLite file"
+    )
+    parser.add_argument(
+        "--metrics-port", type=int, help="Enable instrumentation and serve metrics"
+    )
+    parser.add_argument(
+        "--trace-slow-ms", type=float, help="Log span tree of updates slower than that"
+    )
+    parser.add_argument(
+        "--profile-sample-rate", type=float, default=0.0, help="Fraction to profile"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    tracing.configure(
+        slow_update_ms=args.trace_slow_ms, profile_sample_rate=args.profile_sample_rate
+    )
+    if args.metrics_port:
+        metrics.enable(args.metrics_port)
+    os.environ.setdefault("TELEGRAM_PAYMENT_TOKEN", "fake-payment-token")
+
+    moltin_server = FakeMoltinServer(
+        products=args.products,
+        restaurants=args.restaurants,
+        latency=args.moltin_latency,
+        error_rate=args.error_rate,
+    ).start()
+    telegram_server = FakeTelegramServer(latency=args.telegram_latency).start()
+
+    try:
+        bot = Bot(
+            TOKEN,
+            base_url=telegram_server.base_url,
+            request=metrics.InstrumentedRequest(con_pool_size=args.concurrency + 4),
+        )
+        if args.redis_url:
+            redis_connection = redis.Redis.from_url(args.redis_url)
+        elif args.redis_latency:
+            redis_connection = SlowRedis(args.redis_latency)
+        else:
+            redis_connection = InMemoryRedis()
+        if args.sqlite_states:
+            state_storage = SqliteStateStorage(args.sqlite_states)
+        else:
+            state_storage = RedisStateStorage(redis_connection)
+        moltin_api_client = SimpleMoltinApiClient(
+            "fake-client-id", "fake-secret", api_base_url=moltin_server.url
+        )
+        catalog = None
+        if args.catalog_refresh_interval:
+            catalog = CatalogRefresher(
+                moltin_api_client,
+                interval=args.catalog_refresh_interval,
+                snapshot_path=args.catalog_snapshot,
+                currencies=args.currencies,
+            )
+            started_at = time.perf_counter()
+            catalog.start()
+            print(
+                f"Catalog ready in {(time.perf_counter() - started_at) * 1000:.1f} ms"
+            )
+        moltin_client = CoalescingCartClient(
+            CachingMoltinClient(moltin_api_client, catalog=catalog),
+            window=args.cart_coalesce_window,
+        )
+        jinja_env = create_jinja_env(production=True)
+        job_queue = FakeJobQueue()
+        courier_dispatcher = None
+        if args.courier_dispatch_window:
+            courier_dispatcher = CourierDispatcher(
+                redis_connection,
+                bot,
+                jinja_env,
+                window=args.courier_dispatch_window,
+            )
+        fulfillment = FulfillmentPipeline(
+            redis_connection,
+            moltin_client,
+            bot,
+            job_queue,
+            jinja_env,
+            workers=args.fulfillment_workers,
+            retry_delay=0.05,
+            courier_dispatcher=courier_dispatcher,
+        )
+        fulfillment.start()
+        event_log = None
+        if args.event_log_interval:
+            event_log = EventLog(
+                redis_connection, flush_interval=args.event_log_interval
+            )
+            event_log.start()
+        state_machine = StateMachine(
+            MenuState,
+            registry,
+            state_storage,
+            moltin_client,
+            jinja_env,
+            prefetcher=(
+                Prefetcher(max_workers=args.prefetch_workers)
+                if args.prefetch_workers
+                else None
+            ),
+            event_log=event_log,
+        )
+        invoices = InvoiceRegistry(redis_connection)
+        context = SimpleNamespace(
+            bot=bot,
+            job_queue=job_queue,
+            bot_data={
+                "fulfillment": fulfillment,
+                "invoices": invoices,
+                "currency_by_language": dict(
+                    pair.split("=")
+                    for pair in args.currency_by_language.split(",")
+                    if pair
+                ),
+            },
+        )
+        if catalog:
+            context.bot_data["catalog_search"] = CatalogSearch(catalog)
+        if event_log:
+            context.bot_data["event_log"] = event_log
+
+        load_test = LoadTest(
+            state_machine,
+            invoices,
+            context,
+            UpdateFactory(bot, invoices),
+            list(moltin_server.products.keys()),
+            adds=args.adds,
+            think_time=args.think_time,
+        )
+        elapsed = load_test.run(args.journeys, args.concurrency)
+        started_at = time.perf_counter()
+        while redis_connection.llen(fulfillment.QUEUE_KEY) or any(
+            redis_connection.llen(fulfillment.PROCESSING_KEY.format(consumer.decode()))
+            for consumer in redis_connection.hgetall(fulfillment.LEASES_KEY)
+        ):
+            time.sleep(0.01)
+        fulfillment.stop()
+        if courier_dispatcher:
+            # Send what would be sent once the window passes
+            print(
+                f"Courier routes sent: {courier_dispatcher.dispatch(now=float('inf'))}"
+            )
+        print(
+            f"Orders fulfilled {(time.perf_counter() - started_at) * 1000:.1f} ms "
+            f"after last update, {redis_connection.llen(fulfillment.FAILED_KEY)} "
+            f"failed, {len(job_queue.jobs)} reminders scheduled"
+        )
+        if event_log:
+            event_log.stop()
+            print(f"Order events in stream: {redis_connection.xlen(STREAM_KEY)}")
+        print_report(
+            load_test,
+            elapsed,
+            args.journeys,
+            {"Moltin": moltin_server, "Telegram": telegram_server},
+        )
+    finally:
+        moltin_server.stop()
+        telegram_server.stop()
+
+
+if __name__ == "__main__":
+    main()
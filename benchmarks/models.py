@@ -0,0 +1,161 @@
+"""Decode time, memory and pickled size of raw Moltin documents vs models.
+
+Fake documents are leaner than real Moltin ones, which carry timestamps,
+links and meta of every resource, so real savings are bigger.
+
+Run from project root:
+    python -m benchmarks.models [--products 100]
+"""
+
+import json
+import pickle
+import timeit
+import tracemalloc
+from argparse import ArgumentParser
+
+from benchmarks.fake_moltin import make_products, make_restaurants
+from models import CartItem, Restaurant, loads
+from moltin_api import SimpleMoltinApiClient
+from states import PaymentInquiryState
+
+
+def make_products_response(count):
+    products = make_products(count)
+    return {
+        "data": products,
+        "included": {
+            "main_images": [
+                {
+                    "type": "file",
+                    "id": product["relationships"]["main_image"]["data"]["id"],
+                    "link": {"href": f"https://files.example.com/{product['id']}.png"},
+                }
+                for product in products
+            ]
+        },
+    }
+
+
+def make_cart_items(products):
+    return [
+        {
+            "type": "cart_item",
+            "id": f"item-{product['id']}",
+            "product_id": product["id"],
+            "name": product["name"],
+            "quantity": 2,
+            "meta": {
+                "display_price": {
+                    "with_tax": {
+                        "value": {
+                            "amount": product["price"][0]["amount"] * 2,
+                            "formatted": f"{product['price'][0]['amount'] * 2} Р",
+                        }
+                    }
+                }
+            },
+        }
+        for product in products
+    ]
+
+
+def measure_memory(build):
+    tracemalloc.start()
+    value = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del value
+    return size
+
+
+def build_raw_product_cards(payload):
+    products_info = json.loads(payload)
+    image_links = {
+        image["id"]: image["link"]["href"]
+        for image in products_info["included"]["main_images"]
+    }
+    return {
+        product["id"]: (
+            product,
+            image_links.get(product["relationships"]["main_image"]["data"]["id"]),
+        )
+        for product in products_info["data"]
+    }
+
+
+def print_row(name, before, after, unit):
+    print(f"{name:<36}{before:>12.1f}{after:>12.1f} {unit:<6}{before / after:>6.1f}x")
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--products", type=int, default=100)
+    parser.add_argument("-n", "--number", type=int, default=200)
+    args = parser.parse_args()
+
+    products_payload = json.dumps(
+        make_products_response(args.products), ensure_ascii=False
+    ).encode()
+    raw_cart_items = make_cart_items(make_products(5))
+    cart_payload = json.dumps({"data": raw_cart_items}, ensure_ascii=False).encode()
+    raw_restaurant = make_restaurants(1)[0]
+
+    print(f"{'':<36}{'raw':>12}{'models':>12}")
+    print_row(
+        f"decode {args.products} products",
+        timeit.timeit(lambda: json.loads(products_payload), number=args.number)
+        / args.number
+        * 1e6,
+        timeit.timeit(lambda: loads(products_payload), number=args.number)
+        / args.number
+        * 1e6,
+        "us",
+    )
+    print_row(
+        f"decode and build {args.products} cards",
+        timeit.timeit(
+            lambda: build_raw_product_cards(products_payload), number=args.number
+        )
+        / args.number
+        * 1e6,
+        timeit.timeit(
+            lambda: SimpleMoltinApiClient.get_product_cards(loads(products_payload)),
+            number=args.number,
+        )
+        / args.number
+        * 1e6,
+        "us",
+    )
+    print_row(
+        f"memory of {args.products} product cards",
+        measure_memory(lambda: build_raw_product_cards(products_payload)) / 1024,
+        measure_memory(
+            lambda: SimpleMoltinApiClient.get_product_cards(loads(products_payload))
+        )
+        / 1024,
+        "KiB",
+    )
+    print_row(
+        "memory of cart with 5 items",
+        measure_memory(lambda: json.loads(cart_payload)["data"]) / 1024,
+        measure_memory(
+            lambda: [CartItem.from_api(item) for item in loads(cart_payload)["data"]]
+        )
+        / 1024,
+        "KiB",
+    )
+
+    raw_state = PaymentInquiryState(raw_restaurant, 100, {"lon": 37.6, "lat": 55.7})
+    state = PaymentInquiryState(
+        Restaurant.from_api(raw_restaurant), 100, {"lon": 37.6, "lat": 55.7}
+    )
+    print_row(
+        "pickled PaymentInquiryState",
+        len(pickle.dumps(raw_state)),
+        len(pickle.dumps(state)),
+        "bytes",
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Cost of recording order events on the user path and aggregation speed.
+
+Compares writing every event to the stream right away, one Redis round
+trip each, with buffering them in `EventLog`. Redis is an in-memory
+stand-in with `--redis-latency` added to every round trip.
+
+Run from project root:
+    python -m benchmarks.order_events [--events 20000]
+"""
+
+import random
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from benchmarks.load import SlowRedis
+from order_analytics import OrderEventAggregator
+from order_events import STREAM_KEY, EventLog
+
+
+STATES = ["MenuState", "PizzaDescriptionState", "CartState", "DeliveryState"]
+
+
+def make_events(count, seed=0):
+    random.seed(seed)
+    events = []
+    for i in range(count):
+        chat = 10000 + i % 500
+        if i % 10 == 9:
+            events.append(
+                (
+                    "order",
+                    chat,
+                    {
+                        "order": f"charge-{i}",
+                        "cart_total": random.randint(400, 3000),
+                        "restaurant": f"restaurant-{i % 5}",
+                        "distance_km": round(random.uniform(0.1, 20), 2),
+                        "delivery": random.random() < 0.7,
+                    },
+                )
+            )
+        else:
+            events.append(
+                (
+                    "transition",
+                    chat,
+                    {
+                        "state": random.choice(STATES),
+                        "new_state": random.choice(STATES),
+                        "duration_ms": round(random.uniform(1, 50), 1),
+                    },
+                )
+            )
+    return events
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument(
+        "--redis-latency", type=float, default=0.0005, help="Seconds per round trip"
+    )
+    args = parser.parse_args()
+
+    events = make_events(args.events)
+
+    redis_connection = SlowRedis(args.redis_latency)
+    started_at = time.perf_counter()
+    for event, chat, fields in events:
+        redis_connection.xadd(STREAM_KEY, {"event": event, "chat": chat, **fields})
+    direct = (time.perf_counter() - started_at) / len(events)
+
+    redis_connection = SlowRedis(args.redis_latency)
+    event_log = EventLog(redis_connection, flush_interval=0.1, max_buffered=len(events))
+    event_log.start()
+    started_at = time.perf_counter()
+    for event, chat, fields in events:
+        event_log.record(event, chat, **fields)
+    buffered = (time.perf_counter() - started_at) / len(events)
+    event_log.stop()
+
+    print(f"Redis round trip {args.redis_latency * 1000:.2f} ms")
+    print(f"XADD per event:      {direct * 1e6:>10.1f} us on the user path")
+    print(f"EventLog.record:     {buffered * 1e6:>10.1f} us on the user path")
+    print(f"Events in stream:    {redis_connection.xlen(STREAM_KEY):>10}")
+
+    with tempfile.TemporaryDirectory() as export_dir:
+        aggregator = OrderEventAggregator(
+            redis_connection, "benchmark", export_dir=export_dir
+        )
+        started_at = time.perf_counter()
+        processed = aggregator.run(once=True)
+        elapsed = time.perf_counter() - started_at
+    print(
+        f"Aggregated {processed} events in {elapsed * 1000:.1f} ms, "
+        f"{processed / elapsed:.0f} events/s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Time to answer pre-checkout query arriving behind a backlog of updates.
+
+Dispatcher is fed `--backlog` updates taking `--update-ms` each and then a
+pre-checkout query, once with plain FIFO update queue and once with
+`PreCheckoutFirstQueue`.
+
+Run from project root:
+    python -m benchmarks.pre_checkout --backlog 200 --update-ms 20
+"""
+
+import queue
+import threading
+import time
+from argparse import ArgumentParser
+
+from telegram import Bot, Update
+from telegram.ext import Dispatcher, PreCheckoutQueryHandler, TypeHandler
+
+from benchmarks.fake_telegram import TOKEN, FakeTelegramServer
+from benchmarks.load import InMemoryRedis
+from invoices import InvoiceRegistry, PreCheckoutFirstQueue
+
+
+CHAT_ID = 10000
+
+
+def build_update(bot, update_id, payload):
+    return Update.de_json({"update_id": update_id, **payload}, bot)
+
+
+def measure(bot, update_queue, invoices, backlog, update_seconds):
+    answered = threading.Event()
+
+    def answer_pre_checkout(update, context):
+        try:
+            invoices.answer_pre_checkout(update, context)
+        finally:
+            answered.set()
+
+    def handle_update(update, context):
+        if update.pre_checkout_query:
+            return
+        time.sleep(update_seconds)
+
+    dispatcher = Dispatcher(bot, update_queue, workers=1)
+    dispatcher.add_handler(PreCheckoutQueryHandler(answer_pre_checkout), group=-1)
+    dispatcher.add_handler(TypeHandler(Update, handle_update))
+
+    invoice = invoices.get(CHAT_ID)
+    for update_id in range(1, backlog + 1):
+        update_queue.put(
+            build_update(
+                bot,
+                update_id,
+                {
+                    "message": {
+                        "message_id": update_id,
+                        "date": int(time.time()),
+                        "chat": {"id": CHAT_ID + update_id, "type": "private"},
+                        "text": "hello",
+                    }
+                },
+            )
+        )
+    thread = threading.Thread(target=dispatcher.start, daemon=True)
+    thread.start()
+    started_at = time.perf_counter()
+    update_queue.put(
+        build_update(
+            bot,
+            backlog + 1,
+            {
+                "pre_checkout_query": {
+                    "id": "checkout",
+                    "from": {"id": CHAT_ID, "is_bot": False, "first_name": "User"},
+                    "currency": invoice["currency"],
+                    "total_amount": invoice["total_amount"],
+                    "invoice_payload": invoice["payload"],
+                }
+            },
+        )
+    )
+    answered.wait()
+    elapsed = time.perf_counter() - started_at
+    dispatcher.stop()
+    thread.join()
+    return elapsed
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--backlog", type=int, default=200)
+    parser.add_argument("--update-ms", type=float, default=20)
+    parser.add_argument("--telegram-latency", type=float, default=0.0)
+    args = parser.parse_args()
+
+    telegram_server = FakeTelegramServer(latency=args.telegram_latency).start()
+    try:
+        bot = Bot(TOKEN, base_url=telegram_server.base_url)
+        invoices = InvoiceRegistry(InMemoryRedis())
+        invoices.register(CHAT_ID, "rub", 100000, "cart-hash")
+
+        for name, update_queue in (
+            ("FIFO queue", queue.Queue()),
+            ("PreCheckoutFirstQueue", PreCheckoutFirstQueue()),
+        ):
+            elapsed = measure(
+                bot, update_queue, invoices, args.backlog, args.update_ms / 1000
+            )
+            print(f"{name:<24}answered in {elapsed * 1000:>10.1f} ms")
+    finally:
+        telegram_server.stop()
+
+
+if __name__ == "__main__":
+    main()
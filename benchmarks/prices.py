@@ -0,0 +1,99 @@
+"""Price table build cost and pricing of carts and invoices from it.
+
+Reports time and memory to build the table once per catalog version, then
+time to price a menu cart label, a cart and an invoice with it compared
+with invoice prices taken from Moltin cart amounts.
+
+Run from project root:
+    python -m benchmarks.prices [--products 1000] [--currencies RUB USD EUR]
+"""
+
+import random
+import timeit
+import tracemalloc
+from argparse import ArgumentParser
+
+from telegram import LabeledPrice
+
+from benchmarks.fake_moltin import make_currencies, make_products
+from models import CartItem
+from prices import PriceTable
+
+
+def make_cart(products, size):
+    cart_items = []
+    for product in random.sample(products, size):
+        quantity = random.randint(1, 3)
+        amount = product["price"][0]["amount"] * quantity
+        cart_items.append(
+            CartItem(
+                id=f"item-{product['id']}",
+                product_id=product["id"],
+                name=product["name"],
+                quantity=quantity,
+                amount=amount,
+                formatted_amount=f"{amount} Р",
+            )
+        )
+    return cart_items
+
+
+def measure(function, number):
+    return timeit.timeit(function, number=number) / number * 1e6
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--products", type=int, default=1000)
+    parser.add_argument("--currencies", type=str, nargs="+", default=["RUB", "USD"])
+    parser.add_argument("--cart-size", type=int, default=5)
+    parser.add_argument("-n", "--number", type=int, default=10000)
+    args = parser.parse_args()
+
+    random.seed(0)
+    products_info = {"data": make_products(args.products)}
+    currencies_info = {"data": make_currencies()}
+
+    tracemalloc.start()
+    prices = PriceTable.from_api(products_info, currencies_info, args.currencies)
+    table_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    build = measure(
+        lambda: PriceTable.from_api(products_info, currencies_info, args.currencies),
+        10,
+    )
+    print(
+        f"Table of {args.products} products x {len(prices.currencies)} currencies: "
+        f"built in {build / 1000:.1f} ms, {table_bytes / 1024:.0f} KiB"
+    )
+
+    cart_items = make_cart(products_info["data"], args.cart_size)
+    print(f"{'operation':<32}{'currency':>10}{'us':>10}")
+    moltin_invoice = measure(
+        lambda: [
+            LabeledPrice(item.name, int(item.amount) * 100) for item in cart_items
+        ],
+        args.number,
+    )
+    print(f"{'invoice from Moltin amounts':<32}{'RUB':>10}{moltin_invoice:>10.2f}")
+    for currency in prices.currencies:
+        operations = {
+            "menu cart label": lambda: prices.format(
+                prices.get_total(cart_items, currency), currency
+            ),
+            "cart with item prices": lambda: [
+                prices.format(prices.get_item_amount(item, currency), currency)
+                for item in cart_items
+            ],
+            "invoice from table": lambda: [
+                LabeledPrice(item.name, prices.get_item_amount(item, currency))
+                for item in cart_items
+            ],
+        }
+        for name, operation in operations.items():
+            elapsed = measure(operation, args.number)
+            print(f"{name:<32}{currency:>10}{elapsed:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
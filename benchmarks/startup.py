@@ -0,0 +1,94 @@
+"""Cold start import time of the bot and command line tools.
+
+Every module is imported in a fresh interpreter `--number` times, median
+wall time above a bare interpreter start is reported, followed by the
+slowest direct imports of the bot by `python -X importtime`.
+
+Run from project root:
+    python -m benchmarks.startup [--number 10]
+"""
+
+import statistics
+import subprocess
+import sys
+import time
+import timeit
+from argparse import ArgumentParser
+
+from states import MenuState, registry
+
+
+MODULES = ["tg_bot", "broadcast", "order_analytics", "state_storage"]
+
+
+def measure_import(module, number):
+    code = f"import {module}" if module else "pass"
+    durations = []
+    for _ in range(number):
+        started_at = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], check=True)
+        durations.append(time.perf_counter() - started_at)
+    return statistics.median(durations)
+
+
+def get_preloaded_modules():
+    """Get modules imported by the bare interpreter, e.g. by site hooks"""
+    return set(
+        subprocess.run(
+            [sys.executable, "-c", "import sys; print('\\n'.join(sys.modules))"],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.split()
+    )
+
+
+def get_slowest_imports(module, count):
+    """Get cumulative import time of modules imported by `module` itself"""
+    preloaded = get_preloaded_modules()
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stderr
+    # Nested imports are reported before the module importing them
+    imports = []
+    for line in stderr.splitlines()[1:]:
+        _, cumulative, name = line.split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        imports.append((depth, name.strip(), int(cumulative) / 1000))
+    module_depth = next(depth for depth, name, _ in imports if name == module)
+    direct = [
+        (name, cumulative)
+        for depth, name, cumulative in imports
+        if depth == module_depth + 1 and name not in preloaded
+    ]
+    return sorted(direct, key=lambda item: item[1], reverse=True)[:count]
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("-n", "--number", type=int, default=10)
+    parser.add_argument("--top", type=int, default=12)
+    args = parser.parse_args()
+
+    interpreter = measure_import(None, args.number)
+    print(f"Bare interpreter start {interpreter * 1000:.1f} ms")
+    print(f"{'module':<20}{'import ms':>10}")
+    for module in MODULES:
+        elapsed = measure_import(module, args.number) - interpreter
+        print(f"{module:<20}{elapsed * 1000:>10.1f}")
+
+    number = 1000
+    elapsed = timeit.timeit(lambda: registry.validate(MenuState), number=number)
+    print(f"State registry validation {elapsed / number * 1e6:.1f} us")
+
+    print()
+    print("Slowest imports of tg_bot (cumulative, -X importtime):")
+    for name, cumulative in get_slowest_imports("tg_bot", args.top):
+        print(f"  {name:<40}{cumulative:>8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""Latency of user state persistence backends.
+
+Redis is the in-memory stand-in with `--redis-latency` added to every
+round trip, or a real server given with `--redis-url`. SQLite database is
+created in a temporary directory.
+
+Run from project root:
+    python -m benchmarks.state_storage [--chats 10000]
+"""
+
+import os
+import pickle
+import random
+import tempfile
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+
+import redis
+
+from benchmarks.load import SlowRedis
+from models import Restaurant
+from state_storage import RedisStateStorage, SqliteStateStorage
+from states import CartState, MenuState, PaymentInquiryState
+
+
+def make_states(chats):
+    restaurant = Restaurant(
+        id="restaurant-1",
+        address="Москва, ул. Тверская, 1",
+        lon=37.61,
+        lat=55.76,
+        courier=123456,
+    )
+    samples = [
+        pickle.dumps(MenuState(menu_page=2)),
+        pickle.dumps(CartState()),
+        pickle.dumps(
+            PaymentInquiryState(
+                restaurant, 100, {"lon": 37.6, "lat": 55.7}, distance=2.4
+            )
+        ),
+    ]
+    return {10000 + i: random.choice(samples) for i in range(chats)}
+
+
+def measure(operation, items):
+    started_at = time.perf_counter()
+    for item in items:
+        operation(item)
+    return (time.perf_counter() - started_at) / len(items) * 1e6
+
+
+def measure_mixed(storage, states, operations, workers):
+    chat_ids = list(states)
+
+    def handle(_):
+        chat_id = random.choice(chat_ids)
+        # Every update loads the state once the cache is cold and saves
+        # the new one
+        storage.load(chat_id)
+        storage.save(chat_id, states[chat_id])
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(handle, range(operations)))
+    return operations / (time.perf_counter() - started_at)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--chats", type=int, default=10000)
+    parser.add_argument("-n", "--number", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument(
+        "--redis-latency", type=float, default=0.0003, help="Seconds per round trip"
+    )
+    parser.add_argument("--redis-url", type=str, help="Use real Redis server")
+    args = parser.parse_args()
+
+    random.seed(0)
+    states = make_states(args.chats)
+    chat_ids = list(states)
+    sample = random.sample(chat_ids, min(args.number, len(chat_ids)))
+    batches = [
+        random.sample(chat_ids, args.batch_size)
+        for _ in range(max(1, args.number // args.batch_size))
+    ]
+
+    with tempfile.TemporaryDirectory() as directory:
+        backends = {
+            "redis": RedisStateStorage(
+                redis.Redis.from_url(args.redis_url)
+                if args.redis_url
+                else SlowRedis(args.redis_latency)
+            ),
+            "sqlite": SqliteStateStorage(os.path.join(directory, "states.db")),
+        }
+        print(
+            f"{'backend':<10}{'load us':>10}{'save us':>10}"
+            f"{f'load {args.batch_size} us':>16}{f'save {args.batch_size} us':>16}"
+            f"{f'{args.workers} threads upd/s':>20}"
+        )
+        for name, storage in backends.items():
+            storage.save_many(states)
+            load = measure(storage.load, sample)
+            save = measure(
+                lambda chat_id: storage.save(chat_id, states[chat_id]), sample
+            )
+            load_many = measure(storage.load_many, batches)
+            save_many = measure(
+                lambda batch: storage.save_many(
+                    {chat_id: states[chat_id] for chat_id in batch}
+                ),
+                batches,
+            )
+            mixed = measure_mixed(storage, states, args.number, args.workers)
+            print(
+                f"{name:<10}{load:>10.1f}{save:>10.1f}{load_many:>16.1f}"
+                f"{save_many:>16.1f}{mixed:>20.0f}"
+            )
+            storage.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""Startup and render cost per template.
+
+Run from project root:
+    python -m benchmarks.template_render [-n 10000]
+"""
+
+import tempfile
+import timeit
+from argparse import ArgumentParser
+
+from models import CartItem, Product
+from template_loader import (
+    TEMPLATES_DIR,
+    compile_templates,
+    create_jinja_env,
+    render_static,
+)
+
+
+CART_ITEMS = [
+    CartItem(
+        id=f"item-{i}",
+        product_id=f"product-{i}",
+        name=f"Пицца {i}",
+        quantity=i,
+        amount=i * 100,
+        formatted_amount=f"{i}00 Р",
+    )
+    for i in range(1, 4)
+]
+
+SAMPLE_CONTEXTS = {
+    "arrange_delivery_message.html": None,
+    "customer_reminder_message.html": None,
+    "menu_message.html": None,
+    "cart_message.html": {"cart_items": CART_ITEMS, "total_price": "600 Р"},
+    "confirm_delivery_message.html": {
+        "address": "ул. Тестовая, 1",
+        "distance": 3.2,
+        "delivery_price": "100 Р",
+    },
+    "courier_notification_message.html": {
+        "cart_items": CART_ITEMS,
+        "restaurant_address": "ул. Тестовая, 1",
+    },
+    "payment_message.html": {
+        "cart_items": CART_ITEMS,
+        "total_price": "700 Р",
+        "delivery_ordered": True,
+        "restaurant_address": "ул. Тестовая, 1",
+        "delivery_price": "100 Р",
+    },
+    "product_details_message.html": {
+        "product": Product(
+            id="product-1",
+            name="Пицца",
+            description="Описание",
+            price=500,
+            currency="RUB",
+        ),
+        "price": "500 Р",
+    },
+}
+
+
+def measure(jinja_env, template_name, context, number):
+    if context is None:
+        render = lambda: render_static(jinja_env, template_name)
+    else:
+        render = lambda: jinja_env.get_template(template_name).render(**context)
+    return timeit.timeit(render, number=number) / number * 1e6
+
+
+def measure_startup(create_env, number):
+    """Time to create environment and render every template once"""
+
+    def start():
+        jinja_env = create_env()
+        for template_name, context in SAMPLE_CONTEXTS.items():
+            jinja_env.get_template(template_name).render(**(context or {}))
+
+    return timeit.timeit(start, number=number) / number * 1e3
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("-n", "--number", type=int, default=10000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as compiled_dir:
+        compile_templates(compiled_dir, templates_dir=TEMPLATES_DIR)
+        env_factories = {
+            "reload": create_jinja_env,
+            "production": lambda: create_jinja_env(production=True),
+            "precompiled": lambda: create_jinja_env(
+                compiled_templates_dir=compiled_dir, production=True
+            ),
+        }
+        environments = {
+            name: create_env() for name, create_env in env_factories.items()
+        }
+
+        startup_number = max(args.number // 1000, 1)
+        print(f"{'startup':<40}" + "".join(f"{name:>14}" for name in environments))
+        timings = [
+            measure_startup(create_env, startup_number)
+            for create_env in env_factories.values()
+        ]
+        print(f"{'':<40}" + "".join(f"{timing:>11.2f} ms" for timing in timings))
+        print()
+
+        print(f"{'template':<40}" + "".join(f"{name:>14}" for name in environments))
+        for template_name, context in SAMPLE_CONTEXTS.items():
+            timings = [
+                measure(jinja_env, template_name, context, args.number)
+                for jinja_env in environments.values()
+            ]
+            print(
+                f"{template_name:<40}"
+                + "".join(f"{timing:>11.2f} us" for timing in timings)
+            )
+
+
+if __name__ == "__main__":
+    main()
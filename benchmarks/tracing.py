@@ -0,0 +1,58 @@
+"""Overhead of slow-update tracing and sampled profiling per update.
+
+Every update is a `trace_update` block with `--spans` nested spans, like
+state stages and upstream calls of a real update, doing no work of its
+own, so the figures are the pure cost of instrumentation.
+
+Run from project root:
+    python -m benchmarks.tracing [--updates 20000] [--spans 8]
+"""
+
+import tempfile
+import timeit
+from argparse import ArgumentParser
+
+import tracing
+
+
+def handle_update(spans):
+    with tracing.trace_update(chat_id=1, update_id=1):
+        for number in range(spans):
+            with tracing.span(f"stage-{number}"):
+                tracing.annotate(status=200)
+
+
+def measure(updates, spans, **settings):
+    tracing.configure(**settings)
+    try:
+        seconds = timeit.timeit(lambda: handle_update(spans), number=updates)
+    finally:
+        tracing.configure()
+    return seconds / updates * 1e6
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("-n", "--updates", type=int, default=20000)
+    parser.add_argument("--spans", type=int, default=8)
+    parser.add_argument("--profile-sample-rate", type=float, default=0.01)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as profile_dir:
+        modes = {
+            "disabled": {},
+            # Threshold is never reached, so nothing is logged
+            "tracing": {"slow_update_ms": 1e9},
+            f"profiling {args.profile_sample_rate:.0%}": {
+                "profile_sample_rate": args.profile_sample_rate,
+                "profile_dir": profile_dir,
+            },
+        }
+        print(f"{'mode':<20}{'per update':>14}")
+        for name, settings in modes.items():
+            timing = measure(args.updates, args.spans, **settings)
+            print(f"{name:<20}{timing:>11.2f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+import json
+import threading
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+
+import redis
+from environs import Env
+from telegram import Bot
+from telegram.constants import PARSEMODE_HTML
+from telegram.error import BadRequest, RetryAfter, TelegramError, Unauthorized
+from telegram.utils.request import Request
+
+from state_storage import StateStorage, create_state_storage
+from template_loader import TEMPLATES_DIR, create_jinja_env
+
+
+class RateLimiter:
+    """Let through at most `rate` calls per second across all threads"""
+
+    def __init__(self, rate):
+        self.__interval = 1 / rate
+        self.__next_at = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def acquire(self):
+        with self.__lock:
+            now = time.monotonic()
+            wait = self.__next_at - now
+            self.__next_at = max(self.__next_at, now) + self.__interval
+        if wait > 0:
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self.__lock:
+            self.__next_at = max(self.__next_at, time.monotonic() + seconds)
+
+
+class Broadcast:
+    """Send the same message to every chat the bot has state saved for.
+
+    Chats are enumerated from the state storage in batches of `batch_size`,
+    each batch is sent by `concurrency` threads at no more than `rate`
+    messages per second in total. Progress is saved in Redis after every
+    batch, so an interrupted broadcast resumes from the last batch, which
+    is sent again. Chats which blocked the bot are counted as failed.
+    """
+
+    CHECKPOINT_KEY = "broadcast:{}"
+
+    def __init__(
+        self,
+        bot: Bot,
+        redis_connection,
+        state_storage: StateStorage,
+        name,
+        text,
+        rate=20,
+        concurrency=8,
+        batch_size=500,
+        max_attempts=3,
+    ):
+        self.__bot = bot
+        self.__redis = redis_connection
+        self.__storage = state_storage
+        self.__checkpoint_key = self.CHECKPOINT_KEY.format(name)
+        self.__text = text
+        self.__rate_limiter = RateLimiter(rate)
+        self.__concurrency = concurrency
+        self.__batch_size = batch_size
+        self.__max_attempts = max_attempts
+
+    def __load_checkpoint(self):
+        if (checkpoint := self.__redis.get(self.__checkpoint_key)) is not None:
+            checkpoint = json.loads(checkpoint)
+            # Checkpoints saved before storages got positions keep SCAN cursor
+            if "cursor" in checkpoint:
+                checkpoint["position"] = checkpoint.pop("cursor") or None
+            return checkpoint
+        return {"position": None, "sent": 0, "failed": 0, "done": False}
+
+    def reset(self):
+        self.__redis.delete(self.__checkpoint_key)
+
+    def run(self, report_interval=10, report=print):
+        """Send message to all chats not covered by previous runs.
+
+        Returns:
+            dict: checkpoint with `sent` and `failed` message counts
+        """
+        checkpoint = self.__load_checkpoint()
+        if checkpoint["done"]:
+            return checkpoint
+
+        started_at = reported_at = time.monotonic()
+        processed_before = checkpoint["sent"] + checkpoint["failed"]
+        with ThreadPoolExecutor(
+            max_workers=self.__concurrency, thread_name_prefix="broadcast"
+        ) as executor:
+            for chat_ids, position in self.__storage.iter_chat_ids(
+                batch_size=self.__batch_size, position=checkpoint["position"]
+            ):
+                for is_sent in executor.map(self.__send, chat_ids):
+                    checkpoint["sent" if is_sent else "failed"] += 1
+                checkpoint["position"] = position
+                checkpoint["done"] = position is None
+                self.__redis.set(self.__checkpoint_key, json.dumps(checkpoint))
+
+                now = time.monotonic()
+                if checkpoint["done"] or now - reported_at >= report_interval:
+                    reported_at = now
+                    processed = checkpoint["sent"] + checkpoint["failed"]
+                    throughput = (processed - processed_before) / (now - started_at)
+                    report(
+                        f"{checkpoint['sent']} sent, {checkpoint['failed']} failed, "
+                        f"{throughput:.1f} msg/s"
+                    )
+        return checkpoint
+
+    def __send(self, chat_id):
+        for _ in range(self.__max_attempts):
+            self.__rate_limiter.acquire()
+            try:
+                self.__bot.send_message(
+                    chat_id=chat_id, text=self.__text, parse_mode=PARSEMODE_HTML
+                )
+                return True
+            except RetryAfter as error:
+                self.__rate_limiter.pause(error.retry_after)
+            except (Unauthorized, BadRequest):
+                # Bot is blocked or chat is gone
+                return False
+            except TelegramError:
+                pass
+        return False
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument(
+        "template", type=str, help="Name of message template, e.g. promo_message.html"
+    )
+    parser.add_argument(
+        "--name",
+        type=str,
+        help="Broadcast name to save progress under, template name by default",
+    )
+    parser.add_argument(
+        "-T",
+        "--templates-dir",
+        type=str,
+        default=TEMPLATES_DIR,
+        help="Directory with message templates",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=20,
+        help="Messages per second, keep below 30 to leave room for bot users",
+    )
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument(
+        "--restart", action="store_true", help="Start over instead of resuming"
+    )
+
+    args = parser.parse_args()
+
+    env = Env()
+    env.read_env()
+
+    redis_connection = redis.Redis(
+        host=env("REDIS_HOST"),
+        port=env("REDIS_PORT"),
+        password=env("REDIS_PASSWORD"),
+    )
+    bot = Bot(
+        env("TELEGRAM_BOT_TOKEN"),
+        request=Request(con_pool_size=args.concurrency + 1),
+    )
+    state_storage = create_state_storage(
+        redis_connection, path=env("STATE_STORAGE_PATH", None)
+    )
+    text = create_jinja_env(args.templates_dir).get_template(args.template).render()
+
+    broadcast = Broadcast(
+        bot,
+        redis_connection,
+        state_storage,
+        args.name if args.name else args.template,
+        text,
+        rate=args.rate,
+        concurrency=args.concurrency,
+        batch_size=args.batch_size,
+    )
+    if args.restart:
+        broadcast.reset()
+    checkpoint = broadcast.run()
+    state_storage.close()
+    print(f"Broadcast done: {checkpoint['sent']} sent, {checkpoint['failed']} failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+import logging
+import threading
+
+from models import CartItem
+
+
+logger = logging.getLogger("pizza_bot")
+
+
+class _PendingCart:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.additions = {}
+        self.removals = []
+        self.discarded = False
+        self.timer = None
+        self.failures = 0
+
+    def is_empty(self):
+        return not self.additions and not self.removals and not self.discarded
+
+
+class _PendingAddition:
+    def __init__(self, unit_price=None):
+        self.quantity = 0
+        self.unit_price = unit_price
+
+
+class CoalescingCartClient:
+    """Moltin client wrapper merging cart mutations made within a short window.
+
+    Added quantities of the same product are summed up and all pending additions
+    are sent as one (bulk) request once `window` seconds pass since the first
+    pending mutation, or as soon as the cart is read. Optimistic cart reads
+    return server cart with pending mutations applied on top, without waiting
+    for them to be sent. Mutations which failed to be sent stay pending and
+    are retried with growing delay, they are dropped after `max_attempts`
+    failed attempts. Every other method is passed to the wrapped client as is.
+    """
+
+    def __init__(self, moltin_client, window=1.0, max_attempts=5):
+        self.__moltin = moltin_client
+        self.__window = window
+        self.__max_attempts = max_attempts
+        self.__lock = threading.Lock()
+        self.__carts = {}
+
+    def __getattr__(self, name):
+        return getattr(self.__moltin, name)
+
+    def __acquire_cart(self, cart_id):
+        while True:
+            with self.__lock:
+                cart = self.__carts.setdefault(cart_id, _PendingCart())
+            cart.lock.acquire()
+            if self.__carts.get(cart_id) is cart:
+                return cart
+            # Cart got flushed and dropped while we were waiting
+            cart.lock.release()
+
+    def __release_cart(self, cart_id, cart):
+        if cart.is_empty():
+            if cart.timer:
+                cart.timer.cancel()
+            with self.__lock:
+                del self.__carts[cart_id]
+        cart.lock.release()
+
+    def __schedule_flush(self, cart_id, cart, delay=None):
+        if cart.timer is None:
+            cart.timer = threading.Timer(
+                self.__window if delay is None else delay, self.flush, args=(cart_id,)
+            )
+            cart.timer.daemon = True
+            cart.timer.start()
+
+    def __send_pending(self, cart_id, cart):
+        # Mutations are taken off the cart once sent, so the failed ones and
+        # the ones after them stay pending
+        try:
+            if cart.discarded:
+                self.__moltin.flush_cart(cart_id)
+                cart.discarded = False
+            while cart.removals:
+                self.__moltin.remove_product_from_cart(cart_id, cart.removals[0])
+                cart.removals.pop(0)
+            quantities_by_currency = {}
+            for (product_id, currency), addition in cart.additions.items():
+                quantities_by_currency.setdefault(currency, {})[
+                    product_id
+                ] = addition.quantity
+            for currency, quantities in quantities_by_currency.items():
+                if len(quantities) == 1:
+                    [(product_id, quantity)] = quantities.items()
+                    self.__moltin.add_product_to_cart(
+                        cart_id, product_id, quantity, currency=currency
+                    )
+                else:
+                    self.__moltin.add_products_to_cart(
+                        cart_id, quantities, currency=currency
+                    )
+                for product_id in quantities:
+                    del cart.additions[(product_id, currency)]
+        except Exception:
+            cart.failures += 1
+            if cart.failures >= self.__max_attempts:
+                logger.exception(
+                    f"Failed to update cart({cart_id}) {cart.failures} times, "
+                    "pending changes dropped"
+                )
+                cart.additions, cart.removals, cart.discarded = {}, [], False
+                cart.failures = 0
+                return
+            logger.warning(f"Failed to update cart({cart_id}), retrying", exc_info=True)
+            if cart.timer:
+                cart.timer.cancel()
+                cart.timer = None
+            self.__schedule_flush(cart_id, cart, delay=self.__window * 2**cart.failures)
+            return
+        cart.failures = 0
+
+    def flush(self, cart_id):
+        """Send pending mutations of the cart right away"""
+        if cart_id not in self.__carts:
+            return
+        cart = self.__acquire_cart(cart_id)
+        try:
+            self.__send_pending(cart_id, cart)
+        finally:
+            self.__release_cart(cart_id, cart)
+
+    def flush_all(self):
+        for cart_id in list(self.__carts):
+            self.flush(cart_id)
+
+    def add_product_to_cart(
+        self, cart_id, product_id, quantity, currency=None, unit_price=None
+    ):
+        """Queue product addition.
+        `unit_price` is only used to estimate total price of optimistic reads."""
+        if not self.__window:
+            return self.__moltin.add_product_to_cart(
+                cart_id, product_id, quantity, currency=currency
+            )
+
+        cart = self.__acquire_cart(cart_id)
+        try:
+            addition = cart.additions.setdefault(
+                (product_id, currency), _PendingAddition(unit_price)
+            )
+            addition.quantity += quantity
+            self.__schedule_flush(cart_id, cart)
+        finally:
+            self.__release_cart(cart_id, cart)
+
+    def remove_product_from_cart(self, cart_id, item_id):
+        if not self.__window:
+            return self.__moltin.remove_product_from_cart(cart_id, item_id)
+
+        cart = self.__acquire_cart(cart_id)
+        try:
+            cart.removals.append(item_id)
+            self.__schedule_flush(cart_id, cart)
+        finally:
+            self.__release_cart(cart_id, cart)
+
+    def get_cart_and_full_price(self, cart_id, optimistic=False, complete_items=False):
+        """Get cart items and total price.
+
+        Pending mutations are sent before reading the cart unless `optimistic`
+        is set. Optimistic read applies them to the result instead, items
+        added that way only have `product_id` and `quantity` set. With
+        `complete_items` all pending mutations are sent if there are
+        additions among them, so only removals are applied optimistically.
+        """
+        cart = self.__acquire_cart(cart_id)
+        try:
+            if not optimistic or (complete_items and cart.additions):
+                self.__send_pending(cart_id, cart)
+            cart_items, total_price = self.__moltin.get_cart_and_full_price(cart_id)
+            if optimistic and not cart.is_empty():
+                return self.__apply_pending(cart, cart_items, total_price)
+            return cart_items, total_price
+        finally:
+            self.__release_cart(cart_id, cart)
+
+    @staticmethod
+    def __apply_pending(cart, cart_items, total_price):
+        if cart.discarded:
+            cart_items, total_price = [], 0
+        pending_quantities = {}
+        for (product_id, _), addition in cart.additions.items():
+            pending_quantities[product_id] = (
+                pending_quantities.get(product_id, 0) + addition.quantity
+            )
+            if addition.unit_price is not None:
+                total_price = total_price + addition.unit_price * addition.quantity
+
+        updated_items = []
+        for item in cart_items:
+            if item.id in cart.removals:
+                total_price = total_price - item.amount
+                continue
+            if quantity := pending_quantities.pop(item.product_id, None):
+                item = item.replace(quantity=item.quantity + quantity)
+            updated_items.append(item)
+
+        for product_id, quantity in pending_quantities.items():
+            updated_items.append(CartItem(product_id=product_id, quantity=quantity))
+
+        return updated_items, total_price
+
+    def flush_cart(self, cart_id):
+        cart = self.__acquire_cart(cart_id)
+        try:
+            cart.additions, cart.removals, cart.discarded = {}, [], False
+            self.__moltin.flush_cart(cart_id)
+        finally:
+            self.__release_cart(cart_id, cart)
+
+    def discard_cart(self, cart_id):
+        """Queue cart flush, optimistic reads show the cart empty right away"""
+        if not self.__window:
+            return self.__moltin.flush_cart(cart_id)
+
+        cart = self.__acquire_cart(cart_id)
+        try:
+            cart.additions, cart.removals, cart.discarded = {}, [], True
+            self.__schedule_flush(cart_id, cart)
+        finally:
+            self.__release_cart(cart_id, cart)
+
+    def checkout(self, cart_id, customer_id):
+        self.flush(cart_id)
+        self.__moltin.checkout(cart_id, customer_id)
@@ -0,0 +1,290 @@
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+from types import MappingProxyType
+from typing import Mapping, NamedTuple, Tuple
+
+import models
+from moltin_api import SimpleMoltinApiClient
+from prices import PriceTable
+
+
+logger = logging.getLogger("pizza_bot")
+
+CATALOG_RESOURCES = {
+    "products": ("/v2/products", {"include": "main_image"}),
+    "restaurants": ("/v2/flows/restaurant/entries", None),
+    "currencies": ("/v2/currencies", None),
+}
+# Largest page Moltin serves
+PAGE_LIMIT = 100
+
+
+class CatalogSnapshot(NamedTuple):
+    """Immutable view of the catalog at some point in time"""
+
+    version: str
+    # Product name to product id, same as `get_products` returns
+    products: Mapping[str, str]
+    # Product id to tuple of `Product` and image link
+    product_cards: Mapping[str, tuple]
+    restaurants: Tuple[models.Restaurant, ...]
+    prices: PriceTable
+
+
+def merge_pages(pages):
+    """Join pages of a Moltin collection into a single response"""
+    return {
+        "data": [item for page in pages for item in page["data"]],
+        "included": {
+            "main_images": [
+                image
+                for page in pages
+                for image in page.get("included", {}).get("main_images", [])
+            ]
+        },
+    }
+
+
+def build_snapshot(
+    version, products_info, restaurants_info, currencies_info, currencies=("RUB",)
+):
+    return CatalogSnapshot(
+        version=version,
+        products=MappingProxyType(
+            {product["name"]: product["id"] for product in products_info["data"]}
+        ),
+        product_cards=MappingProxyType(
+            SimpleMoltinApiClient.get_product_cards(products_info)
+        ),
+        restaurants=tuple(map(models.Restaurant.from_api, restaurants_info["data"])),
+        prices=PriceTable.from_api(products_info, currencies_info, currencies),
+    )
+
+
+SNAPSHOT_FILE_MAGIC = b"PZCATLG\x00"
+SNAPSHOT_FILE_FORMAT = 2
+# magic, format version, payload length, payload crc32
+SNAPSHOT_FILE_HEADER = struct.Struct("<8sHII")
+
+
+def save_snapshot_file(path, catalog_state):
+    """Atomically write catalog state to a compressed binary file"""
+    payload = zlib.compress(
+        json.dumps(catalog_state, ensure_ascii=False, separators=(",", ":")).encode()
+    )
+    header = SNAPSHOT_FILE_HEADER.pack(
+        SNAPSHOT_FILE_MAGIC, SNAPSHOT_FILE_FORMAT, len(payload), zlib.crc32(payload)
+    )
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as file:
+        file.write(header)
+        file.write(payload)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+
+
+def load_snapshot_file(path):
+    """Read catalog state saved with `save_snapshot_file`.
+
+    Returns:
+        dict|None: catalog state or None if file is missing, corrupted or
+            written in another format
+    """
+    try:
+        with open(path, "rb") as file, mmap.mmap(
+            file.fileno(), 0, access=mmap.ACCESS_READ
+        ) as mapped_file:
+            if len(mapped_file) < SNAPSHOT_FILE_HEADER.size:
+                return None
+            magic, file_format, length, crc = SNAPSHOT_FILE_HEADER.unpack_from(
+                mapped_file
+            )
+            if magic != SNAPSHOT_FILE_MAGIC or file_format != SNAPSHOT_FILE_FORMAT:
+                return None
+            payload = mapped_file[
+                SNAPSHOT_FILE_HEADER.size : SNAPSHOT_FILE_HEADER.size + length
+            ]
+    except (OSError, ValueError):
+        return None
+
+    if len(payload) != length or zlib.crc32(payload) != crc:
+        return None
+    return models.loads(zlib.decompress(payload))
+
+
+def get_content_hash(info):
+    return hashlib.sha1(
+        json.dumps(info, sort_keys=True, ensure_ascii=False).encode()
+    ).hexdigest()
+
+
+class CatalogRefresher:
+    """Keep catalog snapshot up to date in background.
+
+    Every page of the resources is revalidated with conditional requests
+    every `interval` seconds, responses without validators are compared by
+    content hash. Readers get the latest `snapshot` right away, it is
+    replaced as a whole once anything changes. Revalidation results are
+    kept only once the new snapshot is built, so a refresh that failed
+    halfway is repeated in full next time.
+
+    Snapshot carries product prices in each of `currencies`, the first one
+    is shown to users unless their language is mapped to another.
+
+    If `snapshot_path` is given, catalog is saved there on every change and
+    loaded from there on start, so it is available before the first request
+    to Moltin completes.
+
+    Listeners added with `add_listener` are called in the refreshing thread
+    every time the snapshot is replaced.
+    """
+
+    def __init__(
+        self,
+        moltin_client: SimpleMoltinApiClient,
+        interval=60,
+        snapshot_path=None,
+        currencies=("RUB",),
+    ):
+        self.__moltin = moltin_client
+        self.__interval = interval
+        self.__snapshot_path = snapshot_path
+        self.__currencies = tuple(currencies)
+        # Pages and their validators by resource name
+        self.__validators = {}
+        self.__pages = {}
+        self.__hashes = {}
+        self.__listeners = []
+        self.__stopped = threading.Event()
+        self.snapshot = None
+
+    def add_listener(self, callback):
+        """Call `callback` with no arguments after every snapshot change"""
+        self.__listeners.append(callback)
+
+    def __notify(self):
+        for callback in self.__listeners:
+            try:
+                callback()
+            except Exception:
+                logger.exception("Catalog listener failed")
+
+    def refresh(self):
+        """Revalidate catalog resources.
+
+        Returns:
+            bool: whether snapshot got replaced
+        """
+        pages, validators, hashes = {}, {}, {}
+        for name, (path, params) in CATALOG_RESOURCES.items():
+            pages[name], validators[name] = self.__fetch_pages(name, path, params)
+            hashes[name] = get_content_hash(pages[name])
+
+        changed = hashes != self.__hashes
+        if changed:
+            self.__update_snapshot(pages, hashes)
+        self.__pages, self.__validators, self.__hashes = pages, validators, hashes
+        if changed and self.__snapshot_path:
+            self.__save()
+        if changed:
+            self.__notify()
+        return changed
+
+    def __fetch_pages(self, name, path, params):
+        """Get every page of a resource, reusing the ones not modified"""
+        known_pages = self.__pages.get(name, [])
+        known_validators = self.__validators.get(name, [])
+        pages, validators = [], []
+        while True:
+            number = len(pages)
+            page_params = {
+                **(params if params else {}),
+                "page[limit]": PAGE_LIMIT,
+                "page[offset]": sum(len(page["data"]) for page in pages),
+            }
+            page, page_validators = self.__moltin.get_if_modified(
+                path,
+                params=page_params,
+                validators=(
+                    known_validators[number] if number < len(known_validators) else None
+                ),
+            )
+            if page is None:
+                page = known_pages[number]
+            pages.append(page)
+            validators.append(page_validators)
+            if not page["data"] or not page.get("links", {}).get("next"):
+                return pages, validators
+
+    def __update_snapshot(self, pages, hashes):
+        version = get_content_hash(hashes)[:12]
+        self.snapshot = build_snapshot(
+            version,
+            merge_pages(pages["products"]),
+            merge_pages(pages["restaurants"]),
+            merge_pages(pages["currencies"]),
+            self.__currencies,
+        )
+        logger.debug(f"Catalog snapshot updated to version {version}")
+
+    def __save(self):
+        try:
+            save_snapshot_file(
+                self.__snapshot_path,
+                {
+                    "pages": self.__pages,
+                    "validators": self.__validators,
+                    "hashes": self.__hashes,
+                },
+            )
+        except OSError:
+            logger.exception("Failed to save catalog snapshot file")
+
+    def __load(self):
+        catalog_state = load_snapshot_file(self.__snapshot_path)
+        if not catalog_state or set(catalog_state["pages"]) != set(CATALOG_RESOURCES):
+            return False
+        self.__update_snapshot(catalog_state["pages"], catalog_state["hashes"])
+        self.__pages = catalog_state["pages"]
+        self.__validators = catalog_state["validators"]
+        self.__hashes = catalog_state["hashes"]
+        self.__notify()
+        return True
+
+    def __revalidate(self):
+        try:
+            self.refresh()
+        except Exception:
+            logger.exception("Failed to refresh catalog, keeping last snapshot")
+
+    def __run(self, revalidate_at_once):
+        if revalidate_at_once:
+            self.__revalidate()
+        while not self.__stopped.wait(self.__interval):
+            self.__revalidate()
+
+    def start(self):
+        """Load initial snapshot and start refreshing in background.
+
+        Initial snapshot is taken from the snapshot file if there is one,
+        otherwise it is requested from Moltin right away.
+        """
+        loaded_from_file = self.__snapshot_path and self.__load()
+        if not loaded_from_file:
+            self.__revalidate()
+        threading.Thread(
+            target=self.__run,
+            args=(loaded_from_file,),
+            name="catalog",
+            daemon=True,
+        ).start()
+
+    def stop(self):
+        self.__stopped.set()
@@ -0,0 +1,259 @@
+import threading
+import time
+from concurrent.futures import Future
+
+import metrics
+
+
+class TtlCache:
+    """Thread safe cache of loaded values expiring after given time.
+
+    Concurrent lookups of a missing key share a single load. Once there are
+    more than `max_entries` entries, expired ones are evicted and then the
+    oldest ones.
+    """
+
+    def __init__(self, name, max_entries=10000):
+        self.__name = name
+        self.__max_entries = max_entries
+        self.__entries = {}
+        self.__loading = {}
+        self.__lock = threading.Lock()
+
+    def get_or_load(self, key, ttl, loader):
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                metrics.record_cache_lookup(self.__name, hit=True)
+                return entry[1]
+            future = self.__loading.get(key)
+            is_loader = future is None
+            if is_loader:
+                future = self.__loading[key] = Future()
+        metrics.record_cache_lookup(self.__name, hit=False)
+
+        if not is_loader:
+            return future.result()
+
+        try:
+            value = loader()
+        except Exception as error:
+            with self.__lock:
+                if self.__loading.get(key) is future:
+                    del self.__loading[key]
+            future.set_exception(error)
+            raise
+
+        with self.__lock:
+            # Key might be invalidated while loading, value is outdated then
+            if self.__loading.get(key) is future:
+                del self.__loading[key]
+                self.__store(key, ttl, value)
+        future.set_result(value)
+        return value
+
+    def __store(self, key, ttl, value):
+        self.__entries.pop(key, None)
+        self.__entries[key] = (time.monotonic() + ttl, value)
+        if len(self.__entries) > self.__max_entries:
+            self.__evict()
+
+    def __evict(self):
+        now = time.monotonic()
+        for key, (expires_at, _) in list(self.__entries.items()):
+            if expires_at <= now:
+                del self.__entries[key]
+        while len(self.__entries) > self.__max_entries:
+            del self.__entries[next(iter(self.__entries))]
+
+    def get(self, key):
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                metrics.record_cache_lookup(self.__name, hit=True)
+                return entry[1]
+        metrics.record_cache_lookup(self.__name, hit=False)
+        return None
+
+    def put(self, key, ttl, value):
+        with self.__lock:
+            self.__store(key, ttl, value)
+
+    def invalidate(self, key):
+        with self.__lock:
+            self.__entries.pop(key, None)
+            self.__loading.pop(key, None)
+
+
+class CachingMoltinClient:
+    """Moltin client wrapper caching catalog and cart reads.
+
+    If `catalog` refresher is given, products and restaurants are served from
+    its latest snapshot, falling back to the cache for anything missing there.
+    Cached carts are invalidated by cart mutations made through this wrapper.
+    If `redis_connection` is given, customer ids are cached there by email.
+    Every other method is passed to the wrapped client as is.
+    """
+
+    def __init__(
+        self,
+        moltin_client,
+        catalog=None,
+        redis_connection=None,
+        catalog_ttl=300,
+        image_ttl=3600,
+        cart_ttl=10,
+    ):
+        self.__moltin = moltin_client
+        self.__catalog = catalog
+        self.__redis = redis_connection
+        self.__catalog_ttl = catalog_ttl
+        self.__image_ttl = image_ttl
+        self.__cart_ttl = cart_ttl
+        self.__product_names = TtlCache("product_names")
+        self.__products = TtlCache("products")
+        self.__images = TtlCache("images")
+        self.__product_cards = TtlCache("product_cards")
+        self.__flow_entries = TtlCache("flow_entries")
+        self.__restaurants = TtlCache("restaurants")
+        self.__carts = TtlCache("carts")
+
+    def __getattr__(self, name):
+        return getattr(self.__moltin, name)
+
+    def __get_snapshot(self):
+        return self.__catalog.snapshot if self.__catalog else None
+
+    def get_price_table(self):
+        """Get price table of the latest catalog snapshot.
+
+        Returns:
+            PriceTable|None: None until the catalog is loaded or without it
+        """
+        snapshot = self.__get_snapshot()
+        return snapshot.prices if snapshot else None
+
+    def get_products(self):
+        if snapshot := self.__get_snapshot():
+            return snapshot.products
+        return self.__product_names.get_or_load(
+            None, self.__catalog_ttl, self.__moltin.get_products
+        )
+
+    def get_product_by_id(self, id):
+        return self.__products.get_or_load(
+            id, self.__catalog_ttl, lambda: self.__moltin.get_product_by_id(id)
+        )
+
+    def get_image_url_by_file_id(self, id):
+        return self.__images.get_or_load(
+            id, self.__image_ttl, lambda: self.__moltin.get_image_url_by_file_id(id)
+        )
+
+    def get_product_with_image(self, id):
+        if (snapshot := self.__get_snapshot()) and id in snapshot.product_cards:
+            return snapshot.product_cards[id]
+        return self.__product_cards.get_or_load(
+            id, self.__catalog_ttl, lambda: self.__moltin.get_product_with_image(id)
+        )
+
+    def get_products_with_images(self, ids):
+        snapshot = self.__get_snapshot()
+        snapshot_cards = snapshot.product_cards if snapshot else {}
+        product_cards = {}
+        missing_ids = []
+        for id in ids:
+            if id in snapshot_cards:
+                product_cards[id] = snapshot_cards[id]
+            elif (product_card := self.__product_cards.get(id)) is not None:
+                product_cards[id] = product_card
+            else:
+                missing_ids.append(id)
+
+        if missing_ids:
+            fetched_cards = self.__moltin.get_products_with_images(missing_ids)
+            for id, product_card in fetched_cards.items():
+                self.__product_cards.put(id, self.__catalog_ttl, product_card)
+            product_cards.update(fetched_cards)
+
+        return product_cards
+
+    def get_flow_entries(self, flow_slug):
+        return self.__flow_entries.get_or_load(
+            flow_slug,
+            self.__catalog_ttl,
+            lambda: self.__moltin.get_flow_entries(flow_slug),
+        )
+
+    def get_restaurants(self):
+        if snapshot := self.__get_snapshot():
+            return snapshot.restaurants
+        return self.__restaurants.get_or_load(
+            None, self.__catalog_ttl, self.__moltin.get_restaurants
+        )
+
+    def get_cart_and_full_price(self, cart_id):
+        return self.__carts.get_or_load(
+            cart_id,
+            self.__cart_ttl,
+            lambda: self.__moltin.get_cart_and_full_price(cart_id),
+        )
+
+    def __get_cached_customer_id(self, key):
+        with metrics.track_upstream("redis", "get"):
+            customer_id = self.__redis.get(key)
+        metrics.record_cache_lookup("customers", hit=customer_id is not None)
+        return customer_id.decode() if customer_id is not None else None
+
+    def get_or_create_customer_by_email(self, email):
+        """Get id of customer with given email, creating one if there is none.
+
+        Concurrent calls for the same email, in any process sharing the Redis,
+        wait for the first one instead of creating duplicate customers.
+        """
+        if not self.__redis:
+            return self.__moltin.get_or_create_customer_by_email(email)
+
+        key = f"customer-email:{email}"
+        if customer_id := self.__get_cached_customer_id(key):
+            return customer_id
+
+        with self.__redis.lock(f"{key}:lock", timeout=30, blocking_timeout=30):
+            if customer_id := self.__get_cached_customer_id(key):
+                return customer_id
+            customer_id = self.__moltin.get_or_create_customer_by_email(email)
+            with metrics.track_upstream("redis", "set"):
+                self.__redis.set(key, customer_id)
+        return customer_id
+
+    def add_product_to_cart(self, cart_id, product_id, quantity, currency=None):
+        try:
+            self.__moltin.add_product_to_cart(
+                cart_id, product_id, quantity, currency=currency
+            )
+        finally:
+            self.__carts.invalidate(cart_id)
+
+    def add_products_to_cart(self, cart_id, quantities, currency=None):
+        try:
+            self.__moltin.add_products_to_cart(cart_id, quantities, currency=currency)
+        finally:
+            self.__carts.invalidate(cart_id)
+
+    def remove_product_from_cart(self, cart_id, item_id):
+        try:
+            self.__moltin.remove_product_from_cart(cart_id, item_id)
+        finally:
+            self.__carts.invalidate(cart_id)
+
+    def flush_cart(self, cart_id):
+        try:
+            self.__moltin.flush_cart(cart_id)
+        finally:
+            self.__carts.invalidate(cart_id)
+
+    def checkout(self, cart_id, customer_id):
+        try:
+            self.__moltin.checkout(cart_id, customer_id)
+        finally:
+            self.__carts.invalidate(cart_id)
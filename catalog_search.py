@@ -0,0 +1,184 @@
+import heapq
+import re
+import threading
+from collections import defaultdict
+
+from telegram import InlineQueryResultArticle, InputTextMessageContent, Update
+from telegram.ext import CallbackContext
+
+from catalog import CatalogRefresher
+
+
+MAX_INLINE_RESULTS = 50
+
+
+def normalize(text):
+    return text.lower().replace("ё", "е")
+
+
+def get_trigrams(text):
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+class _FieldIndex:
+    """Word prefix and trigram postings of a single text field"""
+
+    def __init__(self):
+        self.__texts = {}
+        self.__prefixes = defaultdict(set)
+        self.__trigrams = defaultdict(set)
+
+    def add(self, id, text):
+        self.__texts[id] = text
+        for word in set(re.findall(r"\w+", text)):
+            for length in range(1, len(word) + 1):
+                self.__prefixes[word[:length]].add(id)
+        for trigram in get_trigrams(text):
+            self.__trigrams[trigram].add(id)
+
+    def remove(self, id):
+        if (text := self.__texts.pop(id, None)) is None:
+            return
+        for word in set(re.findall(r"\w+", text)):
+            for length in range(1, len(word) + 1):
+                self.__discard(self.__prefixes, word[:length], id)
+        for trigram in get_trigrams(text):
+            self.__discard(self.__trigrams, trigram, id)
+
+    @staticmethod
+    def __discard(postings, key, id):
+        ids = postings[key]
+        ids.discard(id)
+        if not ids:
+            del postings[key]
+
+    def find(self, term):
+        ids = self.__prefixes.get(term, set())
+        if len(term) < 3:
+            return ids
+        candidates = None
+        for trigram in get_trigrams(term):
+            trigram_ids = self.__trigrams.get(trigram, set())
+            candidates = trigram_ids if candidates is None else candidates & trigram_ids
+            if not candidates:
+                return ids
+        return ids | {id for id in candidates - ids if term in self.__texts[id]}
+
+
+class CatalogIndex:
+    """Prefix and trigram index of product names and descriptions.
+
+    Query terms match word prefixes, terms of three and more characters
+    also match anywhere in the text. Products matching all terms are
+    returned ordered by name, the ones with every term in the name first.
+    """
+
+    def __init__(self):
+        self.__product_cards = {}
+        self.__names = _FieldIndex()
+        self.__texts = _FieldIndex()
+        self.__sorted_ids = []
+        self.__positions = {}
+
+    def update(self, product_cards):
+        """Reindex products added, changed or removed since the last update"""
+        for id in self.__product_cards.keys() - product_cards.keys():
+            self.__names.remove(id)
+            self.__texts.remove(id)
+        names = {}
+        for id, product_card in product_cards.items():
+            product, _ = product_card
+            names[id] = name = normalize(product.name)
+            if self.__product_cards.get(id) == product_card:
+                continue
+            self.__names.remove(id)
+            self.__texts.remove(id)
+            self.__names.add(id, name)
+            self.__texts.add(id, f"{name}\n{normalize(product.description)}")
+        self.__product_cards = dict(product_cards)
+        self.__sorted_ids = sorted(names, key=names.__getitem__)
+        self.__positions = {
+            id: position for position, id in enumerate(self.__sorted_ids)
+        }
+
+    def search(self, query, limit=MAX_INLINE_RESULTS):
+        """Get product cards matching the query.
+
+        Returns:
+            list: tuples of `Product` and image link, empty query matches all
+        """
+        terms = re.findall(r"\w+", normalize(query))
+        if not terms:
+            return [self.__product_cards[id] for id in self.__sorted_ids[:limit]]
+
+        ids = set.intersection(*(self.__texts.find(term) for term in terms))
+        name_ids = set.intersection(*(self.__names.find(term) for term in terms))
+        found_ids = heapq.nsmallest(limit, name_ids, key=self.__positions.__getitem__)
+        if len(found_ids) < limit:
+            found_ids += heapq.nsmallest(
+                limit - len(found_ids),
+                ids - name_ids,
+                key=self.__positions.__getitem__,
+            )
+        return [self.__product_cards[id] for id in found_ids]
+
+
+class CatalogSearch:
+    """Inline mode search over the latest catalog snapshot.
+
+    Index is built once the search is created and brought up to date by
+    the catalog refresher whenever the catalog changes, so queries neither
+    wait for indexing nor reach Moltin.
+    """
+
+    def __init__(self, catalog: CatalogRefresher):
+        self.__catalog = catalog
+        self.__index = CatalogIndex()
+        self.__version = None
+        self.__lock = threading.Lock()
+        catalog.add_listener(self.update_index)
+        self.update_index()
+
+    def update_index(self):
+        """Reindex products changed in the latest catalog snapshot"""
+        with self.__lock:
+            snapshot = self.__catalog.snapshot
+            if snapshot and snapshot.version != self.__version:
+                self.__index.update(snapshot.product_cards)
+                self.__version = snapshot.version
+
+    def search(self, query, limit=MAX_INLINE_RESULTS):
+        with self.__lock:
+            return self.__index.search(query, limit=limit)
+
+    def answer_inline_query(self, update: Update, context: CallbackContext):
+        results = [
+            InlineQueryResultArticle(
+                id=product.id,
+                title=product.name,
+                description=f"{self.__format_price(product, update, context)}\n"
+                f"{product.description}",
+                thumb_url=image_url,
+                # Sent on user behalf, MenuState opens the product on it
+                input_message_content=InputTextMessageContent(product.name),
+            )
+            for product, image_url in self.search(update.inline_query.query)
+        ]
+        # Prices differ between users once currencies are picked by language
+        update.inline_query.answer(
+            results,
+            cache_time=60,
+            is_personal=bool(context.bot_data.get("currency_by_language")),
+        )
+
+    def __format_price(self, product, update, context):
+        snapshot = self.__catalog.snapshot
+        if snapshot:
+            prices = snapshot.prices
+            currency = prices.select_currency(
+                update.inline_query.from_user.language_code,
+                context.bot_data.get("currency_by_language"),
+            )
+            if (price := prices.get_price(product.id, currency)) is not None:
+                return prices.format(price, currency)
+        return f"{product.price} {product.currency}"
@@ -0,0 +1,201 @@
+import json
+import logging
+import threading
+import time
+
+from telegram.constants import PARSEMODE_HTML
+
+
+logger = logging.getLogger("pizza_bot")
+
+
+def plan_route(start, stops):
+    """Order stops by nearest neighbour, starting from `start`.
+
+    Args:
+        start (dict): `lon` and `lat` of the starting point
+        stops (list): dicts with `lon` and `lat`
+
+    Returns:
+        list: tuples of stop and distance from the previous point in km
+    """
+    route = []
+    point = start
+    remaining = list(stops)
+    while remaining:
+        legs = [get_distance(point, stop) for stop in remaining]
+        index = legs.index(min(legs))
+        point = remaining.pop(index)
+        route.append((point, legs[index]))
+    return route
+
+
+def get_distance(point, other_point):
+    from geopy import distance
+
+    # Great circle is accurate enough to compare city distances and is many
+    # times faster than geodesic
+    return distance.great_circle(
+        (point["lat"], point["lon"]), (other_point["lat"], other_point["lon"])
+    ).km
+
+
+def get_route_url(start, stops):
+    points = "~".join(f"{point['lat']},{point['lon']}" for point in [start, *stops])
+    return f"https://yandex.ru/maps/?rtext={points}&rtt=auto"
+
+
+class CourierDispatcher:
+    """Collect delivery orders per restaurant and send couriers routes.
+
+    Stops are kept in Redis lists until dispatched. Restaurant courier gets
+    one message with the route through all stops once the oldest stop
+    waited `window` seconds or `max_stops` stops are collected, whatever
+    comes first. Stops are removed after the message is sent, so they are
+    dispatched at least once. Route that failed to send is retried after
+    `poll_interval`, doubled with every failure up to `MAX_RETRY_DELAY`.
+    Dispatchers of several bot processes sharing the Redis take a lock of
+    the restaurant, so its routes are sent by one of them at a time.
+    """
+
+    RESTAURANTS_KEY = "dispatch:restaurants"
+    STOPS_KEY = "dispatch:stops:{}"
+    LOCK_KEY = "dispatch:lock:{}"
+    # Seconds the lock is held at most, in case its holder dies
+    LOCK_TIMEOUT = 60
+    # Seconds to wait at most before retrying a route that failed to send
+    MAX_RETRY_DELAY = 30
+
+    def __init__(
+        self,
+        redis_connection,
+        bot,
+        jinja_env,
+        window=120,
+        max_stops=5,
+        poll_interval=1.0,
+    ):
+        self.__redis = redis_connection
+        self.__bot = bot
+        self.__jinja = jinja_env
+        self.__window = window
+        self.__max_stops = max_stops
+        self.__poll_interval = poll_interval
+        self.__retry_at = {}
+        self.__failures = {}
+        self.__stopped = threading.Event()
+        self.__thread = None
+
+    def add(self, order, now=None):
+        """Put delivery order in the next route of its restaurant courier.
+
+        Args:
+            order (dict): fulfillment order with `restaurant_id` and
+                `restaurant_coords`
+        """
+        stop = {
+            "order_id": order["order_id"],
+            "chat_id": order["chat_id"],
+            "lon": order["customer_coords"]["lon"],
+            "lat": order["customer_coords"]["lat"],
+            "cart_items": order["cart_items"],
+            "restaurant_address": order["restaurant_address"],
+            "restaurant_coords": order["restaurant_coords"],
+            "courier": order["restaurant_courier"],
+            "added_at": time.time() if now is None else now,
+        }
+        restaurant_id = order["restaurant_id"]
+        pipeline = self.__redis.pipeline()
+        pipeline.rpush(self.STOPS_KEY.format(restaurant_id), json.dumps(stop))
+        pipeline.sadd(self.RESTAURANTS_KEY, restaurant_id)
+        pipeline.execute()
+
+    def start(self):
+        self.__thread = threading.Thread(
+            target=self.__run, name="courier-dispatch", daemon=True
+        )
+        self.__thread.start()
+
+    def stop(self):
+        self.__stopped.set()
+        if self.__thread:
+            self.__thread.join()
+
+    def __run(self):
+        while not self.__stopped.wait(self.__poll_interval):
+            try:
+                self.dispatch()
+            except Exception:
+                logger.exception("Failed to dispatch couriers")
+
+    def dispatch(self, now=None):
+        """Send routes of restaurants with a full batch or a due stop.
+
+        Returns:
+            int: number of routes sent
+        """
+        now = time.time() if now is None else now
+        sent = 0
+        for restaurant_id in self.__redis.smembers(self.RESTAURANTS_KEY):
+            restaurant_id = restaurant_id.decode()
+            if self.__retry_at.get(restaurant_id, 0) > now:
+                continue
+            lock = self.__redis.lock(
+                self.LOCK_KEY.format(restaurant_id), timeout=self.LOCK_TIMEOUT
+            )
+            if not lock.acquire(blocking=False):
+                # Another dispatcher is sending routes of the restaurant
+                continue
+            try:
+                sent += self.__dispatch_restaurant(restaurant_id, now)
+            finally:
+                lock.release()
+        return sent
+
+    def __dispatch_restaurant(self, restaurant_id, now):
+        sent = 0
+        while stops := self.__get_due_stops(restaurant_id, now):
+            try:
+                self.__send_route(stops)
+            except Exception:
+                logger.exception(f"Failed to send route of restaurant({restaurant_id})")
+                failures = self.__failures.get(restaurant_id, 0)
+                self.__failures[restaurant_id] = failures + 1
+                self.__retry_at[restaurant_id] = now + min(
+                    self.__poll_interval * 2**failures, self.MAX_RETRY_DELAY
+                )
+                break
+            self.__retry_at.pop(restaurant_id, None)
+            self.__failures.pop(restaurant_id, None)
+            # Stops added while sending stay in the list
+            self.__redis.ltrim(self.STOPS_KEY.format(restaurant_id), len(stops), -1)
+            sent += 1
+        return sent
+
+    def __get_due_stops(self, restaurant_id, now):
+        stops = [
+            json.loads(stop)
+            for stop in self.__redis.lrange(
+                self.STOPS_KEY.format(restaurant_id), 0, self.__max_stops - 1
+            )
+        ]
+        if len(stops) < self.__max_stops and (
+            not stops or stops[0]["added_at"] + self.__window > now
+        ):
+            return []
+        return stops
+
+    def __send_route(self, stops):
+        start = stops[-1]["restaurant_coords"]
+        route = plan_route(start, stops)
+        message_template = self.__jinja.get_template("courier_route_message.html")
+        self.__bot.send_message(
+            chat_id=stops[-1]["courier"],
+            text=message_template.render(
+                restaurant_address=stops[-1]["restaurant_address"],
+                route=route,
+                route_url=get_route_url(start, [stop for stop, _ in route]),
+            ),
+            parse_mode=PARSEMODE_HTML,
+            disable_web_page_preview=True,
+        )
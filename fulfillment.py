@@ -0,0 +1,290 @@
+import json
+import logging
+import threading
+import time
+import uuid
+
+from redis.exceptions import WatchError
+from telegram.constants import PARSEMODE_HTML
+from telegram.ext import CallbackContext
+
+from template_loader import render_static
+
+
+logger = logging.getLogger("pizza_bot")
+
+ORDER_DEADLINE_SECONDS = 3600
+
+
+def remind_customer(context: CallbackContext):
+    job = context.job
+    context.bot.send_message(
+        chat_id=job.context["chat_id"],
+        text=render_static(job.context["jinja_env"], "customer_reminder_message.html"),
+        parse_mode=PARSEMODE_HTML,
+    )
+
+
+class FulfillmentPipeline:
+    """Durable Redis backed queue of paid orders processed by a worker pool.
+
+    Delivery order goes through `STEPS` in sequence, pick up order needs none
+    of them. Completed steps are saved with the order, so a failed order is
+    retried from the step that failed. After `max_attempts` failed attempts
+    order is moved to the failed list and requeued `requeue_delay` seconds
+    later, the delay doubles with every failure up to `MAX_REQUEUE_DELAY`.
+
+    Every process keeps orders it took in a processing list of its own and
+    renews its lease every `maintenance_interval` seconds. Orders of a
+    process whose lease expired are requeued by the others or by the next
+    process started. Steps are run at least once.
+
+    Reminder is scheduled in the job queue, which lives in memory, so
+    reminders pending when the process stops are lost. Cart is not touched
+    here, it is discarded when the payment arrives.
+    """
+
+    QUEUE_KEY = "fulfillment:queue"
+    PROCESSING_KEY = "fulfillment:processing:{}"
+    LEASES_KEY = "fulfillment:leases"
+    FAILED_KEY = "fulfillment:failed"
+    ORDER_KEY = "fulfillment:order:{}"
+    # Processing list shared by processes of versions without leases
+    LEGACY_PROCESSING_KEY = "fulfillment:processing"
+    # Seconds a process lease lasts unless renewed
+    LEASE_TIMEOUT = 60
+    # Seconds a failed order waits at most before it is retried
+    MAX_REQUEUE_DELAY = 900
+
+    STEPS = (
+        "save_customer_address",
+        "send_order_summary",
+        "send_courier_location",
+        "schedule_reminder",
+    )
+    PICKUP_STEPS = ()
+
+    def __init__(
+        self,
+        redis_connection,
+        moltin_client,
+        bot,
+        job_queue,
+        jinja_env,
+        workers=2,
+        max_attempts=5,
+        retry_delay=1.0,
+        courier_dispatcher=None,
+        requeue_delay=60,
+        maintenance_interval=5.0,
+    ):
+        self.__redis = redis_connection
+        self.__moltin = moltin_client
+        self.__bot = bot
+        self.__job_queue = job_queue
+        self.__jinja = jinja_env
+        self.__workers = workers
+        self.__max_attempts = max_attempts
+        self.__retry_delay = retry_delay
+        self.__courier_dispatcher = courier_dispatcher
+        self.__requeue_delay = requeue_delay
+        self.__maintenance_interval = maintenance_interval
+        self.__consumer = uuid.uuid4().hex
+        self.__processing_key = self.PROCESSING_KEY.format(self.__consumer)
+        self.__stopped = threading.Event()
+
+    def enqueue(self, order):
+        """Save order and put it in the queue.
+
+        Args:
+            order (dict): order with unique `order_id`, `chat_id`,
+                `restaurant_id`, `restaurant_address`, `restaurant_coords`,
+                `restaurant_courier`, `cart_items` and `customer_coords`
+                (None for pick up)
+
+        Returns:
+            bool: False if order with the same id is already queued
+        """
+        order = {**order, "done_steps": []}
+        order_key = self.ORDER_KEY.format(order["order_id"])
+        # Order is saved and queued in one transaction, so it is never saved
+        # without being queued
+        with self.__redis.pipeline() as pipeline:
+            try:
+                pipeline.watch(order_key)
+                if pipeline.exists(order_key):
+                    return False
+                pipeline.multi()
+                pipeline.set(order_key, json.dumps(order))
+                pipeline.lpush(self.QUEUE_KEY, order["order_id"])
+                pipeline.execute()
+            except WatchError:
+                # Same order got saved meanwhile
+                return False
+        return True
+
+    def start(self):
+        """Requeue orders left unfinished and due failed ones, start workers"""
+        while (
+            self.__redis.rpoplpush(self.LEGACY_PROCESSING_KEY, self.QUEUE_KEY)
+            is not None
+        ):
+            pass
+        self.__maintain()
+        threading.Thread(
+            target=self.__run_maintenance, name="fulfillment-maintenance", daemon=True
+        ).start()
+        for number in range(self.__workers):
+            threading.Thread(
+                target=self.__work, name=f"fulfillment-{number}", daemon=True
+            ).start()
+
+    def stop(self):
+        self.__stopped.set()
+
+    def __run_maintenance(self):
+        # Runs apart from workers, so the lease is renewed while they are
+        # busy retrying
+        while not self.__stopped.wait(self.__maintenance_interval):
+            try:
+                self.__maintain()
+            except Exception:
+                logger.exception("Failed to maintain fulfillment queue")
+
+    def __maintain(self):
+        now = time.time()
+        self.__redis.hset(self.LEASES_KEY, self.__consumer, now + self.LEASE_TIMEOUT)
+        self.__requeue_abandoned(now)
+        self.__requeue_failed(now)
+
+    def __requeue_abandoned(self, now):
+        for consumer, expires_at in self.__redis.hgetall(self.LEASES_KEY).items():
+            if float(expires_at) > now:
+                continue
+            consumer = consumer.decode()
+            processing_key = self.PROCESSING_KEY.format(consumer)
+            while self.__redis.rpoplpush(processing_key, self.QUEUE_KEY) is not None:
+                pass
+            self.__redis.hdel(self.LEASES_KEY, consumer)
+            logger.warning(f"Requeued orders of fulfillment process({consumer})")
+
+    def __requeue_failed(self, now):
+        for order_id in self.__redis.lrange(self.FAILED_KEY, 0, -1):
+            order_id = order_id.decode()
+            saved_order = self.__redis.get(self.ORDER_KEY.format(order_id))
+            # Orders failed before retries were scheduled are due right away
+            if saved_order and json.loads(saved_order).get("retry_at", 0) > now:
+                continue
+            # Order is moved in a transaction, so it is queued once even if
+            # several processes requeue it
+            with self.__redis.pipeline() as pipeline:
+                try:
+                    pipeline.watch(self.FAILED_KEY)
+                    if order_id.encode() not in pipeline.lrange(self.FAILED_KEY, 0, -1):
+                        continue
+                    pipeline.multi()
+                    pipeline.lrem(self.FAILED_KEY, 1, order_id)
+                    pipeline.lpush(self.QUEUE_KEY, order_id)
+                    pipeline.execute()
+                except WatchError:
+                    # Failed list changed meanwhile, order is requeued next time
+                    continue
+
+    def __work(self):
+        while not self.__stopped.is_set():
+            order_id = self.__redis.brpoplpush(
+                self.QUEUE_KEY, self.__processing_key, timeout=1
+            )
+            if order_id is None:
+                continue
+            try:
+                self.__process(order_id.decode())
+            except Exception:
+                logger.exception(f"Failed to process order({order_id})")
+
+    def __process(self, order_id):
+        order_key = self.ORDER_KEY.format(order_id)
+        if (saved_order := self.__redis.get(order_key)) is None:
+            self.__redis.lrem(self.__processing_key, 1, order_id)
+            return
+        order = json.loads(saved_order)
+
+        steps = self.STEPS if order["customer_coords"] else self.PICKUP_STEPS
+        for step in steps:
+            if step in order["done_steps"]:
+                continue
+            if not self.__run_step(step, order):
+                self.__fail(order_key, order, step)
+                return
+            order["done_steps"].append(step)
+            self.__redis.set(order_key, json.dumps(order))
+
+        self.__redis.delete(order_key)
+        self.__redis.lrem(self.__processing_key, 1, order_id)
+
+    def __fail(self, order_key, order, step):
+        failures = order.get("failures", 0)
+        delay = min(self.__requeue_delay * 2**failures, self.MAX_REQUEUE_DELAY)
+        order["failures"] = failures + 1
+        order["retry_at"] = time.time() + delay
+        logger.error(
+            f"Order({order['order_id']}) is stuck at {step}, retrying in {delay} s"
+        )
+        pipeline = self.__redis.pipeline()
+        pipeline.set(order_key, json.dumps(order))
+        pipeline.lpush(self.FAILED_KEY, order["order_id"])
+        pipeline.lrem(self.__processing_key, 1, order["order_id"])
+        pipeline.execute()
+
+    def __run_step(self, step, order):
+        for attempt in range(1, self.__max_attempts + 1):
+            try:
+                getattr(self, f"_FulfillmentPipeline__{step}")(order)
+                return True
+            except Exception:
+                logger.warning(
+                    f"Order({order['order_id']}) {step} attempt {attempt} failed",
+                    exc_info=True,
+                )
+                if self.__stopped.wait(self.__retry_delay * 2 ** (attempt - 1)):
+                    return False
+        return False
+
+    def __save_customer_address(self, order):
+        self.__moltin.create_flow_entry(
+            "customer-address",
+            telegram_id=order["chat_id"],
+            lon=order["customer_coords"]["lon"],
+            lat=order["customer_coords"]["lat"],
+        )
+
+    def __send_order_summary(self, order):
+        message_template = self.__jinja.get_template(
+            "courier_notification_message.html"
+        )
+        self.__bot.send_message(
+            chat_id=order["chat_id"],
+            text=message_template.render(
+                cart_items=order["cart_items"],
+                restaurant_address=order["restaurant_address"],
+            ),
+            parse_mode=PARSEMODE_HTML,
+        )
+
+    def __send_courier_location(self, order):
+        # Orders queued before dispatching was introduced lack restaurant id
+        if self.__courier_dispatcher and "restaurant_id" in order:
+            self.__courier_dispatcher.add(order)
+            return
+        self.__bot.send_location(
+            chat_id=order["restaurant_courier"],
+            longitude=order["customer_coords"]["lon"],
+            latitude=order["customer_coords"]["lat"],
+        )
+
+    def __schedule_reminder(self, order):
+        self.__job_queue.run_once(
+            remind_customer,
+            ORDER_DEADLINE_SECONDS,
+            context={"chat_id": order["chat_id"], "jinja_env": self.__jinja},
+        )
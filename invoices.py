@@ -0,0 +1,107 @@
+import hashlib
+import json
+import logging
+import queue
+
+from telegram import Update
+from telegram.ext import CallbackContext, DispatcherHandlerStop
+
+import metrics
+from catalog_cache import TtlCache
+
+
+logger = logging.getLogger("pizza_bot")
+
+
+def get_cart_hash(cart_items):
+    cart_contents = sorted(
+        (item.product_id, item.quantity, item.amount) for item in cart_items
+    )
+    return hashlib.sha1(json.dumps(cart_contents).encode()).hexdigest()
+
+
+class PreCheckoutFirstQueue(queue.Queue):
+    """Update queue putting pre-checkout queries ahead of other updates.
+
+    Telegram cancels payment unless pre-checkout query is answered within
+    10 seconds, so it should not wait for a backlog of other updates.
+    """
+
+    def _put(self, update):
+        if isinstance(update, Update) and update.pre_checkout_query:
+            self.queue.appendleft(update)
+        else:
+            self.queue.append(update)
+
+
+class InvoiceRegistry:
+    """Snapshots of the invoices sent to users.
+
+    Snapshot is kept in memory and in Redis, so pre-checkout query is
+    validated without loading user state, with a single Redis GET at most.
+    """
+
+    KEY = "invoice:{}"
+
+    def __init__(self, redis_connection, ttl=86400):
+        self.__redis = redis_connection
+        self.__ttl = ttl
+        self.__invoices = TtlCache("invoices")
+
+    def register(self, chat_id, currency, total_amount, cart_hash):
+        """Save snapshot of the invoice about to be sent.
+
+        Args:
+            chat_id (int): id of user chat
+            currency (str): three-letter ISO 4217 currency code
+            total_amount (int): invoice total in the smallest currency units
+            cart_hash (str): hash of cart contents, see `get_cart_hash`
+
+        Returns:
+            str: payload to send invoice with
+        """
+        invoice = {
+            "payload": f"{chat_id}:{cart_hash}",
+            "currency": currency.upper(),
+            "total_amount": total_amount,
+        }
+        with metrics.track_upstream("redis", "set"):
+            self.__redis.set(
+                self.KEY.format(chat_id), json.dumps(invoice), ex=self.__ttl
+            )
+        self.__invoices.put(chat_id, self.__ttl, invoice)
+        return invoice["payload"]
+
+    def get(self, chat_id):
+        if (invoice := self.__invoices.get(chat_id)) is not None:
+            return invoice
+        with metrics.track_upstream("redis", "get"):
+            saved_invoice = self.__redis.get(self.KEY.format(chat_id))
+        if saved_invoice is None:
+            return None
+        invoice = json.loads(saved_invoice)
+        self.__invoices.put(chat_id, self.__ttl, invoice)
+        return invoice
+
+    def answer_pre_checkout(self, update: Update, context: CallbackContext):
+        """Answer pre-checkout query.
+
+        Accepted query is not passed to other handlers. Rejected one is, so
+        that user state is updated accordingly.
+        """
+        query = update.pre_checkout_query
+        invoice = self.get(query.from_user.id)
+        if invoice is None or invoice != {
+            "payload": query.invoice_payload,
+            "currency": query.currency,
+            "total_amount": query.total_amount,
+        }:
+            logger.warning(f"Rejected pre-checkout query of user({query.from_user.id})")
+            query.answer(ok=False, error_message="Что-то пошло не так...")
+            return
+
+        query.answer(ok=True)
+        context.bot.send_message(
+            chat_id=query.from_user.id, text="Обрабатываем Ваш платеж..."
+        )
+        raise DispatcherHandlerStop
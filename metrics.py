@@ -0,0 +1,156 @@
+import functools
+import re
+import time
+from urllib.parse import urlsplit
+
+import requests
+from telegram.utils.request import Request
+
+import tracing
+
+
+# Created by `enable`, so prometheus_client is not imported unless needed
+STATE_STAGE_SECONDS = None
+UPSTREAM_CALL_SECONDS = None
+UPSTREAM_CALLS_IN_FLIGHT = None
+CACHE_LOOKUPS = None
+
+_enabled = False
+
+
+def enable(port, addr="127.0.0.1"):
+    """Start metrics endpoint and turn instrumentation on.
+    Until called tracking helpers only record tracing spans, if any."""
+    global _enabled, STATE_STAGE_SECONDS, UPSTREAM_CALL_SECONDS
+    global UPSTREAM_CALLS_IN_FLIGHT, CACHE_LOOKUPS
+    from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+    STATE_STAGE_SECONDS = Histogram(
+        "pizza_bot_state_stage_seconds",
+        "Time spent in state handlers",
+        ["state", "stage"],
+    )
+    UPSTREAM_CALL_SECONDS = Histogram(
+        "pizza_bot_upstream_call_seconds",
+        "Time spent in calls to external services",
+        ["service", "operation"],
+    )
+    UPSTREAM_CALLS_IN_FLIGHT = Gauge(
+        "pizza_bot_upstream_calls_in_flight",
+        "Calls to external services in progress",
+        ["service"],
+    )
+    CACHE_LOOKUPS = Counter(
+        "pizza_bot_cache_lookups_total",
+        "Cache lookups by result",
+        ["cache", "result"],
+    )
+    start_http_server(port, addr=addr)
+    _enabled = True
+
+
+def is_enabled():
+    return _enabled
+
+
+class _Timer:
+    def __init__(self, span, histogram, in_flight=None):
+        self.__span = span
+        self.__histogram = histogram
+        self.__in_flight = in_flight
+
+    def __enter__(self):
+        if self.__in_flight:
+            self.__in_flight.inc()
+        self.__span.__enter__()
+        self.__started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.__histogram.observe(time.perf_counter() - self.__started_at)
+        self.__span.__exit__(exc_type, exc_value, traceback)
+        if self.__in_flight:
+            self.__in_flight.dec()
+
+
+def track_state(state, stage):
+    """Time `stage` (handle_input, clean_up, prepare_state) of given state instance"""
+    state_name = type(state).__name__
+    span = tracing.span(f"{state_name}.{stage}")
+    if not _enabled:
+        return span
+    return _Timer(span, STATE_STAGE_SECONDS.labels(state_name, stage))
+
+
+def track_upstream(service, operation):
+    """Time a call to an external service"""
+    span = tracing.span(f"{service}.{operation}")
+    if not _enabled:
+        return span
+    return _Timer(
+        span,
+        UPSTREAM_CALL_SECONDS.labels(service, operation),
+        UPSTREAM_CALLS_IN_FLIGHT.labels(service),
+    )
+
+
+def timed_upstream(service):
+    """Decorate function to time its calls as `service` operation"""
+
+    def decorator(func):
+        operation = func.__name__.lstrip("_")
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with track_upstream(service, operation):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def record_cache_lookup(cache, hit):
+    if _enabled:
+        CACHE_LOOKUPS.labels(cache, "hit" if hit else "miss").inc()
+
+
+class InstrumentedRequest(Request):
+    """Telegram request object timing every Bot API call"""
+
+    def post(self, url, data, timeout=None):
+        with track_upstream("telegram", url.rsplit("/", 1)[-1]):
+            return super().post(url, data, timeout=timeout)
+
+
+# Moltin ids and chat ids have digits in them, unlike API version prefix
+_DIGIT_PATTERN = re.compile(r"\d")
+_VERSION_PATTERN = re.compile(r"v\d+")
+
+
+def _is_path_id(segment):
+    return bool(_DIGIT_PATTERN.search(segment)) and not _VERSION_PATTERN.fullmatch(
+        segment
+    )
+
+
+def get_request_operation(method, url):
+    """Name HTTP request by method and path with ids replaced, so there are
+    few label values, e.g. `GET /v2/carts/{id}/items`"""
+    segments = [
+        "{id}" if _is_path_id(segment) else segment
+        for segment in urlsplit(url).path.split("/")
+    ]
+    return f"{method.upper()} {'/'.join(segments)}"
+
+
+class InstrumentedSession(requests.Session):
+    """`requests` session timing every HTTP request to `service`"""
+
+    def __init__(self, service):
+        super().__init__()
+        self.__service = service
+
+    def request(self, method, url, *args, **kwargs):
+        with track_upstream(self.__service, get_request_operation(method, url)):
+            return super().request(method, url, *args, **kwargs)
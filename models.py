@@ -0,0 +1,116 @@
+"""Compact models of Moltin resources keeping only the fields the bot uses"""
+
+try:
+    from orjson import loads
+except ImportError:
+    from json import loads
+
+
+class _Model:
+    """Base of models, `__slots__` must list fields in the order of `__init__` args"""
+
+    __slots__ = ()
+
+    def __reduce__(self):
+        # Pickle as class and field values only, without field names
+        return self.__class__, tuple(getattr(self, name) for name in self.__slots__)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.__reduce__() == other.__reduce__()
+
+    def __hash__(self):
+        return hash(self.__reduce__())
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{self.__class__.__name__}({fields})"
+
+    def replace(self, **changes):
+        """Copy of the model with given fields changed"""
+        return self.__class__(
+            **{name: changes.get(name, getattr(self, name)) for name in self.__slots__}
+        )
+
+
+class Product(_Model):
+    __slots__ = ("id", "name", "description", "price", "currency", "main_image_id")
+
+    def __init__(self, id, name, description, price, currency, main_image_id=None):
+        self.id = id
+        self.name = name
+        self.description = description
+        self.price = price
+        self.currency = currency
+        self.main_image_id = main_image_id
+
+    @classmethod
+    def from_api(cls, product_data):
+        [price, *_] = product_data["price"]
+        main_image = product_data.get("relationships", {}).get("main_image", {})
+        return cls(
+            id=product_data["id"],
+            name=product_data["name"],
+            description=product_data.get("description", ""),
+            price=price["amount"],
+            currency=price["currency"],
+            main_image_id=main_image.get("data", {}).get("id"),
+        )
+
+
+class CartItem(_Model):
+    """Cart item, `amount` is the price of all units with tax.
+
+    Items known only from pending cart mutations have just
+    `product_id` and `quantity` set.
+    """
+
+    __slots__ = ("id", "product_id", "name", "quantity", "amount", "formatted_amount")
+
+    def __init__(
+        self,
+        id=None,
+        product_id=None,
+        name=None,
+        quantity=0,
+        amount=None,
+        formatted_amount=None,
+    ):
+        self.id = id
+        self.product_id = product_id
+        self.name = name
+        self.quantity = quantity
+        self.amount = amount
+        self.formatted_amount = formatted_amount
+
+    @classmethod
+    def from_api(cls, item_data):
+        value = item_data["meta"]["display_price"]["with_tax"]["value"]
+        return cls(
+            id=item_data["id"],
+            product_id=item_data["product_id"],
+            name=item_data["name"],
+            quantity=item_data["quantity"],
+            amount=value["amount"],
+            formatted_amount=value["formatted"],
+        )
+
+
+class Restaurant(_Model):
+    __slots__ = ("id", "address", "lon", "lat", "courier")
+
+    def __init__(self, id, address, lon, lat, courier):
+        self.id = id
+        self.address = address
+        self.lon = lon
+        self.lat = lat
+        self.courier = courier
+
+    @classmethod
+    def from_api(cls, entry_data):
+        return cls(
+            id=entry_data["id"],
+            address=entry_data["restaurant-address"],
+            lon=float(entry_data["restaurant-lon"]),
+            lat=float(entry_data["restaurant-lat"]),
+            courier=entry_data["restaurant-courier"],
+        )
@@ -1,15 +1,29 @@
 import time
-import requests
 
-from slugify import slugify
+import tracing
+from metrics import InstrumentedSession
+from models import CartItem, Product, Restaurant, loads
+
+
+def slugify(text):
+    # python-slugify loads transliteration tables, so it is imported only
+    # when the bot first creates a flow entry
+    from slugify import slugify
+
+    return slugify(text)
 
 
 class SimpleMoltinApiClient:
-    def __init__(self, client_id, client_secret=None):
+    API_BASE_URL = "https://api.moltin.com"
+
+    def __init__(self, client_id, client_secret=None, api_base_url=None):
+        self.__base_url = api_base_url if api_base_url else self.API_BASE_URL
         self.__client_id = client_id
         self.__client_secret = client_secret
         self.__access_token = None
         self.__expires_on = 0
+        self.__session = InstrumentedSession("moltin")
+        self.__session.hooks["response"].append(tracing.record_http_response)
 
     def __get_access_token(self):
         """Get access token or acquire a new one upon expiration"""
@@ -18,15 +32,15 @@ class SimpleMoltinApiClient:
         if self.__access_token and now < self.__expires_on:
             return self.__access_token
 
-        url = "https://api.moltin.com/oauth/access_token"
+        url = f"{self.__base_url}/oauth/access_token"
         data = {"client_id": self.__client_id, "grant_type": "implicit"}
         if self.__client_secret:
             data["client_secret"] = self.__client_secret
             data["grant_type"] = "client_credentials"
 
-        response = requests.post(url, data=data)
+        response = self.__session.post(url, data=data)
         response.raise_for_status()
-        auth_data = response.json()
+        auth_data = loads(response.content)
 
         self.__access_token = auth_data["access_token"]
         self.__expires_on = now + auth_data["expires_in"]
@@ -34,7 +48,7 @@ class SimpleMoltinApiClient:
         return self.__access_token
 
     def create_flow(self, name, description):
-        url = "https://api.moltin.com/v2/flows"
+        url = f"{self.__base_url}/v2/flows"
 
         headers = {
             "Authorization": f"Bearer {self.__get_access_token()}",
@@ -51,13 +65,13 @@ class SimpleMoltinApiClient:
             }
         }
 
-        response = requests.post(url, headers=headers, json=json)
+        response = self.__session.post(url, headers=headers, json=json)
         response.raise_for_status()
-        new_flow = response.json()
+        new_flow = loads(response.content)
         return new_flow["data"]["id"]
 
     def create_flow_field(self, flow_id, name, field_type, description, required=True):
-        url = "https://api.moltin.com/v2/fields"
+        url = f"{self.__base_url}/v2/fields"
 
         headers = {
             "Authorization": f"Bearer {self.__get_access_token()}",
@@ -77,13 +91,13 @@ class SimpleMoltinApiClient:
             }
         }
 
-        response = requests.post(url, headers=headers, json=json)
+        response = self.__session.post(url, headers=headers, json=json)
         response.raise_for_status()
-        new_field = response.json()
+        new_field = loads(response.content)
         return new_field["data"]["id"]
 
     def create_flow_entry(self, flow_slug, **kwargs):
-        url = f"https://api.moltin.com/v2/flows/{flow_slug}/entries"
+        url = f"{self.__base_url}/v2/flows/{flow_slug}/entries"
 
         headers = {
             "Authorization": f"Bearer {self.__get_access_token()}",
@@ -97,23 +111,62 @@ class SimpleMoltinApiClient:
             }
         }
 
-        response = requests.post(url, headers=headers, json=json)
+        response = self.__session.post(url, headers=headers, json=json)
         response.raise_for_status()
-        new_entry = response.json()
+        new_entry = loads(response.content)
         return new_entry["data"]["id"]
 
     def get_flow_entries(self, flow_slug):
-        url = f"https://api.moltin.com/v2/flows/{flow_slug}/entries"
+        url = f"{self.__base_url}/v2/flows/{flow_slug}/entries"
 
         headers = {"Authorization": f"Bearer {self.__get_access_token()}"}
 
-        response = requests.get(url, headers=headers)
+        response = self.__session.get(url, headers=headers)
         response.raise_for_status()
 
-        flow_entries_info = response.json()
+        flow_entries_info = loads(response.content)
 
         return flow_entries_info["data"]
 
+    def get_restaurants(self):
+        return tuple(
+            Restaurant.from_api(entry)
+            for entry in self.get_flow_entries(flow_slug="restaurant")
+        )
+
+    def get_if_modified(self, path, params=None, validators=None):
+        """Get API resource unless it has not changed since previous request.
+
+        Args:
+            path (str): API path, e.g. `/v2/products`
+            params (dict): query parameters
+            validators (dict): `ETag` and `Last-Modified` headers of previous response
+
+        Returns:
+            tuple: response data or None if resource is not modified,
+                and validators of the response
+        """
+        url = f"{self.__base_url}{path}"
+
+        headers = {"Authorization": f"Bearer {self.__get_access_token()}"}
+        validators = validators if validators else {}
+        if etag := validators.get("ETag"):
+            headers["If-None-Match"] = etag
+        if last_modified := validators.get("Last-Modified"):
+            headers["If-Modified-Since"] = last_modified
+
+        response = self.__session.get(url, headers=headers, params=params)
+        if response.status_code == 304:
+            return None, validators
+        response.raise_for_status()
+
+        new_validators = {
+            header: response.headers[header]
+            for header in ("ETag", "Last-Modified")
+            if header in response.headers
+        }
+        return loads(response.content), new_validators
+
     def create_product(
         self,
         name,
@@ -124,7 +177,7 @@ class SimpleMoltinApiClient:
         sku: str = None,
         draft=False,
     ):
-        url = "https://api.moltin.com/v2/products"
+        url = f"{self.__base_url}/v2/products"
 
         headers = {
             "Authorization": f"Bearer {self.__get_access_token()}",
@@ -151,37 +204,99 @@ class SimpleMoltinApiClient:
             }
         }
 
-        response = requests.post(url, headers=headers, json=json)
+        response = self.__session.post(url, headers=headers, json=json)
         response.raise_for_status()
-        new_product = response.json()
+        new_product = loads(response.content)
         return new_product["data"]["id"]
 
     def get_products(self):
-        url = "https://api.moltin.com/v2/products"
+        url = f"{self.__base_url}/v2/products"
 
         headers = {"Authorization": f"Bearer {self.__get_access_token()}"}
 
-        response = requests.get(url, headers=headers)
+        response = self.__session.get(url, headers=headers)
         response.raise_for_status()
 
-        product_data = response.json()
+        product_data = loads(response.content)
 
         return {product["name"]: product["id"] for product in product_data["data"]}
 
     def get_product_by_id(self, id):
-        url = f"https://api.moltin.com/v2/products/{id}"
+        url = f"{self.__base_url}/v2/products/{id}"
+
+        headers = {"Authorization": f"Bearer {self.__get_access_token()}"}
+
+        response = self.__session.get(url, headers=headers)
+        response.raise_for_status()
+
+        product_info = loads(response.content)
+
+        return Product.from_api(product_info["data"])
+
+    def get_product_with_image(self, id):
+        """Get product and link to its main image with a single request.
+
+        Returns:
+            tuple: product and image link, or None if product has no image
+        """
+        url = f"{self.__base_url}/v2/products/{id}"
 
         headers = {"Authorization": f"Bearer {self.__get_access_token()}"}
+        params = {"include": "main_image"}
 
-        response = requests.get(url, headers=headers)
+        response = self.__session.get(url, headers=headers, params=params)
         response.raise_for_status()
 
-        product_info = response.json()
+        product_info = loads(response.content)
+        image_links = self.__get_included_image_links(product_info)
+        product = Product.from_api(product_info["data"])
+
+        return product, image_links.get(product.main_image_id)
+
+    def get_products_with_images(self, ids):
+        """Get several products with links to their main images in a single request.
+
+        Returns:
+            dict: mapping of product id to tuple of product and image link
+        """
+        if not ids:
+            return {}
+
+        url = f"{self.__base_url}/v2/products"
+
+        headers = {"Authorization": f"Bearer {self.__get_access_token()}"}
+        params = {"filter": f"in(id,{','.join(ids)})", "include": "main_image"}
+
+        response = self.__session.get(url, headers=headers, params=params)
+        response.raise_for_status()
 
-        return product_info["data"]
+        products_info = loads(response.content)
+
+        return self.get_product_cards(products_info)
+
+    @classmethod
+    def get_product_cards(cls, products_info):
+        """Get products with links to their main images from products response.
+
+        Returns:
+            dict: mapping of product id to tuple of product and image link
+        """
+        image_links = cls.__get_included_image_links(products_info)
+        products = map(Product.from_api, products_info["data"])
+        return {
+            product.id: (product, image_links.get(product.main_image_id))
+            for product in products
+        }
+
+    @staticmethod
+    def __get_included_image_links(response_info):
+        return {
+            image["id"]: image["link"]["href"]
+            for image in response_info.get("included", {}).get("main_images", [])
+        }
 
     def create_image_from_url(self, image_url):
-        url = f"https://api.moltin.com/v2/files"
+        url = f"{self.__base_url}/v2/files"
 
         headers = {
             "Authorization": f"Bearer {self.__get_access_token()}",
@@ -191,14 +306,12 @@ class SimpleMoltinApiClient:
             "file_location": (None, image_url),
         }
 
-        response = requests.post(url, headers=headers, files=files)
-        new_file = response.json()
+        response = self.__session.post(url, headers=headers, files=files)
+        new_file = loads(response.content)
         return new_file["data"]["id"]
 
     def attach_image_to_product(self, product_id, image_id):
-        url = (
-            f"https://api.moltin.com/v2/products/{product_id}/relationships/main-image"
-        )
+        url = f"{self.__base_url}/v2/products/{product_id}/relationships/main-image"
 
         headers = {
             "Authorization": f"Bearer {self.__get_access_token()}",
@@ -207,45 +320,45 @@ class SimpleMoltinApiClient:
 
         json = {"data": {"type": "main_image", "id": image_id}}
 
-        response = requests.post(url, headers=headers, json=json)
+        response = self.__session.post(url, headers=headers, json=json)
         response.raise_for_status()
 
     def get_image_url_by_file_id(self, id):
-        url = f"https://api.moltin.com/v2/files/{id}"
+        url = f"{self.__base_url}/v2/files/{id}"
 
         headers = {"Authorization": f"Bearer {self.__get_access_token()}"}
 
-        response = requests.get(url, headers=headers)
+        response = self.__session.get(url, headers=headers)
         response.raise_for_status()
 
-        file_info = response.json()
+        file_info = loads(response.content)
         return file_info["data"]["link"]["href"]
 
     def remove_product_from_cart(self, cart_id, item_id):
-        url = f"https://api.moltin.com/v2/carts/{cart_id}/items/{item_id}"
+        url = f"{self.__base_url}/v2/carts/{cart_id}/items/{item_id}"
 
         headers = {"Authorization": f"Bearer {self.__get_access_token()}"}
 
-        response = requests.delete(url, headers=headers)
+        response = self.__session.delete(url, headers=headers)
         response.raise_for_status()
 
     def get_cart_and_full_price(self, cart_id):
-        url = f"https://api.moltin.com/v2/carts/{cart_id}/items"
+        url = f"{self.__base_url}/v2/carts/{cart_id}/items"
 
         headers = {"Authorization": f"Bearer {self.__get_access_token()}"}
 
-        response = requests.get(url, headers=headers)
+        response = self.__session.get(url, headers=headers)
         response.raise_for_status()
 
-        items_info = response.json()
+        items_info = loads(response.content)
 
         return (
-            items_info["data"],
+            [CartItem.from_api(item) for item in items_info["data"]],
             items_info["meta"]["display_price"]["with_tax"]["amount"],
         )
 
     def add_product_to_cart(self, cart_id, product_id, quantity, currency=None):
-        url = f"https://api.moltin.com/v2/carts/{cart_id}/items"
+        url = f"{self.__base_url}/v2/carts/{cart_id}/items"
 
         headers = {
             "Authorization": f"Bearer {self.__get_access_token()}",
@@ -256,41 +369,78 @@ class SimpleMoltinApiClient:
 
         json = {"data": {"id": product_id, "type": "cart_item", "quantity": quantity}}
 
-        response = requests.post(url, headers=headers, json=json)
+        response = self.__session.post(url, headers=headers, json=json)
         response.raise_for_status()
 
-    def get_or_create_customer_by_email(self, email):
-        url = "https://api.moltin.com/v2/customers"
+    def add_products_to_cart(self, cart_id, quantities, currency=None):
+        """Add several products to cart with single bulk request.
+
+        Args:
+            cart_id: cart reference
+            quantities (dict): mapping of product id to quantity to add
+        """
+        url = f"{self.__base_url}/v2/carts/{cart_id}/items"
+
+        headers = {
+            "Authorization": f"Bearer {self.__get_access_token()}",
+            "Content-Type": "application/json",
+        }
+        if currency:
+            headers["X-MOLTIN-CURRENCY"] = currency
+
+        json = {
+            "data": [
+                {"id": product_id, "type": "cart_item", "quantity": quantity}
+                for product_id, quantity in quantities.items()
+            ]
+        }
+
+        response = self.__session.post(url, headers=headers, json=json)
+        response.raise_for_status()
+
+    def get_customer_id_by_email(self, email):
+        url = f"{self.__base_url}/v2/customers"
 
         headers = {"Authorization": f"Bearer {self.__get_access_token()}"}
+        params = {"filter": f"eq(email,{email})"}
 
-        response = requests.get(url, headers=headers)
+        response = self.__session.get(url, headers=headers, params=params)
         response.raise_for_status()
 
-        customer_info = response.json()
+        customer_info = loads(response.content)
 
         if customer_info["data"]:
             return customer_info["data"][0]["id"]
+        return None
 
-        headers["Content-Type"] = "application/json"
+    def create_customer(self, email, name="Anonymous Customer"):
+        url = f"{self.__base_url}/v2/customers"
 
-        json = {
-            "data": {"type": "customer", "name": "Anonymous Customer", "email": email}
+        headers = {
+            "Authorization": f"Bearer {self.__get_access_token()}",
+            "Content-Type": "application/json",
         }
 
-        response = requests.post(url, headers=headers, json=json)
+        json = {"data": {"type": "customer", "name": name, "email": email}}
+
+        response = self.__session.post(url, headers=headers, json=json)
         response.raise_for_status()
 
-        customer_info = response.json()
+        customer_info = loads(response.content)
 
         return customer_info["data"]["id"]
 
+    def get_or_create_customer_by_email(self, email):
+        if customer_id := self.get_customer_id_by_email(email):
+            return customer_id
+        return self.create_customer(email)
+
     def flush_cart(self, cart_id):
-        url = f"https://api.moltin.com/v2/carts/{cart_id}"
+        url = f"{self.__base_url}/v2/carts/{cart_id}"
 
         headers = {"Authorization": f"Bearer {self.__get_access_token()}"}
 
-        response = requests.delete(url, headers=headers)
+        response = self.__session.delete(url, headers=headers)
         response.raise_for_status()
 
     def checkout(self, cart_id, customer_id):
@@ -303,7 +453,7 @@ class SimpleMoltinApiClient:
             "country": "na",
         }
 
-        url = f"https://api.moltin.com/v2/carts/{cart_id}/checkout"
+        url = f"{self.__base_url}/v2/carts/{cart_id}/checkout"
 
         headers = {
             "Authorization": f"Bearer {self.__get_access_token()}",
@@ -318,5 +468,5 @@ class SimpleMoltinApiClient:
             }
         }
 
-        response = requests.post(url, headers=headers, json=json)
+        response = self.__session.post(url, headers=headers, json=json)
         response.raise_for_status()
@@ -0,0 +1,189 @@
+import csv
+import os
+import time
+from argparse import ArgumentParser
+from collections import defaultdict
+from datetime import datetime, timezone
+
+import redis
+from environs import Env
+
+from order_events import EVENT_FIELDS, STREAM_KEY
+
+
+class OrderEventAggregator:
+    """Aggregate order events from the stream as a consumer group member.
+
+    Every event is counted into a Redis hash of its time bucket, e.g.
+    `order-stats:1666137600`, and appended to a daily CSV file in
+    `export_dir`. Counters of a batch are written in the same transaction
+    which acknowledges it, so a crashed consumer picks up its pending
+    events on restart without double counting. CSV rows of the batch being
+    processed during a crash may be written twice.
+
+    Counter fields:
+        transitions:<state>><new_state>  number of transitions
+        updates:<state>, duration_ms:<state>  handled updates and their
+            total handling time, by the state handling them
+        orders, revenue, delivery_orders  paid orders and their total
+    """
+
+    GROUP = "analytics"
+    STATS_KEY = "order-stats:{}"
+
+    def __init__(
+        self,
+        redis_connection,
+        consumer,
+        export_dir="./order-events",
+        bucket_seconds=60,
+        batch_size=500,
+        stats_ttl=30 * 86400,
+    ):
+        self.__redis = redis_connection
+        self.__consumer = consumer
+        self.__export_dir = export_dir
+        self.__bucket_seconds = bucket_seconds
+        self.__batch_size = batch_size
+        self.__stats_ttl = stats_ttl
+        self.__last_id = "0"
+
+    def create_group(self):
+        try:
+            self.__redis.xgroup_create(STREAM_KEY, self.GROUP, id="0", mkstream=True)
+        except redis.ResponseError as error:
+            if "BUSYGROUP" not in str(error):
+                raise
+
+    def process_batch(self, block_ms=None):
+        """Aggregate the next batch, pending events of the consumer first.
+
+        Returns:
+            int: number of events processed
+        """
+        response = self.__redis.xreadgroup(
+            self.GROUP,
+            self.__consumer,
+            {STREAM_KEY: self.__last_id},
+            count=self.__batch_size,
+            block=None if self.__last_id == "0" else block_ms,
+        )
+        entries = response[0][1] if response else []
+        if not entries and self.__last_id == "0":
+            # No pending events left, switch to new ones
+            self.__last_id = ">"
+            return self.process_batch(block_ms)
+        if not entries:
+            return 0
+
+        events = [
+            {name.decode(): value.decode() for name, value in fields.items()}
+            for _, fields in entries
+        ]
+        self.__export(events)
+
+        pipeline = self.__redis.pipeline()
+        for bucket, counters in self.__count(events).items():
+            key = self.STATS_KEY.format(bucket)
+            for field, value in counters.items():
+                if isinstance(value, int):
+                    pipeline.hincrby(key, field, value)
+                else:
+                    pipeline.hincrbyfloat(key, field, value)
+            pipeline.expire(key, self.__stats_ttl)
+        pipeline.xack(STREAM_KEY, self.GROUP, *(id for id, _ in entries))
+        pipeline.execute()
+        return len(entries)
+
+    def __count(self, events):
+        buckets = defaultdict(lambda: defaultdict(int))
+        for event in events:
+            ts = int(event["ts"]) // 1000
+            counters = buckets[ts - ts % self.__bucket_seconds]
+            if event["event"] == "transition":
+                state = event["state"]
+                counters[f"transitions:{state}>{event['new_state']}"] += 1
+                counters[f"updates:{state}"] += 1
+                counters[f"duration_ms:{state}"] += float(event["duration_ms"])
+            elif event["event"] == "order":
+                counters["orders"] += 1
+                counters["revenue"] += int(event.get("cart_total", 0))
+                counters["delivery_orders"] += int(event.get("delivery", 0))
+        return buckets
+
+    def __export(self, events):
+        days = defaultdict(list)
+        for event in events:
+            day = datetime.fromtimestamp(int(event["ts"]) // 1000, tz=timezone.utc)
+            days[day.date().isoformat()].append(event)
+
+        os.makedirs(self.__export_dir, exist_ok=True)
+        for day, day_events in days.items():
+            path = os.path.join(self.__export_dir, f"order-events-{day}.csv")
+            is_new = not os.path.exists(path)
+            with open(path, "a", newline="") as file:
+                writer = csv.DictWriter(file, EVENT_FIELDS, extrasaction="ignore")
+                if is_new:
+                    writer.writeheader()
+                writer.writerows(day_events)
+
+    def run(self, block_ms=5000, once=False):
+        """Process events until interrupted, or until stream is drained if
+        `once` is set.
+
+        Returns:
+            int: number of events processed
+        """
+        self.create_group()
+        processed = 0
+        while True:
+            count = self.process_batch(block_ms=None if once else block_ms)
+            processed += count
+            if once and not count:
+                return processed
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--consumer",
+        type=str,
+        default="analytics",
+        help="Consumer name, keep it the same between restarts",
+    )
+    parser.add_argument("-o", "--export-dir", type=str, default="./order-events")
+    parser.add_argument(
+        "--bucket", type=int, default=60, help="Seconds per counters bucket"
+    )
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument(
+        "--once", action="store_true", help="Exit once stream is drained"
+    )
+
+    args = parser.parse_args()
+
+    env = Env()
+    env.read_env()
+
+    redis_connection = redis.Redis(
+        host=env("REDIS_HOST"),
+        port=env("REDIS_PORT"),
+        password=env("REDIS_PASSWORD"),
+    )
+    aggregator = OrderEventAggregator(
+        redis_connection,
+        args.consumer,
+        export_dir=args.export_dir,
+        bucket_seconds=args.bucket,
+        batch_size=args.batch_size,
+    )
+    started_at = time.monotonic()
+    try:
+        processed = aggregator.run(once=args.once)
+    except KeyboardInterrupt:
+        return
+    print(f"Processed {processed} events in {time.monotonic() - started_at:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
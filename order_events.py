@@ -0,0 +1,90 @@
+import logging
+import threading
+import time
+from collections import deque
+
+
+logger = logging.getLogger("pizza_bot")
+
+STREAM_KEY = "order-events"
+
+# Every event has `event`, `ts` (unix time in ms) and `chat`, the rest
+# depends on event type and is omitted when unknown
+EVENT_FIELDS = (
+    "ts",
+    "event",
+    "chat",
+    "state",
+    "new_state",
+    "duration_ms",
+    "cart_total",
+    "restaurant",
+    "distance_km",
+    "delivery",
+    "order",
+)
+
+
+class EventLog:
+    """Append events to a Redis Stream without blocking the caller.
+
+    Events are buffered in memory and written by a background thread every
+    `flush_interval` seconds with a single pipelined request. Buffer holds
+    at most `max_buffered` events, the oldest ones are dropped beyond that,
+    as are events which could not be written. Stream is trimmed to about
+    `max_len` entries.
+    """
+
+    def __init__(
+        self, redis_connection, flush_interval=1.0, max_buffered=10000, max_len=1000000
+    ):
+        self.__redis = redis_connection
+        self.__flush_interval = flush_interval
+        self.__max_len = max_len
+        self.__events = deque(maxlen=max_buffered)
+        self.__stopped = threading.Event()
+        self.__thread = None
+
+    def record(self, event, chat, **fields):
+        fields = {
+            "event": event,
+            "ts": int(time.time() * 1000),
+            "chat": chat,
+            **{
+                name: int(value) if isinstance(value, bool) else value
+                for name, value in fields.items()
+                if value is not None
+            },
+        }
+        self.__events.append(fields)
+
+    def start(self):
+        self.__thread = threading.Thread(
+            target=self.__run, name="event-log", daemon=True
+        )
+        self.__thread.start()
+
+    def stop(self):
+        self.__stopped.set()
+        if self.__thread:
+            self.__thread.join()
+        self.flush()
+
+    def __run(self):
+        while not self.__stopped.wait(self.__flush_interval):
+            self.flush()
+
+    def flush(self):
+        events = []
+        while self.__events:
+            events.append(self.__events.popleft())
+        if not events:
+            return
+
+        pipeline = self.__redis.pipeline(transaction=False)
+        for fields in events:
+            pipeline.xadd(STREAM_KEY, fields, maxlen=self.__max_len, approximate=True)
+        try:
+            pipeline.execute()
+        except Exception:
+            logger.warning(f"Dropped {len(events)} order events", exc_info=True)
@@ -0,0 +1,65 @@
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger("pizza_bot")
+
+
+class Prefetcher:
+    """Run prefetch tasks in background with bounded concurrency.
+
+    At most `max_pending` tasks are queued or running at once, tasks beyond
+    that are dropped. Tasks of a chat not yet started are cancelled once
+    the chat sends a new update. Chats are forgotten once their tasks are done.
+    """
+
+    def __init__(self, max_workers=4, max_pending=64):
+        self.__executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="prefetch"
+        )
+        self.__slots = threading.BoundedSemaphore(max_pending)
+        self.__pending = {}
+        self.__lock = threading.Lock()
+
+    def prefetch(self, chat_id, tasks):
+        self.cancel(chat_id)
+        futures = []
+        for task in tasks:
+            if not self.__slots.acquire(blocking=False):
+                logger.debug("Prefetch queue is full, skipping the rest")
+                break
+            future = self.__executor.submit(self.__run, task)
+            future.add_done_callback(lambda _: self.__slots.release())
+            futures.append(future)
+        if futures:
+            with self.__lock:
+                self.__pending[chat_id] = futures
+            for future in futures:
+                future.add_done_callback(
+                    functools.partial(self.__forget, chat_id, futures)
+                )
+
+    def __forget(self, chat_id, futures, _):
+        with self.__lock:
+            if self.__pending.get(chat_id) is futures and all(
+                future.done() for future in futures
+            ):
+                del self.__pending[chat_id]
+
+    def cancel(self, chat_id):
+        with self.__lock:
+            futures = self.__pending.pop(chat_id, [])
+        for future in futures:
+            future.cancel()
+
+    def shutdown(self):
+        self.__executor.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    def __run(task):
+        try:
+            task()
+        except Exception:
+            logger.debug("Prefetch task failed", exc_info=True)
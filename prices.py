@@ -0,0 +1,203 @@
+"""Product prices in every configured currency, in the smallest currency units"""
+
+import logging
+from decimal import ROUND_HALF_UP, Decimal
+from types import MappingProxyType
+from typing import Mapping, NamedTuple, Tuple
+
+
+logger = logging.getLogger("pizza_bot")
+
+# ISO 4217 currencies without minor units, Telegram Payments take amounts of
+# the others in hundredths
+ZERO_DECIMAL_CURRENCIES = frozenset({"CLP", "ISK", "JPY", "KRW", "PYG", "UGX", "VND"})
+
+# Store currencies are kept in whole units unless Moltin says otherwise,
+# invoices always multiplied cart amounts by 100 for kopecks
+DEFAULT_DECIMAL_PLACES = 0
+DEFAULT_FORMATS = {"RUB": "{price} Р"}
+
+
+def get_minor_digits(currency):
+    return 0 if currency in ZERO_DECIMAL_CURRENCIES else 2
+
+
+class Currency(NamedTuple):
+    code: str
+    # Units of this currency per unit of the default store currency
+    exchange_rate: Decimal
+    # Digits after decimal point in Moltin amounts and formatted prices
+    decimal_places: int
+    format: str
+    decimal_point: str = "."
+    thousand_separator: str = ""
+
+    @classmethod
+    def from_api(cls, currency_data):
+        return cls(
+            code=currency_data["code"].upper(),
+            exchange_rate=Decimal(str(currency_data.get("exchange_rate", 1))),
+            decimal_places=int(currency_data.get("decimal_places", 2)),
+            format=currency_data.get("format", "{price} " + currency_data["code"]),
+            decimal_point=currency_data.get("decimal_point", "."),
+            thousand_separator=currency_data.get("thousand_separator", ""),
+        )
+
+    @classmethod
+    def fallback(cls, code):
+        """Store currency of a Moltin store without currencies set up"""
+        return cls(
+            code=code,
+            exchange_rate=Decimal(1),
+            decimal_places=DEFAULT_DECIMAL_PLACES,
+            format=DEFAULT_FORMATS.get(code, "{price} " + code),
+        )
+
+
+class PriceTable:
+    """Prices of all products in each configured currency.
+
+    Amounts are integers in the smallest currency units, the way Telegram
+    Payments expect them. Prices set on a product for a currency are taken
+    as is, the rest are converted from the store currency price by Moltin
+    exchange rates. The table is built once per catalog version, so pricing
+    menus, carts and invoices takes no Moltin requests.
+    """
+
+    def __init__(
+        self,
+        currencies: Tuple[Currency, ...],
+        store_currency: Currency,
+        prices: Mapping[str, Mapping[str, int]],
+    ):
+        self.__currencies = {currency.code: currency for currency in currencies}
+        self.__store_currency = store_currency
+        self.__prices = prices
+        # First configured currency is the default one
+        self.currencies = tuple(self.__currencies)
+
+    @classmethod
+    def from_api(cls, products_info, currencies_info, codes):
+        """Build the table from Moltin products and currencies responses.
+
+        Args:
+            codes (list): ISO 4217 codes of currencies to price products in
+        """
+        known = {
+            currency.code: currency
+            for currency in map(Currency.from_api, currencies_info["data"])
+        }
+        store_currency = next(
+            (
+                Currency.from_api(currency_data)
+                for currency_data in currencies_info["data"]
+                if currency_data.get("default")
+            ),
+            known.get(codes[0].upper()) or Currency.fallback(codes[0].upper()),
+        )
+        known.setdefault(store_currency.code, store_currency)
+        currencies = []
+        for code in map(str.upper, codes):
+            if code in known:
+                currencies.append(known[code])
+            else:
+                logger.warning(f"Currency {code} is not set up in Moltin, skipping it")
+        currencies = tuple(currencies) or (store_currency,)
+
+        prices = {currency.code: {} for currency in currencies}
+        for product_data in products_info["data"]:
+            amounts = {
+                price["currency"].upper(): price["amount"]
+                for price in product_data["price"]
+            }
+            store_code = store_currency.code if store_currency.code in amounts else None
+            for currency in currencies:
+                if currency.code in amounts:
+                    prices[currency.code][product_data["id"]] = cls.__to_minor_units(
+                        amounts[currency.code], currency
+                    )
+                elif store_code:
+                    prices[currency.code][product_data["id"]] = cls.__convert(
+                        amounts[store_code], store_currency, currency
+                    )
+        return cls(
+            currencies,
+            store_currency,
+            MappingProxyType(
+                {code: MappingProxyType(table) for code, table in prices.items()}
+            ),
+        )
+
+    @staticmethod
+    def __to_minor_units(amount, currency):
+        digits = get_minor_digits(currency.code) - currency.decimal_places
+        return int(
+            (Decimal(str(amount)) * Decimal(10) ** digits).to_integral_value(
+                ROUND_HALF_UP
+            )
+        )
+
+    @staticmethod
+    def __convert(amount, from_currency, to_currency):
+        units = (
+            Decimal(str(amount))
+            / Decimal(10) ** from_currency.decimal_places
+            / from_currency.exchange_rate
+            * to_currency.exchange_rate
+        )
+        return int(
+            (
+                units * Decimal(10) ** get_minor_digits(to_currency.code)
+            ).to_integral_value(ROUND_HALF_UP)
+        )
+
+    def select_currency(self, language_code=None, currency_by_language=None):
+        """Get currency to show prices to user in.
+
+        Args:
+            language_code (str): IETF language tag of the user, e.g. "en-US"
+            currency_by_language (dict): currency codes by language, e.g.
+                `{"en": "USD"}`, unconfigured currencies fall back to default
+        """
+        language = (language_code or "").split("-")[0].lower()
+        currency = (currency_by_language or {}).get(language, "").upper()
+        return currency if currency in self.__currencies else self.currencies[0]
+
+    def get_price(self, product_id, currency):
+        """Get price of product.
+
+        Returns:
+            int|None: price in the smallest units, None for unknown products
+        """
+        return self.__prices[currency].get(product_id)
+
+    def convert(self, amount, currency):
+        """Convert Moltin amount in store currency to the smallest units"""
+        return self.__convert(
+            amount, self.__store_currency, self.__currencies[currency]
+        )
+
+    def get_item_amount(self, item, currency):
+        """Get price of all units of the cart item in the smallest units.
+
+        Products gone from the catalog are priced by Moltin cart amount.
+        """
+        price = self.get_price(item.product_id, currency)
+        if price is None:
+            return self.convert(item.amount or 0, currency)
+        return price * item.quantity
+
+    def get_total(self, cart_items, currency):
+        return sum(self.get_item_amount(item, currency) for item in cart_items)
+
+    def format(self, amount, currency):
+        """Format amount in the smallest units with Moltin currency format"""
+        currency = self.__currencies[currency]
+        units = Decimal(amount) / Decimal(10) ** get_minor_digits(currency.code)
+        number = f"{units:,.{currency.decimal_places}f}"
+        number = (
+            number.replace(",", "\0")
+            .replace(".", currency.decimal_point)
+            .replace("\0", currency.thousand_separator)
+        )
+        return currency.format.format(price=number)
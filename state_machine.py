@@ -2,18 +2,30 @@ from __future__ import annotations
 import logging
 
 import pickle
-from typing import Type
+import time
+from types import MappingProxyType
+from typing import Any, Mapping, NamedTuple, Type
 
 from jinja2 import Environment
 from telegram import Update
 from telegram.ext import CallbackContext
 
+import metrics
+import tracing
 from moltin_api import SimpleMoltinApiClient
+from state_storage import StateStorage
 
 
 logger = logging.getLogger("pizza_bot")
 
 
+class Transition(NamedTuple):
+    """Switch to registered state `name` created with `kwargs`"""
+
+    name: str
+    kwargs: Mapping[str, Any] = MappingProxyType({})
+
+
 class State(object):
     def __init__(self):
         pass
@@ -36,7 +48,7 @@ class State(object):
 
     def handle_input(
         self, update: Update, context: CallbackContext
-    ) -> Type[State] | None:
+    ) -> Transition | None:
         """Handle user input.
         All user input for given state is redirected here.
 
@@ -45,10 +57,29 @@ class State(object):
             context (CallbackContext): context instance of incoming update handler
 
         Returns:
-            Type[State]|None: new state to transition to or None to keep present state
+            Transition|None: transition to a state registered as a target of
+                this one or None to keep present state
         """
         return None
 
+    def get_prefetch_tasks(self, moltin: SimpleMoltinApiClient):
+        """Get tasks warming up caches for the likely next state.
+        Tasks are run in background after the state is prepared.
+
+        Returns:
+            list: callables taking no arguments
+        """
+        return []
+
+    def get_event_attributes(self):
+        """Get attributes of the state to record with transition to it,
+        e.g. cart total. See `order_events.EVENT_FIELDS` for known ones.
+
+        Returns:
+            dict: attribute names and values
+        """
+        return {}
+
     def clean_up(self, update: Update, context: CallbackContext):
         """Clean up before state transition.
         Good place to edit/delete state messages or keyboards or get rid of expired context data.
@@ -60,17 +91,113 @@ class State(object):
         pass
 
 
+class StateRegistry:
+    """Declared states and transitions between them.
+
+    Every state class is registered with names of the states its
+    `handle_input` may switch to, `StateMachine.INITIAL_STATE` included.
+    `validate` checks the declarations once all states are defined. States
+    return a `Transition` naming the target and the state machine creates
+    it with `create_state`, so only declared transitions can be taken.
+    """
+
+    def __init__(self):
+        self.__classes = {}
+        self.__targets = {}
+        self.__transitions = {}
+        self.__initial_name = None
+
+    def register(self, *targets):
+        """Decorate state class to register it with its transition targets"""
+
+        def decorator(state_class: Type[State]):
+            self.__classes[state_class.__name__] = state_class
+            self.__targets[state_class.__name__] = targets
+            return state_class
+
+        return decorator
+
+    def validate(self, initial_state: Type[State]):
+        """Check that transitions lead to registered states and every state
+        is reachable from the initial one.
+
+        Raises:
+            ValueError: with all problems found
+        """
+        initial_name = initial_state.__name__
+        errors = []
+        if initial_name not in self.__targets:
+            errors.append(f"initial state {initial_name} is not registered")
+        transitions = {}
+        for name, targets in self.__targets.items():
+            transitions[name] = frozenset(
+                initial_name if target == StateMachine.INITIAL_STATE else target
+                for target in targets
+            )
+            errors.extend(
+                f"{name} switches to unregistered {target}"
+                for target in sorted(transitions[name] - self.__targets.keys())
+            )
+
+        reachable = {initial_name}
+        pending = [initial_name]
+        while pending:
+            for target in transitions.get(pending.pop(), ()):
+                if target not in reachable:
+                    reachable.add(target)
+                    pending.append(target)
+        errors.extend(
+            f"{name} is unreachable from {initial_name}"
+            for name in sorted(self.__targets.keys() - reachable)
+        )
+        if errors:
+            raise ValueError("Invalid state registry: " + "; ".join(errors))
+        self.__transitions = transitions
+        self.__initial_name = initial_name
+
+    def create_state(self, state_name, transition: Transition) -> State:
+        """Create the state a transition of state `state_name` leads to.
+
+        Raises:
+            ValueError: if the transition was not declared
+        """
+        target = (
+            self.__initial_name
+            if transition.name == StateMachine.INITIAL_STATE
+            else transition.name
+        )
+        if target not in self.__transitions.get(state_name, ()):
+            raise ValueError(f"Undeclared transition {state_name} -> {target}")
+        return self.__classes[target](**transition.kwargs)
+
+    @property
+    def transitions(self):
+        """dict: names of states each state may switch to"""
+        return dict(self.__transitions)
+
+
 class StateMachine:
     INITIAL_STATE = "INITIAL_STATE"
 
     def __init__(
-        self, initial_state: Type[State], redis_connection, moltin_client, jinja_env
+        self,
+        initial_state: Type[State],
+        registry: StateRegistry,
+        state_storage: StateStorage,
+        moltin_client,
+        jinja_env,
+        prefetcher=None,
+        event_log=None,
     ):
         self.users_state = dict()
         self.__initial_state = initial_state
-        self.__redis = redis_connection
+        self.__storage = state_storage
         self.__moltin_client = moltin_client
         self.__jinja = jinja_env
+        self.__prefetcher = prefetcher
+        self.__event_log = event_log
+        self.__registry = registry
+        registry.validate(initial_state)
 
     def handle_message(self, update: Update, context: CallbackContext):
         chat_id = (
@@ -79,43 +206,87 @@ class StateMachine:
             else update.pre_checkout_query.from_user.id
         )
 
+        with tracing.trace_update(chat_id=chat_id, update_id=update.update_id):
+            self.__handle_message(chat_id, update, context)
+
+    def __prefetch(self, chat_id, state: State):
+        if self.__prefetcher:
+            self.__prefetcher.prefetch(
+                chat_id, state.get_prefetch_tasks(self.__moltin_client)
+            )
+
+    def __record_transition(self, chat_id, state_name, new_state: State, started_at):
+        if self.__event_log:
+            self.__event_log.record(
+                "transition",
+                chat_id,
+                state=state_name,
+                new_state=type(new_state).__name__,
+                duration_ms=round((time.perf_counter() - started_at) * 1000, 1),
+                **new_state.get_event_attributes(),
+            )
+
+    def __handle_message(self, chat_id, update: Update, context: CallbackContext):
+        started_at = time.perf_counter()
+        if self.__prefetcher:
+            self.__prefetcher.cancel(chat_id)
+
         # Reset state to initial upon /start command regardless of current state
         if update.message and update.message.text == "/start":
             logger.debug(f"Set initial state for user id({chat_id})")
             self.users_state[chat_id] = self.__initial_state()
-            self.users_state[chat_id].prepare_state(
-                update, context, self.__moltin_client, self.__jinja
+            with metrics.track_state(self.users_state[chat_id], "prepare_state"):
+                self.users_state[chat_id].prepare_state(
+                    update, context, self.__moltin_client, self.__jinja
+                )
+            self.__prefetch(chat_id, self.users_state[chat_id])
+            self.__record_transition(
+                chat_id, "/start", self.users_state[chat_id], started_at
             )
             return
 
-        # Try to retrieve user state from persistent redis storage
-        if self.users_state.get(chat_id, None) is None and self.__redis.exists(chat_id):
-            self.users_state[chat_id] = pickle.loads(self.__redis.get(chat_id))
-            logger.debug(
-                f"Loaded {type(self.users_state[chat_id]).__name__} for user id({chat_id}) from persistent storage"
-            )
+        # Try to retrieve user state from persistent storage
+        if self.users_state.get(chat_id, None) is None:
+            with metrics.track_upstream(self.__storage.name, "get"):
+                pickled_state = self.__storage.load(chat_id)
+            metrics.record_cache_lookup("user_state", hit=False)
+            if pickled_state is not None:
+                self.users_state[chat_id] = pickle.loads(pickled_state)
+                logger.debug(
+                    f"Loaded {type(self.users_state[chat_id]).__name__} for user id({chat_id}) from persistent storage"
+                )
+        else:
+            metrics.record_cache_lookup("user_state", hit=True)
 
-        if not (
-            new_state := self.users_state[chat_id].handle_input(
+        with metrics.track_state(self.users_state[chat_id], "handle_input"):
+            transition = self.users_state[chat_id].handle_input(
                 update, context, self.__moltin_client, self.__jinja
             )
-        ):
+        if not transition:
             logger.debug("No valid input from user id({chat_id})")
             # User input didn't cause state transition
             return
 
-        if new_state == StateMachine.INITIAL_STATE:
-            new_state = self.__initial_state()
+        state_name = type(self.users_state[chat_id]).__name__
+        try:
+            new_state = self.__registry.create_state(state_name, transition)
+        except ValueError:
+            logger.exception(f"Failed to switch user id({chat_id})")
+            return
 
         # Clean up previous state
-        self.users_state[chat_id].clean_up(update, context)
+        with metrics.track_state(self.users_state[chat_id], "clean_up"):
+            self.users_state[chat_id].clean_up(update, context)
 
         # Set, prepare and save new state message
         logger.debug(f"Switching user({chat_id}) to {type(new_state).__name__}...")
+        tracing.annotate(state=state_name, new_state=type(new_state).__name__)
         self.users_state[chat_id] = new_state
-        self.users_state[chat_id].prepare_state(
-            update, context, self.__moltin_client, self.__jinja
-        )
+        with metrics.track_state(new_state, "prepare_state"):
+            new_state.prepare_state(update, context, self.__moltin_client, self.__jinja)
+        self.__prefetch(chat_id, new_state)
         logger.debug(f"Done! Pickling state and saving in persistent storage...")
-        self.__redis.set(chat_id, pickle.dumps(self.users_state[chat_id]))
+        with metrics.track_upstream(self.__storage.name, "set"):
+            self.__storage.save(chat_id, pickle.dumps(new_state))
         logger.debug("Done!")
+        self.__record_transition(chat_id, state_name, new_state, started_at)
@@ -0,0 +1,241 @@
+import threading
+from abc import ABC, abstractmethod
+from argparse import ArgumentParser
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import redis
+from environs import Env
+
+
+class StateStorage(ABC):
+    """Persistent storage of pickled user states keyed by chat id"""
+
+    name = None
+
+    @abstractmethod
+    def load(self, chat_id) -> Optional[bytes]:
+        """Get saved state of the chat.
+
+        Returns:
+            bytes: pickled state, `None` if there is no state saved
+        """
+
+    @abstractmethod
+    def save(self, chat_id, state: bytes):
+        """Save pickled state of the chat"""
+
+    @abstractmethod
+    def load_many(self, chat_ids: Iterable[int]) -> Dict[int, bytes]:
+        """Get saved states of several chats at once.
+
+        Returns:
+            dict: pickled states by chat id, chats without state are omitted
+        """
+
+    @abstractmethod
+    def save_many(self, states: Dict[int, bytes]):
+        """Save pickled states of several chats at once"""
+
+    @abstractmethod
+    def iter_chat_ids(
+        self, batch_size=500, position=None
+    ) -> Iterator[Tuple[List[int], Optional[int]]]:
+        """Iterate over chat ids with saved state in batches.
+
+        Args:
+            position: position yielded with a previous batch to resume
+                after it, `None` to start from the beginning
+
+        Yields:
+            tuple: batch of chat ids, possibly empty, and position after it,
+                `None` after the last batch
+        """
+
+    def close(self):
+        pass
+
+
+class RedisStateStorage(StateStorage):
+    """States kept in Redis under bare chat id keys"""
+
+    name = "redis"
+
+    def __init__(self, redis_connection):
+        self.__redis = redis_connection
+
+    def load(self, chat_id):
+        return self.__redis.get(chat_id)
+
+    def save(self, chat_id, state):
+        self.__redis.set(chat_id, state)
+
+    def load_many(self, chat_ids):
+        chat_ids = list(chat_ids)
+        if not chat_ids:
+            return {}
+        return {
+            chat_id: state
+            for chat_id, state in zip(chat_ids, self.__redis.mget(chat_ids))
+            if state is not None
+        }
+
+    def save_many(self, states):
+        if states:
+            self.__redis.mset(states)
+
+    def iter_chat_ids(self, batch_size=500, position=None):
+        # Position is SCAN cursor
+        cursor = position if position else 0
+        while True:
+            cursor, keys = self.__redis.scan(cursor, match="[1-9]*", count=batch_size)
+            chat_ids = [int(key) for key in keys if key.isdigit()]
+            yield chat_ids, cursor if cursor else None
+            if cursor == 0:
+                return
+
+
+class SqliteStateStorage(StateStorage):
+    """States kept in a local SQLite database in WAL mode.
+
+    Suits single-node deployments: reads do not leave the process and do
+    not wait for writes. Every thread gets its own connection. With
+    `synchronous=NORMAL` states saved right before a power loss, but not
+    before a process crash, may be lost.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path, busy_timeout=5.0):
+        self.__path = path
+        self.__busy_timeout = busy_timeout
+        self.__local = threading.local()
+        self.__connections = []
+        self.__lock = threading.Lock()
+        with self.__connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS states "
+                "(chat_id INTEGER PRIMARY KEY, state BLOB NOT NULL)"
+            )
+
+    def __connect(self):
+        connection = getattr(self.__local, "connection", None)
+        if connection is None:
+            # Imported on first use, most deployments keep states in Redis
+            import sqlite3
+
+            connection = sqlite3.connect(
+                self.__path,
+                timeout=self.__busy_timeout,
+                isolation_level=None,
+                check_same_thread=False,
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.__local.connection = connection
+            with self.__lock:
+                self.__connections.append(connection)
+        return connection
+
+    def load(self, chat_id):
+        row = (
+            self.__connect()
+            .execute("SELECT state FROM states WHERE chat_id = ?", (chat_id,))
+            .fetchone()
+        )
+        return row[0] if row else None
+
+    def save(self, chat_id, state):
+        self.__connect().execute(
+            "INSERT OR REPLACE INTO states (chat_id, state) VALUES (?, ?)",
+            (chat_id, state),
+        )
+
+    def load_many(self, chat_ids):
+        chat_ids = list(chat_ids)
+        states = {}
+        connection = self.__connect()
+        # Stay below SQLite limit of host parameters per statement
+        for start in range(0, len(chat_ids), 500):
+            batch = chat_ids[start : start + 500]
+            params = ", ".join("?" * len(batch))
+            query = f"SELECT chat_id, state FROM states WHERE chat_id IN ({params})"
+            states.update(connection.execute(query, batch))
+        return states
+
+    def save_many(self, states):
+        connection = self.__connect()
+        connection.execute("BEGIN")
+        try:
+            connection.executemany(
+                "INSERT OR REPLACE INTO states (chat_id, state) VALUES (?, ?)",
+                states.items(),
+            )
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def iter_chat_ids(self, batch_size=500, position=None):
+        # Position is the last chat id of the previous batch
+        connection = self.__connect()
+        while True:
+            if position is None:
+                rows = connection.execute(
+                    "SELECT chat_id FROM states ORDER BY chat_id LIMIT ?",
+                    (batch_size,),
+                )
+            else:
+                rows = connection.execute(
+                    "SELECT chat_id FROM states WHERE chat_id > ? "
+                    "ORDER BY chat_id LIMIT ?",
+                    (position, batch_size),
+                )
+            chat_ids = [row[0] for row in rows]
+            if len(chat_ids) < batch_size:
+                yield chat_ids, None
+                return
+            position = chat_ids[-1]
+            yield chat_ids, position
+
+    def close(self):
+        with self.__lock:
+            connections, self.__connections = self.__connections, []
+        for connection in connections:
+            connection.close()
+
+
+def create_state_storage(redis_connection, path=None) -> StateStorage:
+    """Get SQLite storage if database `path` is given, Redis one otherwise"""
+    if path:
+        return SqliteStateStorage(path)
+    return RedisStateStorage(redis_connection)
+
+
+def main():
+    parser = ArgumentParser(description="Copy user states from Redis to SQLite")
+    parser.add_argument("path", type=str, help="SQLite database file")
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    env = Env()
+    env.read_env()
+
+    source = RedisStateStorage(
+        redis.Redis(
+            host=env("REDIS_HOST"),
+            port=env("REDIS_PORT"),
+            password=env("REDIS_PASSWORD"),
+        )
+    )
+    target = SqliteStateStorage(args.path)
+    copied = 0
+    for chat_ids, _ in source.iter_chat_ids(batch_size=args.batch_size):
+        states = source.load_many(chat_ids)
+        target.save_many(states)
+        copied += len(states)
+    target.close()
+    print(f"Copied {copied} states to {args.path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,29 @@
+import functools
 import os
 import requests
-from geopy import distance
 from jinja2 import Environment
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice
 from telegram.constants import PARSEMODE_HTML
 from telegram.ext import CallbackContext
 
+import metrics
+from invoices import get_cart_hash
+from models import Restaurant
 from moltin_api import SimpleMoltinApiClient
-from state_machine import State, StateMachine
+from state_machine import State, StateMachine, StateRegistry, Transition
+from template_loader import render_static
+
+
+# States and their transitions, the state machine creates states through it
+registry = StateRegistry()
+
+
+def restore_restaurant(state, attribute):
+    """Convert restaurant of a state pickled before restaurants became
+    models, when it was a raw flow entry"""
+    if isinstance(restaurant := state.get(attribute), dict):
+        state[attribute] = Restaurant.from_api(restaurant)
+    return state
 
 
 def chunks(lst, n):
@@ -16,6 +32,24 @@ def chunks(lst, n):
         yield lst[i : i + n]
 
 
+def get_prices(update, context, moltin):
+    """Get catalog price table and currency to show prices to the user in.
+
+    Returns:
+        tuple: `PriceTable` and currency code, both None until the catalog
+            is loaded
+    """
+    prices = moltin.get_price_table()
+    if not prices:
+        return None, None
+    currency = prices.select_currency(
+        update.effective_user.language_code,
+        context.bot_data.get("currency_by_language"),
+    )
+    return prices, currency
+
+
+@metrics.timed_upstream("geocoder")
 def fetch_coordinates(apikey, address):
     base_url = "https://geocode-maps.yandex.ru/1.x"
     response = requests.get(
@@ -37,18 +71,7 @@ def fetch_coordinates(apikey, address):
     return float(lon), float(lat)
 
 
-def remind_customer(context: CallbackContext):
-    job = context.job
-    message_template = job.context["jinja_env"].get_template(
-        "customer_reminder_message.html"
-    )
-    context.bot.send_message(
-        chat_id=job.context["chat_id"],
-        text=message_template.render(),
-        parse_mode=PARSEMODE_HTML,
-    )
-
-
+@registry.register("MenuState", "PizzaDescriptionState", "CartState", "DeliveryState")
 class MenuState(State):
     def __init__(self, menu_page=None):
         self.__page = menu_page if menu_page else 0
@@ -56,10 +79,17 @@ class MenuState(State):
     def prepare_state(self, update, context, moltin, jinja):
         self.__chat_id = update.effective_chat.id
         products = moltin.get_products()
-        cart_items, total_price = moltin.get_cart_and_full_price(self.__chat_id)
-        cart_items_mapped = {
-            item["product_id"]: item["quantity"] for item in cart_items
-        }
+        cart_items, total_price = moltin.get_cart_and_full_price(
+            self.__chat_id, optimistic=True
+        )
+        cart_items_mapped = {item.product_id: item.quantity for item in cart_items}
+        prices, currency = get_prices(update, context, moltin)
+        if prices:
+            total_price = prices.format(
+                prices.get_total(cart_items, currency), currency
+            )
+        else:
+            total_price = f"{total_price} Р"
 
         inline_keyboard = []
         for product_name, product_id in products.items():
@@ -73,8 +103,12 @@ class MenuState(State):
             )
 
         per_page = 8
+        self.__page_product_ids = list(products.values())
 
         if len(inline_keyboard) > per_page:
+            self.__page_product_ids = self.__page_product_ids[
+                self.__page * per_page : self.__page * per_page + per_page
+            ]
             navigation_row = []
             if self.__page > 0:
                 navigation_row.append(
@@ -94,29 +128,43 @@ class MenuState(State):
             )
             if navigation_row:
                 inline_keyboard.append(navigation_row)
+            if "catalog_search" in context.bot_data:
+                inline_keyboard.append(
+                    [
+                        InlineKeyboardButton(
+                            "Поиск по меню", switch_inline_query_current_chat=""
+                        )
+                    ]
+                )
         else:
             inline_keyboard = list(chunks(inline_keyboard, 1))
 
         inline_keyboard.append(
             [
                 InlineKeyboardButton(
-                    f"Корзина ({total_price} Р)" if cart_items else "Корзина (пусто)",
+                    f"Корзина ({total_price})" if cart_items else "Корзина (пусто)",
                     callback_data="cart",
                 ),
                 InlineKeyboardButton("Оформить заказ", callback_data="order"),
             ]
         )
 
-        message_template = jinja.get_template("menu_message.html")
-
         self.__message_id = context.bot.send_message(
             chat_id=self.__chat_id,
-            text=message_template.render(),
+            text=render_static(jinja, "menu_message.html"),
             parse_mode=PARSEMODE_HTML,
             reply_markup=InlineKeyboardMarkup(inline_keyboard),
         ).message_id
 
     def handle_input(self, update, context, moltin, jinja):
+        via_bot = update.message.via_bot if update.message else None
+        if via_bot and via_bot.id == context.bot.id:
+            # Product picked in inline search results
+            product_id = moltin.get_products().get(update.message.text)
+            if not product_id:
+                return None
+            return Transition("PizzaDescriptionState", {"product_id": product_id})
+
         if not update.callback_query:
             return None
 
@@ -124,29 +172,41 @@ class MenuState(State):
         update.callback_query.answer()
 
         if user_input == "cart":
-            return CartState()
+            return Transition("CartState")
         if user_input == "order":
-            return DeliveryState()
+            return Transition("DeliveryState")
         if user_input == "next_page":
-            return MenuState(menu_page=self.__page + 1)
+            return Transition("MenuState", {"menu_page": self.__page + 1})
         if user_input == "prev_page":
-            return MenuState(menu_page=self.__page - 1)
-        return PizzaDescriptionState(user_input)
+            return Transition("MenuState", {"menu_page": self.__page - 1})
+        return Transition("PizzaDescriptionState", {"product_id": user_input})
+
+    def get_prefetch_tasks(self, moltin):
+        return [
+            functools.partial(moltin.get_products_with_images, self.__page_product_ids)
+        ]
 
     def clean_up(self, update: Update, context: CallbackContext):
         context.bot.delete_message(chat_id=self.__chat_id, message_id=self.__message_id)
 
 
+@registry.register(StateMachine.INITIAL_STATE)
 class PizzaDescriptionState(State):
+    __unit_price = None
+
     def __init__(self, product_id):
         self.__product_id = product_id
 
     def prepare_state(self, update, context, moltin, jinja):
         self.__chat_id = update.effective_chat.id
-        product = moltin.get_product_by_id(self.__product_id)
-        image_url = moltin.get_image_url_by_file_id(
-            product["relationships"]["main_image"]["data"]["id"]
-        )
+        product, image_url = moltin.get_product_with_image(self.__product_id)
+        self.__unit_price = product.price
+        prices, currency = get_prices(update, context, moltin)
+        price = prices.get_price(self.__product_id, currency) if prices else None
+        if price is not None:
+            price = prices.format(price, currency)
+        else:
+            price = f"{product.price} {product.currency}"
 
         inline_keyboard = [
             [
@@ -160,7 +220,7 @@ class PizzaDescriptionState(State):
         self.__message_id = context.bot.send_photo(
             chat_id=self.__chat_id,
             photo=image_url,
-            caption=message_template.render(product=product),
+            caption=message_template.render(product=product, price=price),
             parse_mode=PARSEMODE_HTML,
             reply_markup=InlineKeyboardMarkup(inline_keyboard),
         ).message_id
@@ -173,11 +233,13 @@ class PizzaDescriptionState(State):
 
         if user_input == "menu":
             update.callback_query.answer()
-            return StateMachine.INITIAL_STATE
+            return Transition(StateMachine.INITIAL_STATE)
         if user_input == "add_to_cart":
-            moltin.add_product_to_cart(self.__chat_id, self.__product_id, 1)
+            moltin.add_product_to_cart(
+                self.__chat_id, self.__product_id, 1, unit_price=self.__unit_price
+            )
             update.callback_query.answer(text="Товар добавлен в корзину")
-            return StateMachine.INITIAL_STATE
+            return Transition(StateMachine.INITIAL_STATE)
 
     def clean_up(self, update: Update, context: CallbackContext):
         context.bot.edit_message_reply_markup(
@@ -185,12 +247,32 @@ class PizzaDescriptionState(State):
         )
 
 
+@registry.register("CartState", "DeliveryState", StateMachine.INITIAL_STATE)
 class CartState(State):
     def prepare_state(self, update, context, moltin, jinja):
         self.__chat_id = update.effective_chat.id
-        cart_items, total_price = moltin.get_cart_and_full_price(self.__chat_id)
+        # Removals are shown before they are sent, so they can be merged
+        cart_items, total_price = moltin.get_cart_and_full_price(
+            self.__chat_id, optimistic=True, complete_items=True
+        )
+        self.__total_price = total_price
+        prices, currency = get_prices(update, context, moltin)
+        if prices:
+            cart_items = [
+                item.replace(
+                    formatted_amount=prices.format(
+                        prices.get_item_amount(item, currency), currency
+                    )
+                )
+                for item in cart_items
+            ]
+            total_price = prices.format(
+                prices.get_total(cart_items, currency), currency
+            )
+        else:
+            total_price = f"{total_price} Р"
         inline_keyboard = [
-            InlineKeyboardButton(f"Убрать \"{item['name']}\"", callback_data=item["id"])
+            InlineKeyboardButton(f'Убрать "{item.name}"', callback_data=item.id)
             for item in cart_items
         ]
         inline_keyboard = list(chunks(inline_keyboard, 2))
@@ -219,27 +301,29 @@ class CartState(State):
 
         if user_input == "order":
             update.callback_query.answer()
-            return DeliveryState()
+            return Transition("DeliveryState")
         if user_input == "menu":
             update.callback_query.answer()
-            return StateMachine.INITIAL_STATE
+            return Transition(StateMachine.INITIAL_STATE)
         update.callback_query.answer(text="Корзина обновлена")
         moltin.remove_product_from_cart(self.__chat_id, user_input)
-        return CartState()
+        return Transition("CartState")
+
+    def get_event_attributes(self):
+        return {"cart_total": self.__total_price}
 
     def clean_up(self, update: Update, context: CallbackContext):
         context.bot.delete_message(chat_id=self.__chat_id, message_id=self.__message_id)
 
 
+@registry.register("ConfirmAddressState")
 class DeliveryState(State):
     def prepare_state(self, update, context, moltin, jinja):
         self.__chat_id = update.effective_chat.id
 
-        message_template = jinja.get_template("arrange_delivery_message.html")
-
         context.bot.send_message(
             chat_id=self.__chat_id,
-            text=message_template.render(),
+            text=render_static(jinja, "arrange_delivery_message.html"),
             parse_mode=PARSEMODE_HTML,
         )
 
@@ -249,7 +333,10 @@ class DeliveryState(State):
 
         if update.message.location:
             user_input = update.message.location
-            return ConfirmAddressState(user_input.longitude, user_input.latitude)
+            return Transition(
+                "ConfirmAddressState",
+                {"lon": user_input.longitude, "lat": user_input.latitude},
+            )
 
         if not update.message.text:
             return None
@@ -263,28 +350,53 @@ class DeliveryState(State):
                 parse_mode=PARSEMODE_HTML,
             )
             return None
-        return ConfirmAddressState(*coords)
+        lon, lat = coords
+        return Transition("ConfirmAddressState", {"lon": lon, "lat": lat})
 
+    def get_prefetch_tasks(self, moltin):
+        return [moltin.get_restaurants]
 
+
+@registry.register("PaymentInquiryState", "DeliveryState", StateMachine.INITIAL_STATE)
 class ConfirmAddressState(State):
+    # Default for states saved before it was kept in it
+    __distance = None
+
     def __init__(self, lon, lat):
         self.__lon = lon
         self.__lat = lat
 
+    def __setstate__(self, state):
+        self.__dict__.update(
+            restore_restaurant(state, "_ConfirmAddressState__closest_restaurant")
+        )
+
     def __get_distance_to_restaurant(self, restaurant):
+        # Imported on first use, it takes a noticeable part of startup
+        from geopy import distance
+
         return distance.distance(
             (self.__lon, self.__lat),
-            (restaurant["restaurant-lon"], restaurant["restaurant-lat"]),
+            (restaurant.lon, restaurant.lat),
         )
 
     def prepare_state(self, update, context, moltin, jinja):
         self.__chat_id = update.effective_chat.id
-        restaurants = moltin.get_flow_entries(flow_slug="restaurant")
+        restaurants = moltin.get_restaurants()
         self.__closest_restaurant = min(
             restaurants, key=self.__get_distance_to_restaurant
         )
         distance = self.__get_distance_to_restaurant(self.__closest_restaurant).km
+        self.__distance = round(distance, 2)
+        # Delivery fees are in Moltin store currency units
         self.__delivery_price = 0 if distance <= 0.5 else 100 if distance <= 5 else 300
+        prices, currency = get_prices(update, context, moltin)
+        if prices:
+            delivery_price = prices.format(
+                prices.convert(self.__delivery_price, currency), currency
+            )
+        else:
+            delivery_price = f"{self.__delivery_price} Р"
 
         delivery_options_row = [
             InlineKeyboardButton("Самовывоз", callback_data="pick_up")
@@ -292,7 +404,7 @@ class ConfirmAddressState(State):
         if distance <= 20:
             delivery_options_row.append(
                 InlineKeyboardButton(
-                    f"Заказать доставку ( +{self.__delivery_price}р. )",
+                    f"Заказать доставку ( +{delivery_price} )",
                     callback_data="request_delivery",
                 )
             )
@@ -311,8 +423,9 @@ class ConfirmAddressState(State):
         self.__message_id = context.bot.send_message(
             chat_id=self.__chat_id,
             text=message_template.render(
-                address=self.__closest_restaurant["restaurant-address"],
+                address=self.__closest_restaurant.address,
                 distance=distance,
+                delivery_price=delivery_price,
             ),
             parse_mode=PARSEMODE_HTML,
             reply_markup=InlineKeyboardMarkup(inline_keyboard),
@@ -325,18 +438,37 @@ class ConfirmAddressState(State):
         update.callback_query.answer()
         user_input = update.callback_query.data
         if user_input == "pick_up":
-            return PaymentInquiryState(self.__closest_restaurant)
+            return Transition(
+                "PaymentInquiryState",
+                {
+                    "serving_restaurant": self.__closest_restaurant,
+                    "distance": self.__distance,
+                },
+            )
         if user_input == "request_delivery":
             customer_coords = {"lon": self.__lon, "lat": self.__lat}
-            return PaymentInquiryState(
-                self.__closest_restaurant,
-                delivery_price=self.__delivery_price,
-                customer_coords=customer_coords,
+            return Transition(
+                "PaymentInquiryState",
+                {
+                    "serving_restaurant": self.__closest_restaurant,
+                    "delivery_price": self.__delivery_price,
+                    "customer_coords": customer_coords,
+                    "distance": self.__distance,
+                },
             )
         if user_input == "menu":
-            return StateMachine.INITIAL_STATE
+            return Transition(StateMachine.INITIAL_STATE)
         if user_input == "change_address":
-            return DeliveryState()
+            return Transition("DeliveryState")
+
+    def get_prefetch_tasks(self, moltin):
+        return [functools.partial(moltin.get_cart_and_full_price, self.__chat_id)]
+
+    def get_event_attributes(self):
+        return {
+            "restaurant": self.__closest_restaurant.id,
+            "distance_km": self.__distance,
+        }
 
     def clean_up(self, update: Update, context: CallbackContext):
         context.bot.edit_message_reply_markup(
@@ -344,45 +476,89 @@ class ConfirmAddressState(State):
         )
 
 
+@registry.register(StateMachine.INITIAL_STATE)
 class PaymentInquiryState(State):
-    def __init__(self, serving_restaurant, delivery_price=0, customer_coords=None):
+    # Defaults for states saved before these were kept in it
+    __cart_items = None
+    __distance = None
+    __total_price = None
+
+    def __init__(
+        self,
+        serving_restaurant,
+        delivery_price=0,
+        customer_coords=None,
+        distance=None,
+    ):
         self.__restaurant = serving_restaurant
         self.__delivery_price = delivery_price
         self.__customer_coords = customer_coords
+        self.__distance = distance
+
+    def __setstate__(self, state):
+        self.__dict__.update(
+            restore_restaurant(state, "_PaymentInquiryState__restaurant")
+        )
 
     def prepare_state(self, update, context, moltin, jinja):
         self.__chat_id = update.effective_chat.id
         cart_items, total_price = moltin.get_cart_and_full_price(self.__chat_id)
         total_price = int(total_price) + self.__delivery_price
+        self.__total_price = total_price
+        self.__cart_items = self.__get_order_items(cart_items)
+
+        prices, currency = get_prices(update, context, moltin)
+        if prices:
+            labeled_prices = [
+                LabeledPrice(item.name, prices.get_item_amount(item, currency))
+                for item in cart_items
+            ]
+            delivery_amount = prices.convert(self.__delivery_price, currency)
+            formatted_items = [
+                item.replace(formatted_amount=prices.format(price.amount, currency))
+                for item, price in zip(cart_items, labeled_prices)
+            ]
+            formatted_total = prices.format(
+                sum(price.amount for price in labeled_prices) + delivery_amount,
+                currency,
+            )
+            formatted_delivery = prices.format(delivery_amount, currency)
+        else:
+            # Amounts of Moltin store currency are whole rubles
+            currency = "RUB"
+            labeled_prices = [
+                LabeledPrice(item.name, int(item.amount) * 100) for item in cart_items
+            ]
+            delivery_amount = self.__delivery_price * 100
+            formatted_items = cart_items
+            formatted_total = f"{total_price} Р"
+            formatted_delivery = f"{self.__delivery_price} Р"
+        if self.__delivery_price:
+            labeled_prices.append(LabeledPrice("Доставка", delivery_amount))
 
         message_template = jinja.get_template("payment_message.html")
 
         self.__message_id = context.bot.send_message(
             chat_id=self.__chat_id,
             text=message_template.render(
-                cart_items=cart_items,
-                total_price=total_price,
+                cart_items=formatted_items,
+                total_price=formatted_total,
                 delivery_ordered=(self.__customer_coords is not None),
-                restaurant_address=self.__restaurant["restaurant-address"],
-                delivery_price=self.__delivery_price,
+                restaurant_address=self.__restaurant.address,
+                delivery_price=formatted_delivery,
             ),
             parse_mode=PARSEMODE_HTML,
         ).message_id
 
         title = "Заказ Пиццы"
         description = "Описание заказа в сообщении выше"
-        payload = "Custom-Payload"
         provider_token = os.getenv("TELEGRAM_PAYMENT_TOKEN")
-        currency = "rub"
-        prices = [
-            LabeledPrice(
-                item["name"],
-                int(item["meta"]["display_price"]["with_tax"]["value"]["amount"]) * 100,
-            )
-            for item in cart_items
-        ]
-        if self.__delivery_price:
-            prices.append(LabeledPrice("Доставка", self.__delivery_price * 100))
+        payload = context.bot_data["invoices"].register(
+            self.__chat_id,
+            currency,
+            sum(price.amount for price in labeled_prices),
+            get_cart_hash(cart_items),
+        )
 
         self.__invoice_id = context.bot.send_invoice(
             self.__chat_id,
@@ -391,73 +567,66 @@ class PaymentInquiryState(State):
             payload,
             provider_token,
             currency,
-            prices,
+            labeled_prices,
         ).message_id
 
+    @staticmethod
+    def __get_order_items(cart_items):
+        return [{"name": item.name, "quantity": item.quantity} for item in cart_items]
+
     def handle_input(self, update, context, moltin, jinja):
-        if update.message and update.message.successful_payment:
-            if self.__customer_coords:
-                # Save customer address data and notify courier
-
-                moltin.create_flow_entry(
-                    "customer-address",
-                    telegram_id=self.__chat_id,
-                    lon=self.__customer_coords["lon"],
-                    lat=self.__customer_coords["lat"],
-                )
+        if update.message and (payment := update.message.successful_payment):
+            if self.__cart_items is None:
                 cart_items, _ = moltin.get_cart_and_full_price(self.__chat_id)
-                message_template = jinja.get_template(
-                    "courier_notification_message.html"
-                )
-                context.bot.send_message(
-                    chat_id=self.__chat_id,
-                    text=message_template.render(
-                        cart_items=cart_items,
-                        restaurant_address=self.__restaurant["restaurant-address"],
-                    ),
-                    parse_mode=PARSEMODE_HTML,
-                )
-                context.bot.send_location(
-                    chat_id=self.__restaurant["restaurant-courier"],
-                    longitude=self.__customer_coords["lon"],
-                    latitude=self.__customer_coords["lat"],
-                )
-
-                order_deadline_seconds = 3600
-                context.job_queue.run_once(
-                    remind_customer,
-                    order_deadline_seconds,
-                    context={
-                        "chat_id": self.__chat_id,
-                        "jinja_env": jinja,
+                self.__cart_items = self.__get_order_items(cart_items)
+            context.bot_data["fulfillment"].enqueue(
+                {
+                    "order_id": payment.telegram_payment_charge_id,
+                    "chat_id": self.__chat_id,
+                    "restaurant_id": self.__restaurant.id,
+                    "restaurant_address": self.__restaurant.address,
+                    "restaurant_coords": {
+                        "lon": self.__restaurant.lon,
+                        "lat": self.__restaurant.lat,
                     },
+                    "restaurant_courier": self.__restaurant.courier,
+                    "customer_coords": self.__customer_coords,
+                    "cart_items": self.__cart_items,
+                }
+            )
+            moltin.discard_cart(self.__chat_id)
+            if event_log := context.bot_data.get("event_log"):
+                event_log.record(
+                    "order",
+                    self.__chat_id,
+                    order=payment.telegram_payment_charge_id,
+                    **self.get_event_attributes(),
                 )
 
             context.bot.send_message(
                 chat_id=update.effective_chat.id,
                 text="Платеж прошел, спасибо!",
             )
-            moltin.flush_cart(self.__chat_id)
 
-            return StateMachine.INITIAL_STATE
+            return Transition(StateMachine.INITIAL_STATE)
 
         if not (query := update.pre_checkout_query):
             return None
 
-        if query.invoice_payload != "Custom-Payload":
-            query.answer(ok=False, error_message="Что-то пошло не так...")
-            context.bot.send_message(
-                chat_id=query.from_user.id,
-                text="Похоже возникла проблема при оплате. Вы можете попробовать еще раз.",
-            )
-            return StateMachine.INITIAL_STATE
-
-        query.answer(ok=True)
+        # Query is answered by InvoiceRegistry, only rejected ones get here
         context.bot.send_message(
-            chat_id=query.from_user.id, text="Обрабатываем Ваш платеж..."
+            chat_id=query.from_user.id,
+            text="Похоже возникла проблема при оплате. Вы можете попробовать еще раз.",
         )
-
-        return None
+        return Transition(StateMachine.INITIAL_STATE)
+
+    def get_event_attributes(self):
+        return {
+            "cart_total": self.__total_price,
+            "restaurant": self.__restaurant.id,
+            "distance_km": self.__distance,
+            "delivery": self.__customer_coords is not None,
+        }
 
     def clean_up(self, update: Update, context: CallbackContext):
         context.bot.delete_message(chat_id=self.__chat_id, message_id=self.__invoice_id)
@@ -0,0 +1,85 @@
+from argparse import ArgumentParser
+
+from jinja2 import Environment, FileSystemLoader, ModuleLoader, select_autoescape
+
+import metrics
+
+
+TEMPLATES_DIR = "./templates/"
+
+
+def create_jinja_env(
+    templates_dir=TEMPLATES_DIR, compiled_templates_dir=None, production=False
+):
+    """Create jinja environment for bot messages.
+
+    In production mode auto reload is disabled and every template is
+    loaded once at startup, so no filesystem checks happen on render.
+    If `compiled_templates_dir` is given, templates are loaded from modules
+    prepared in advance with `compile_templates`.
+    """
+    source_loader = FileSystemLoader(templates_dir)
+    loader = (
+        ModuleLoader(compiled_templates_dir)
+        if compiled_templates_dir
+        else source_loader
+    )
+    jinja_env = Environment(
+        loader=loader,
+        autoescape=select_autoescape(),
+        auto_reload=not production,
+        cache_size=-1 if production else 400,
+    )
+
+    if production:
+        for template_name in source_loader.list_templates():
+            jinja_env.get_template(template_name)
+
+    return jinja_env
+
+
+def compile_templates(target_dir, templates_dir=TEMPLATES_DIR):
+    jinja_env = Environment(
+        loader=FileSystemLoader(templates_dir), autoescape=select_autoescape()
+    )
+    jinja_env.compile_templates(target_dir, zip=None)
+
+
+_static_renders = {}
+
+
+def render_static(jinja_env: Environment, template_name):
+    """Render template that takes no context.
+    Result is memoized unless environment is set to auto reload templates."""
+    if jinja_env.auto_reload:
+        return jinja_env.get_template(template_name).render()
+
+    key = (jinja_env, template_name)
+    rendered = _static_renders.get(key)
+    metrics.record_cache_lookup("static_render", hit=rendered is not None)
+    if rendered is None:
+        rendered = _static_renders[key] = jinja_env.get_template(template_name).render()
+    return rendered
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument(
+        "target", type=str, help="Directory to write precompiled template modules to"
+    )
+    parser.add_argument(
+        "-T",
+        "--templates-dir",
+        type=str,
+        default=TEMPLATES_DIR,
+        help="Directory with source templates",
+    )
+
+    args = parser.parse_args()
+
+    compile_templates(args.target, templates_dir=args.templates_dir)
+    print(f"Templates compiled into {args.target}")
+
+
+if __name__ == "__main__":
+    main()
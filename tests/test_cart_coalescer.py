@@ -0,0 +1,178 @@
+import unittest
+
+from cart_coalescer import CoalescingCartClient
+from models import CartItem
+
+
+class StubMoltinClient:
+    """Moltin client recording cart calls, the first `failures` of which
+    raise"""
+
+    def __init__(self, failures=0, cart_items=()):
+        self.calls = []
+        self.failures = failures
+        self.cart_items = list(cart_items)
+
+    def __record(self, *call):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("Moltin is down")
+        self.calls.append(call)
+
+    def add_product_to_cart(self, cart_id, product_id, quantity, currency=None):
+        self.__record("add", cart_id, product_id, quantity, currency)
+
+    def add_products_to_cart(self, cart_id, quantities, currency=None):
+        self.__record("add_many", cart_id, quantities, currency)
+
+    def remove_product_from_cart(self, cart_id, item_id):
+        self.__record("remove", cart_id, item_id)
+
+    def flush_cart(self, cart_id):
+        self.__record("flush", cart_id)
+
+    def get_cart_and_full_price(self, cart_id):
+        self.calls.append(("get", cart_id))
+        return list(self.cart_items), sum(item.amount for item in self.cart_items)
+
+
+class CoalescingCartClientTest(unittest.TestCase):
+    # Long enough for timers never to fire during a test, carts are flushed
+    # explicitly
+    WINDOW = 60
+
+    def make_client(self, moltin, max_attempts=5):
+        client = CoalescingCartClient(
+            moltin, window=self.WINDOW, max_attempts=max_attempts
+        )
+        self.addCleanup(self.cancel_timers, client)
+        return client
+
+    @staticmethod
+    def cancel_timers(client):
+        for cart in client._CoalescingCartClient__carts.values():
+            if cart.timer:
+                cart.timer.cancel()
+
+    def test_additions_are_merged_in_one_bulk_call(self):
+        moltin = StubMoltinClient()
+        client = self.make_client(moltin)
+
+        client.add_product_to_cart(1, "margherita", 1, currency="RUB")
+        client.add_product_to_cart(1, "pepperoni", 1, currency="RUB")
+        client.add_product_to_cart(1, "margherita", 2, currency="RUB")
+        self.assertEqual(moltin.calls, [])
+        client.flush(1)
+
+        self.assertEqual(
+            moltin.calls,
+            [("add_many", 1, {"margherita": 3, "pepperoni": 1}, "RUB")],
+        )
+
+    def test_single_product_is_added_with_plain_call(self):
+        moltin = StubMoltinClient()
+        client = self.make_client(moltin)
+
+        client.add_product_to_cart(1, "margherita", 1, currency="RUB")
+        client.add_product_to_cart(1, "margherita", 1, currency="RUB")
+        client.flush(1)
+
+        self.assertEqual(moltin.calls, [("add", 1, "margherita", 2, "RUB")])
+
+    def test_failed_mutations_stay_pending_until_sent(self):
+        moltin = StubMoltinClient(failures=2)
+        client = self.make_client(moltin)
+
+        client.remove_product_from_cart(1, "item-1")
+        client.add_product_to_cart(1, "margherita", 1, currency="RUB")
+        client.flush(1)
+        client.flush(1)
+        self.assertEqual(moltin.calls, [])
+        client.flush(1)
+        client.flush(1)
+
+        self.assertEqual(
+            moltin.calls,
+            [("remove", 1, "item-1"), ("add", 1, "margherita", 1, "RUB")],
+        )
+
+    def test_retry_is_scheduled_with_growing_delay(self):
+        moltin = StubMoltinClient(failures=2)
+        client = self.make_client(moltin)
+        client.add_product_to_cart(1, "margherita", 1, currency="RUB")
+        carts = client._CoalescingCartClient__carts
+
+        client.flush(1)
+        self.assertEqual(carts[1].timer.interval, self.WINDOW * 2)
+        client.flush(1)
+        self.assertEqual(carts[1].timer.interval, self.WINDOW * 4)
+
+    def test_pending_mutations_are_dropped_after_max_attempts(self):
+        moltin = StubMoltinClient(failures=3)
+        client = self.make_client(moltin, max_attempts=3)
+
+        client.add_product_to_cart(1, "margherita", 1, currency="RUB")
+        with self.assertLogs("pizza_bot", "ERROR"):
+            for _ in range(3):
+                client.flush(1)
+        client.flush(1)
+
+        self.assertEqual(moltin.calls, [])
+        self.assertEqual(client.get_cart_and_full_price(1, optimistic=True), ([], 0))
+
+    def test_discard_drops_earlier_mutations_and_flushes_first(self):
+        moltin = StubMoltinClient()
+        client = self.make_client(moltin)
+
+        client.add_product_to_cart(1, "margherita", 1, currency="RUB")
+        client.remove_product_from_cart(1, "item-1")
+        client.discard_cart(1)
+        client.add_product_to_cart(1, "pepperoni", 1, currency="RUB")
+        self.assertEqual(
+            client.get_cart_and_full_price(1, optimistic=True),
+            ([CartItem(product_id="pepperoni", quantity=1)], 0),
+        )
+        client.flush(1)
+
+        self.assertEqual(
+            moltin.calls,
+            [("get", 1), ("flush", 1), ("add", 1, "pepperoni", 1, "RUB")],
+        )
+
+    def test_complete_items_sends_pending_additions_before_read(self):
+        moltin = StubMoltinClient()
+        client = self.make_client(moltin)
+
+        client.remove_product_from_cart(1, "item-1")
+        client.add_product_to_cart(1, "margherita", 1, currency="RUB")
+        client.get_cart_and_full_price(1, optimistic=True, complete_items=True)
+
+        self.assertEqual(
+            moltin.calls,
+            [
+                ("remove", 1, "item-1"),
+                ("add", 1, "margherita", 1, "RUB"),
+                ("get", 1),
+            ],
+        )
+
+    def test_complete_items_applies_pending_removals(self):
+        items = [
+            CartItem(id="item-1", product_id="margherita", quantity=1, amount=500),
+            CartItem(id="item-2", product_id="pepperoni", quantity=1, amount=600),
+        ]
+        moltin = StubMoltinClient(cart_items=items)
+        client = self.make_client(moltin)
+
+        client.remove_product_from_cart(1, "item-1")
+        cart_items, total_price = client.get_cart_and_full_price(
+            1, optimistic=True, complete_items=True
+        )
+
+        self.assertEqual(moltin.calls, [("get", 1)])
+        self.assertEqual(cart_items, [items[1]])
+        self.assertEqual(total_price, 600)
+
+
+if __name__ == "__main__":
+    unittest.main()
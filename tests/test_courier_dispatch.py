@@ -0,0 +1,61 @@
+import unittest
+from unittest import mock
+
+from benchmarks.load import InMemoryRedis
+from courier_dispatch import CourierDispatcher
+from template_loader import create_jinja_env
+
+
+def make_order(number):
+    return {
+        "order_id": f"order-{number}",
+        "chat_id": number,
+        "customer_coords": {"lon": 37.6 + number / 100, "lat": 55.7},
+        "cart_items": [],
+        "restaurant_id": "restaurant-1",
+        "restaurant_address": "ул. Тестовая, 1",
+        "restaurant_coords": {"lon": 37.6, "lat": 55.7},
+        "restaurant_courier": 42,
+    }
+
+
+class FailedRouteRetryTest(unittest.TestCase):
+    def setUp(self):
+        self.redis = InMemoryRedis()
+        self.bot = mock.MagicMock()
+        self.bot.send_message.side_effect = [
+            ConnectionError,
+            ConnectionError,
+            mock.DEFAULT,
+        ]
+        self.dispatcher = CourierDispatcher(
+            self.redis,
+            self.bot,
+            create_jinja_env(),
+            window=120,
+            poll_interval=1.0,
+        )
+        self.dispatcher.add(make_order(1), now=0)
+
+    def test_retried_after_poll_interval_with_backoff(self):
+        self.assertEqual(self.dispatcher.dispatch(now=120), 0)
+        # First retry is due after poll interval, second after twice that
+        self.assertEqual(self.dispatcher.dispatch(now=120.5), 0)
+        self.assertEqual(self.dispatcher.dispatch(now=121), 0)
+        self.assertEqual(self.dispatcher.dispatch(now=122.5), 0)
+        self.assertEqual(self.dispatcher.dispatch(now=123), 1)
+
+        self.assertEqual(self.bot.send_message.call_count, 3)
+        self.assertEqual(self.redis.llen("dispatch:stops:restaurant-1"), 0)
+
+    def test_retry_delay_is_capped(self):
+        self.bot.send_message.side_effect = ConnectionError
+        now = 120
+        for _ in range(10):
+            self.dispatcher.dispatch(now=now)
+            now += CourierDispatcher.MAX_RETRY_DELAY
+        self.assertEqual(self.bot.send_message.call_count, 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
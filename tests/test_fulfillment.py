@@ -0,0 +1,97 @@
+import json
+import time
+import unittest
+from unittest import mock
+
+from benchmarks.load import InMemoryRedis
+from fulfillment import FulfillmentPipeline
+from template_loader import create_jinja_env
+
+
+ORDER = {
+    "order_id": "charge-1",
+    "chat_id": 1001,
+    "customer_coords": {"lon": 37.5, "lat": 55.8},
+    "cart_items": [{"name": "Пицца", "quantity": 1}],
+    "restaurant_id": "restaurant-1",
+    "restaurant_address": "ул. Тестовая, 1",
+    "restaurant_coords": {"lon": 37.6, "lat": 55.7},
+    "restaurant_courier": 42,
+}
+
+
+class FulfillmentPipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.redis = InMemoryRedis()
+        self.moltin = mock.MagicMock()
+
+    def make_pipeline(self, workers=1, **kwargs):
+        pipeline = FulfillmentPipeline(
+            self.redis,
+            self.moltin,
+            mock.MagicMock(),
+            mock.MagicMock(),
+            create_jinja_env(),
+            workers=workers,
+            max_attempts=1,
+            retry_delay=0,
+            **kwargs,
+        )
+        self.addCleanup(pipeline.stop)
+        return pipeline
+
+    def wait_until_fulfilled(self, order_id, timeout=5):
+        deadline = time.monotonic() + timeout
+        while self.redis.exists(FulfillmentPipeline.ORDER_KEY.format(order_id)):
+            if time.monotonic() > deadline:
+                self.fail(f"Order({order_id}) was not fulfilled in {timeout} s")
+            time.sleep(0.01)
+
+    def test_order_is_enqueued_once(self):
+        pipeline = self.make_pipeline()
+        self.assertTrue(pipeline.enqueue(ORDER))
+        self.assertFalse(pipeline.enqueue(ORDER))
+        self.assertEqual(self.redis.llen(FulfillmentPipeline.QUEUE_KEY), 1)
+
+    def test_failed_order_is_requeued_without_restart(self):
+        self.moltin.create_flow_entry.side_effect = [ConnectionError, mock.DEFAULT]
+        pipeline = self.make_pipeline(requeue_delay=0.2, maintenance_interval=0.05)
+        pipeline.enqueue(ORDER)
+
+        with self.assertLogs("pizza_bot", "ERROR"):
+            pipeline.start()
+            self.wait_until_fulfilled(ORDER["order_id"])
+
+        self.assertEqual(self.moltin.create_flow_entry.call_count, 2)
+        self.assertEqual(self.redis.llen(FulfillmentPipeline.FAILED_KEY), 0)
+
+    def test_failed_order_waits_for_its_retry(self):
+        order = {**ORDER, "done_steps": [], "retry_at": time.time() + 60}
+        self.redis.set(
+            FulfillmentPipeline.ORDER_KEY.format(order["order_id"]), json.dumps(order)
+        )
+        self.redis.lpush(FulfillmentPipeline.FAILED_KEY, order["order_id"])
+
+        self.make_pipeline(workers=0).start()
+
+        self.assertEqual(self.redis.llen(FulfillmentPipeline.FAILED_KEY), 1)
+        self.assertEqual(self.redis.llen(FulfillmentPipeline.QUEUE_KEY), 0)
+
+    def test_only_orders_of_expired_leases_are_requeued(self):
+        processing_key = FulfillmentPipeline.PROCESSING_KEY
+        self.redis.hset(FulfillmentPipeline.LEASES_KEY, "alive", time.time() + 60)
+        self.redis.lpush(processing_key.format("alive"), "in-flight")
+        self.redis.hset(FulfillmentPipeline.LEASES_KEY, "dead", time.time() - 1)
+        self.redis.lpush(processing_key.format("dead"), "abandoned")
+
+        self.make_pipeline(workers=0).start()
+
+        self.assertEqual(
+            self.redis.lrange(FulfillmentPipeline.QUEUE_KEY, 0, -1), [b"abandoned"]
+        )
+        self.assertEqual(self.redis.llen(processing_key.format("alive")), 1)
+        self.assertNotIn(b"dead", self.redis.hgetall(FulfillmentPipeline.LEASES_KEY))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+import unittest
+
+from models import CartItem
+from prices import PriceTable
+
+
+CURRENCIES_INFO = {
+    "data": [
+        {
+            "code": "RUB",
+            "default": True,
+            "exchange_rate": 1,
+            "decimal_places": 0,
+            "format": "{price} Р",
+        },
+        {
+            "code": "USD",
+            "exchange_rate": 0.0125,
+            "decimal_places": 2,
+            "format": "${price}",
+            "thousand_separator": ",",
+        },
+        {
+            "code": "JPY",
+            "exchange_rate": 1.6,
+            "decimal_places": 0,
+            "format": "¥{price}",
+        },
+    ]
+}
+
+PRODUCTS_INFO = {
+    "data": [
+        {
+            "id": "margherita",
+            "price": [
+                {"amount": 500, "currency": "RUB"},
+                # Moltin amounts are in units of `decimal_places`, $6.99
+                {"amount": 699, "currency": "USD"},
+            ],
+        },
+        {"id": "pepperoni", "price": [{"amount": 650, "currency": "RUB"}]},
+        {
+            "id": "sushi-pizza",
+            "price": [
+                {"amount": 700, "currency": "RUB"},
+                {"amount": 1200, "currency": "JPY"},
+            ],
+        },
+    ]
+}
+
+
+class PriceTableTest(unittest.TestCase):
+    def setUp(self):
+        self.prices = PriceTable.from_api(
+            PRODUCTS_INFO, CURRENCIES_INFO, ["RUB", "USD", "JPY"]
+        )
+
+    def test_explicit_price_is_taken_as_is(self):
+        self.assertEqual(self.prices.get_price("margherita", "USD"), 699)
+        self.assertEqual(self.prices.get_price("sushi-pizza", "JPY"), 1200)
+
+    def test_missing_price_is_converted_by_exchange_rate(self):
+        # 650 RUB * 0.0125 = $8.125, rounded half up to cents
+        self.assertEqual(self.prices.get_price("pepperoni", "USD"), 813)
+        self.assertEqual(self.prices.get_price("pepperoni", "JPY"), 1040)
+
+    def test_whole_unit_amounts_are_converted_to_minor_units(self):
+        # Store currency has no decimal places, Telegram wants kopecks
+        self.assertEqual(self.prices.get_price("margherita", "RUB"), 50000)
+        self.assertEqual(self.prices.format(50000, "RUB"), "500 Р")
+
+    def test_two_decimal_amounts_are_kept(self):
+        self.assertEqual(self.prices.format(699, "USD"), "$6.99")
+        self.assertEqual(self.prices.format(123456, "USD"), "$1,234.56")
+
+    def test_zero_decimal_currency_has_no_minor_units(self):
+        self.assertEqual(self.prices.get_price("margherita", "JPY"), 800)
+        self.assertEqual(self.prices.format(800, "JPY"), "¥800")
+
+    def test_store_currency_falls_back_without_moltin_currencies(self):
+        with self.assertLogs("pizza_bot", "WARNING"):
+            prices = PriceTable.from_api(PRODUCTS_INFO, {"data": []}, ["RUB", "USD"])
+
+        self.assertEqual(prices.currencies, ("RUB",))
+        self.assertEqual(prices.get_price("margherita", "RUB"), 50000)
+        self.assertEqual(prices.convert(100, "RUB"), 10000)
+        self.assertEqual(prices.format(50000, "RUB"), "500 Р")
+
+    def test_known_product_is_priced_from_table(self):
+        item = CartItem(product_id="margherita", quantity=2, amount=1)
+        self.assertEqual(self.prices.get_item_amount(item, "RUB"), 100000)
+        self.assertEqual(self.prices.get_item_amount(item, "USD"), 1398)
+
+    def test_product_missing_from_table_is_priced_from_cart_amount(self):
+        item = CartItem(product_id="gone", quantity=2, amount=1200)
+        self.assertEqual(self.prices.get_item_amount(item, "RUB"), 120000)
+        self.assertEqual(self.prices.get_item_amount(item, "USD"), 1500)
+        self.assertEqual(self.prices.get_item_amount(item, "JPY"), 1920)
+
+    def test_delivery_fee_is_converted(self):
+        self.assertEqual(self.prices.convert(100, "RUB"), 10000)
+        self.assertEqual(self.prices.convert(100, "USD"), 125)
+        self.assertEqual(self.prices.convert(100, "JPY"), 160)
+
+    def test_total_sums_item_amounts(self):
+        cart_items = [
+            CartItem(product_id="margherita", quantity=1),
+            CartItem(product_id="pepperoni", quantity=2),
+        ]
+        self.assertEqual(self.prices.get_total(cart_items, "RUB"), 180000)
+        self.assertEqual(self.prices.get_total(cart_items, "USD"), 699 + 2 * 813)
+
+
+if __name__ == "__main__":
+    unittest.main()
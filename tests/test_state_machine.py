@@ -0,0 +1,111 @@
+import inspect
+import unittest
+from unittest import mock
+
+import states
+from state_machine import State, StateMachine, StateRegistry, Transition
+
+
+registry = StateRegistry()
+
+
+@registry.register("PageState")
+class MenuState(State):
+    def handle_input(self, update, context, moltin, jinja):
+        return Transition(update.message.text, {"page": 2})
+
+
+@registry.register("DetailState", StateMachine.INITIAL_STATE)
+class PageState(State):
+    def __init__(self, page):
+        self.page = page
+
+
+@registry.register(StateMachine.INITIAL_STATE)
+class DetailState(State):
+    def __init__(self, page):
+        self.page = page
+
+
+class StateRegistryTest(unittest.TestCase):
+    def setUp(self):
+        registry.validate(MenuState)
+
+    def test_declared_transition_creates_registered_state(self):
+        state = registry.create_state("MenuState", Transition("PageState", {"page": 3}))
+
+        self.assertIsInstance(state, PageState)
+        self.assertEqual(state.page, 3)
+
+    def test_initial_state_transition_creates_initial_state(self):
+        state = registry.create_state(
+            "PageState", Transition(StateMachine.INITIAL_STATE)
+        )
+
+        self.assertIsInstance(state, MenuState)
+
+    def test_undeclared_transition_is_refused(self):
+        with self.assertRaises(ValueError):
+            registry.create_state("PageState", Transition("PageState", {"page": 1}))
+
+    def test_unreachable_state_is_reported(self):
+        other_registry = StateRegistry()
+        other_registry.register(StateMachine.INITIAL_STATE)(MenuState)
+        other_registry.register(StateMachine.INITIAL_STATE)(PageState)
+
+        with self.assertRaisesRegex(ValueError, "PageState is unreachable"):
+            other_registry.validate(MenuState)
+
+    def test_bot_states_are_registered(self):
+        state_names = {
+            name
+            for name, value in vars(states).items()
+            if inspect.isclass(value)
+            and issubclass(value, State)
+            and value is not State
+        }
+        states.registry.validate(states.MenuState)
+
+        self.assertEqual(state_names, states.registry.transitions.keys())
+
+
+class StateMachineTest(unittest.TestCase):
+    def setUp(self):
+        self.storage = mock.MagicMock()
+        self.machine = StateMachine(
+            MenuState, registry, self.storage, mock.MagicMock(), mock.MagicMock()
+        )
+        self.state = MenuState()
+        self.machine.users_state[1] = self.state
+        patcher = mock.patch.object(MenuState, "clean_up")
+        self.clean_up = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def handle(self, text):
+        update = mock.MagicMock()
+        update.effective_chat.id = 1
+        update.message.text = text
+        self.machine.handle_message(update, mock.MagicMock())
+
+    def test_state_is_switched_through_registry(self):
+        with mock.patch.object(PageState, "prepare_state") as prepare_state:
+            self.handle("PageState")
+
+        new_state = self.machine.users_state[1]
+        self.assertIsInstance(new_state, PageState)
+        self.assertEqual(new_state.page, 2)
+        self.clean_up.assert_called_once()
+        prepare_state.assert_called_once()
+        self.storage.save.assert_called_once()
+
+    def test_undeclared_transition_keeps_state(self):
+        with self.assertLogs("pizza_bot", "ERROR"):
+            self.handle("DetailState")
+
+        self.assertIs(self.machine.users_state[1], self.state)
+        self.clean_up.assert_not_called()
+        self.storage.save.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
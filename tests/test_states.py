@@ -0,0 +1,98 @@
+import pickle
+import unittest
+from unittest import mock
+
+from models import Restaurant
+from states import ConfirmAddressState, MenuState, PaymentInquiryState, registry
+
+
+# Restaurant the way states kept it before restaurants became models
+RESTAURANT_ENTRY = {
+    "id": "restaurant-1",
+    "type": "entry",
+    "restaurant-address": "ул. Тестовая, 1",
+    "restaurant-lon": "37.6",
+    "restaurant-lat": "55.7",
+    "restaurant-courier": 42,
+}
+
+
+def pickle_legacy_state(state_class, attributes):
+    """Pickle state of `state_class` holding only given private attributes,
+    the way a state saved by an older version is pickled"""
+    state = object.__new__(state_class)
+    state.__dict__.update(
+        (f"_{state_class.__name__}__{name}", value)
+        for name, value in attributes.items()
+    )
+    return pickle.dumps(state)
+
+
+class LegacyPaymentInquiryStateTest(unittest.TestCase):
+    def setUp(self):
+        self.state = pickle.loads(
+            pickle_legacy_state(
+                PaymentInquiryState,
+                {
+                    "restaurant": RESTAURANT_ENTRY,
+                    "delivery_price": 100,
+                    "customer_coords": {"lon": 37.5, "lat": 55.8},
+                    "chat_id": 1001,
+                    "cart_items": [{"name": "Пицца", "quantity": 1}],
+                    "message_id": 1,
+                    "invoice_id": 2,
+                },
+            )
+        )
+
+    def test_restaurant_is_converted_to_model(self):
+        restaurant = self.state._PaymentInquiryState__restaurant
+        self.assertEqual(restaurant, Restaurant.from_api(RESTAURANT_ENTRY))
+
+    def test_successful_payment_enqueues_order(self):
+        update = mock.MagicMock(pre_checkout_query=None)
+        update.message.successful_payment.telegram_payment_charge_id = "charge-1"
+        context = mock.MagicMock()
+        fulfillment = context.bot_data.__getitem__.return_value
+
+        self.state.handle_input(update, context, mock.MagicMock(), mock.MagicMock())
+
+        [order], _ = fulfillment.enqueue.call_args
+        self.assertEqual(order["order_id"], "charge-1")
+        self.assertEqual(order["restaurant_id"], "restaurant-1")
+        self.assertEqual(order["restaurant_address"], "ул. Тестовая, 1")
+        self.assertEqual(order["restaurant_coords"], {"lon": 37.6, "lat": 55.7})
+        self.assertEqual(order["restaurant_courier"], 42)
+        context.bot.send_message.assert_called()
+
+
+class LegacyConfirmAddressStateTest(unittest.TestCase):
+    def test_delivery_request_switches_to_payment(self):
+        state = pickle.loads(
+            pickle_legacy_state(
+                ConfirmAddressState,
+                {
+                    "lon": 37.5,
+                    "lat": 55.8,
+                    "chat_id": 1001,
+                    "closest_restaurant": RESTAURANT_ENTRY,
+                    "delivery_price": 100,
+                    "message_id": 1,
+                },
+            )
+        )
+        update = mock.MagicMock()
+        update.callback_query.data = "request_delivery"
+
+        transition = state.handle_input(
+            update, mock.MagicMock(), mock.MagicMock(), mock.MagicMock()
+        )
+        registry.validate(MenuState)
+        new_state = registry.create_state("ConfirmAddressState", transition)
+
+        self.assertIsInstance(new_state, PaymentInquiryState)
+        self.assertEqual(new_state.get_event_attributes()["restaurant"], "restaurant-1")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,19 +2,35 @@ import logging
 
 import redis
 from environs import Env
-from jinja2 import Environment, FileSystemLoader, select_autoescape
+from telegram import Bot
 from telegram.ext import (
     Updater,
     CallbackQueryHandler,
     MessageHandler,
     CommandHandler,
+    Dispatcher,
     Filters,
+    InlineQueryHandler,
+    JobQueue,
     PreCheckoutQueryHandler,
 )
 
+import metrics
+import tracing
+from cart_coalescer import CoalescingCartClient
+from catalog import CatalogRefresher
+from catalog_cache import CachingMoltinClient
+from catalog_search import CatalogSearch
+from courier_dispatch import CourierDispatcher
+from fulfillment import FulfillmentPipeline
+from invoices import InvoiceRegistry, PreCheckoutFirstQueue
 from moltin_api import SimpleMoltinApiClient
+from order_events import EventLog
+from prefetcher import Prefetcher
 from state_machine import StateMachine
-from states import MenuState
+from state_storage import create_state_storage
+from states import MenuState, registry
+from template_loader import create_jinja_env
 from tg_log_handler import TelegramLogHandler
 
 
@@ -35,22 +51,117 @@ def main():
     telegram_handler.setLevel(logging.ERROR)
     logger.addHandler(telegram_handler)
 
+    if metrics_port := env.int("METRICS_PORT", None):
+        metrics.enable(metrics_port, addr=env("METRICS_ADDR", "127.0.0.1"))
+
+    tracing.configure(
+        slow_update_ms=env.float("TRACE_SLOW_UPDATE_MS", None),
+        profile_sample_rate=env.float("PROFILE_SAMPLE_RATE", 0.0),
+        profile_dir=env("PROFILE_DIR", None),
+    )
+    tracing.install_signal_handlers()
+
     redis_connection = redis.Redis(
         host=env("REDIS_HOST"),
         port=env("REDIS_PORT"),
         password=env("REDIS_PASSWORD"),
     )
-    moltin_client = SimpleMoltinApiClient(
+    moltin_api_client = SimpleMoltinApiClient(
         client_id=env("MOLTIN_CLIENT_ID"), client_secret=env("MOLTIN_CLIENT_SECRET")
     )
-    jinja_env = Environment(
-        loader=FileSystemLoader("./templates/"), autoescape=select_autoescape()
+    catalog = None
+    if catalog_refresh_interval := env.int("CATALOG_REFRESH_INTERVAL", 60):
+        catalog = CatalogRefresher(
+            moltin_api_client,
+            interval=catalog_refresh_interval,
+            snapshot_path=env("CATALOG_SNAPSHOT_PATH", "./catalog.snapshot") or None,
+            currencies=env.list("CURRENCIES", ["RUB"]),
+        )
+        catalog.start()
+    moltin_client = CoalescingCartClient(
+        CachingMoltinClient(
+            moltin_api_client,
+            catalog=catalog,
+            redis_connection=redis_connection,
+            catalog_ttl=env.int("CATALOG_CACHE_TTL", 300),
+        ),
+        window=env.float("CART_COALESCE_WINDOW", 1.0),
+    )
+    jinja_env = create_jinja_env(
+        compiled_templates_dir=env("JINJA_COMPILED_TEMPLATES", None),
+        production=env.bool("JINJA_PRODUCTION", False),
+    )
+
+    prefetch_workers = env.int("PREFETCH_WORKERS", 4)
+    prefetcher = Prefetcher(max_workers=prefetch_workers) if prefetch_workers else None
+
+    event_log = None
+    if event_log_interval := env.float("EVENT_LOG_INTERVAL", 1.0):
+        event_log = EventLog(redis_connection, flush_interval=event_log_interval)
+        event_log.start()
+
+    state_storage = create_state_storage(
+        redis_connection, path=env("STATE_STORAGE_PATH", None)
     )
 
-    state_machine = StateMachine(MenuState, redis_connection, moltin_client, jinja_env)
+    state_machine = StateMachine(
+        MenuState,
+        registry,
+        state_storage,
+        moltin_client,
+        jinja_env,
+        prefetcher=prefetcher,
+        event_log=event_log,
+    )
 
-    updater = Updater(env("TELEGRAM_BOT_TOKEN"))
-    dispatcher = updater.dispatcher
+    workers = 4
+    fulfillment_workers = env.int("FULFILLMENT_WORKERS", 2)
+    bot = Bot(
+        env("TELEGRAM_BOT_TOKEN"),
+        request=metrics.InstrumentedRequest(
+            con_pool_size=workers + fulfillment_workers + 4
+        ),
+    )
+    job_queue = JobQueue()
+    dispatcher = Dispatcher(
+        bot, PreCheckoutFirstQueue(), workers=workers, job_queue=job_queue
+    )
+    job_queue.set_dispatcher(dispatcher)
+    updater = Updater(dispatcher=dispatcher, workers=None)
+    courier_dispatcher = None
+    if courier_dispatch_window := env.int("COURIER_DISPATCH_WINDOW", 120):
+        courier_dispatcher = CourierDispatcher(
+            redis_connection,
+            bot,
+            jinja_env,
+            window=courier_dispatch_window,
+            max_stops=env.int("COURIER_MAX_STOPS", 5),
+        )
+        courier_dispatcher.start()
+    fulfillment = FulfillmentPipeline(
+        redis_connection,
+        moltin_client,
+        bot,
+        job_queue,
+        jinja_env,
+        workers=fulfillment_workers,
+        courier_dispatcher=courier_dispatcher,
+    )
+    fulfillment.start()
+    invoices = InvoiceRegistry(redis_connection)
+    dispatcher.bot_data["fulfillment"] = fulfillment
+    dispatcher.bot_data["invoices"] = invoices
+    dispatcher.bot_data["currency_by_language"] = env.dict("CURRENCY_BY_LANGUAGE", {})
+    if event_log:
+        dispatcher.bot_data["event_log"] = event_log
+    # Answer pre-checkout queries before they reach the state machine
+    dispatcher.add_handler(
+        PreCheckoutQueryHandler(invoices.answer_pre_checkout), group=-1
+    )
+    if catalog:
+        catalog_search = CatalogSearch(catalog)
+        dispatcher.bot_data["catalog_search"] = catalog_search
+        dispatcher.add_handler(InlineQueryHandler(catalog_search.answer_inline_query))
     dispatcher.add_handler(CallbackQueryHandler(state_machine.handle_message))
     dispatcher.add_handler(PreCheckoutQueryHandler(state_machine.handle_message))
     dispatcher.add_handler(MessageHandler(Filters.text, state_machine.handle_message))
@@ -68,6 +179,17 @@ def main():
     dispatcher.add_error_handler(on_error)
     updater.start_polling()
     updater.idle()
+    fulfillment.stop()
+    if courier_dispatcher:
+        courier_dispatcher.stop()
+    if event_log:
+        event_log.stop()
+    moltin_client.flush_all()
+    state_storage.close()
+    if prefetcher:
+        prefetcher.shutdown()
+    if catalog:
+        catalog.stop()
 
 
 if __name__ == "__main__":
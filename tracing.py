@@ -0,0 +1,195 @@
+import cProfile
+import json
+import logging
+import os
+import random
+import signal
+import threading
+import time
+
+
+logger = logging.getLogger("pizza_bot")
+
+
+class _Local(threading.local):
+    # Class default keeps lookups off the AttributeError path in threads
+    # which never traced an update
+    span = None
+
+
+_local = _Local()
+
+
+class TracingSettings:
+    def __init__(self, slow_update_ms=None, profile_sample_rate=0.0, profile_dir=None):
+        self.slow_update_ms = slow_update_ms
+        self.profile_sample_rate = profile_sample_rate
+        self.profile_dir = profile_dir if profile_dir else "./profiles"
+        self.tracing_enabled = slow_update_ms is not None
+        self.profiling_enabled = profile_sample_rate > 0
+
+
+settings = TracingSettings()
+
+
+class Span:
+    def __init__(self, name, **attributes):
+        self.name = name
+        self.attributes = attributes
+        self.children = []
+        self.started_at = time.perf_counter()
+        self.duration = None
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.started_at
+
+    def as_dict(self, trace_started_at):
+        span_info = {
+            "name": self.name,
+            "start_ms": round((self.started_at - trace_started_at) * 1000, 3),
+            "duration_ms": round(self.duration * 1000, 3),
+            **self.attributes,
+        }
+        if self.children:
+            span_info["children"] = [
+                child.as_dict(trace_started_at) for child in self.children
+            ]
+        return span_info
+
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class _ChildSpan:
+    def __init__(self, name, attributes):
+        self.__name = name
+        self.__attributes = attributes
+
+    def __enter__(self):
+        self.__parent = _local.span
+        self.__span = Span(self.__name, **self.__attributes)
+        self.__parent.children.append(self.__span)
+        _local.span = self.__span
+        return self.__span
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.__span.finish()
+        if exc_type:
+            self.__span.attributes["error"] = exc_type.__name__
+        _local.span = self.__parent
+
+
+def span(name, **attributes):
+    """Record a child span of the update being traced, if any"""
+    if _local.span is None:
+        return _NOOP_SPAN
+    return _ChildSpan(name, attributes)
+
+
+def annotate(**attributes):
+    """Add attributes to the innermost active span"""
+    if (current_span := _local.span) is not None:
+        current_span.attributes.update(attributes)
+
+
+def record_http_response(response, *args, **kwargs):
+    """`requests` response hook adding request details to active span"""
+    annotate(
+        method=response.request.method,
+        url=response.url,
+        status=response.status_code,
+    )
+
+
+class _UpdateTrace:
+    def __init__(self, attributes):
+        self.__attributes = attributes
+
+    def __enter__(self):
+        self.__profiler = None
+        if (
+            settings.profiling_enabled
+            and random.random() < settings.profile_sample_rate
+        ):
+            self.__profiler = cProfile.Profile()
+            self.__profiler.enable()
+
+        self.__span = None
+        if settings.tracing_enabled:
+            self.__span = _local.span = Span("update", **self.__attributes)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.__profiler:
+            self.__profiler.disable()
+            self.__dump_profile()
+
+        if not self.__span:
+            return
+        _local.span = None
+        self.__span.finish()
+        if exc_type:
+            self.__span.attributes["error"] = exc_type.__name__
+        if self.__span.duration * 1000 >= settings.slow_update_ms:
+            logger.warning(
+                "Slow update: %s",
+                json.dumps(
+                    self.__span.as_dict(self.__span.started_at), ensure_ascii=False
+                ),
+            )
+
+    def __dump_profile(self):
+        os.makedirs(settings.profile_dir, exist_ok=True)
+        file_name = "{}-{}.prof".format(
+            time.strftime("%Y%m%d-%H%M%S"),
+            "-".join(str(value) for value in self.__attributes.values()),
+        )
+        self.__profiler.dump_stats(os.path.join(settings.profile_dir, file_name))
+
+
+def trace_update(**attributes):
+    """Trace handling of single update.
+
+    Logs span tree if update took longer than `slow_update_ms` and
+    writes cProfile stats for sampled fraction of updates.
+    """
+    if not settings.tracing_enabled and not settings.profiling_enabled:
+        return _NOOP_SPAN
+    return _UpdateTrace(attributes)
+
+
+def configure(slow_update_ms=None, profile_sample_rate=0.0, profile_dir=None):
+    global settings
+    settings = TracingSettings(slow_update_ms, profile_sample_rate, profile_dir)
+
+
+def toggle_tracing(signum=None, frame=None):
+    if settings.slow_update_ms is None:
+        settings.slow_update_ms = 1000
+    settings.tracing_enabled = not settings.tracing_enabled
+    logger.info(
+        f"Slow update tracing {'enabled' if settings.tracing_enabled else 'disabled'}"
+    )
+
+
+def toggle_profiling(signum=None, frame=None):
+    if not settings.profile_sample_rate:
+        settings.profile_sample_rate = 0.01
+    settings.profiling_enabled = not settings.profiling_enabled
+    logger.info(
+        f"Update profiling {'enabled' if settings.profiling_enabled else 'disabled'}"
+    )
+
+
+def install_signal_handlers():
+    """Toggle tracing on SIGUSR1 and profiling on SIGUSR2"""
+    signal.signal(signal.SIGUSR1, toggle_tracing)
+    signal.signal(signal.SIGUSR2, toggle_profiling)